@@ -0,0 +1,2017 @@
+"""
+Headless chart engine for the Music Tracker app.
+
+Holds everything that does not need Home Assistant: the SQLite schema and
+migrations, play ingestion, chart queries and aggregation, chart snapshots,
+HTML rendering and database optimization. The AppDaemon app in
+music_tracker.py drives it; it can also be run on its own:
+
+  python music_chart_engine.py charts /config/music_data_history.db --output /config/www/music_charts.html
+  python music_chart_engine.py charts music.db --periods weekly,quarterly:90 --json charts.json
+  python music_chart_engine.py rebuild-history music.db --days 365
+  python music_chart_engine.py optimize music.db --dry-run
+  python music_chart_engine.py renormalize music.db --keywords remaster,remix,live
+  python music_chart_engine.py check-plans music.db
+  python music_chart_engine.py --metrics music.prom --slow-query-ms 200 charts music.db --output charts.html
+"""
+
+import argparse
+import contextlib
+import datetime
+import functools
+import gzip
+import hashlib
+import heapq
+import json
+import logging
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+import jinja2
+
+TEMPLATE = """<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="UTF-8" />
+<meta name="viewport" content="width=device-width,initial-scale=1" />
+<title>Music Charts</title>
+<style>
+:root{color-scheme:light dark;--bg-light:#f4f4f9;--bg-dark:#1a1a1a;--text-light:#333;--text-dark:#eee;--card-light:#fff;--card-dark:#2a2a2a;--accent-light:#3498db;--accent-dark:#2980b9;}
+*{box-sizing:border-box;margin:0;padding:0;}
+body{font-family:sans-serif;background:var(--bg-light);color:var(--text-light);padding:1em;}
+body.dark-mode{background:var(--bg-dark);color:var(--text-dark);}
+#refreshPageButton,#toggleDarkMode,#toggleUpdates{padding:.4em 1em;font-size:.75rem;color:#fff;background:#007bff;border:none;border-radius:5px;cursor:pointer;margin-right:.5em;}
+#toggleUpdates:disabled{background:#6c757d;cursor:not-allowed;}
+header{display:flex;flex-wrap:wrap;align-items:center;justify-content:space-between;margin-bottom:1em;}
+h1{font-size:1.6rem;color:var(--accent-light);}
+body.dark-mode h1{color:var(--accent-dark);}
+#controls label{margin-right:1em;font-size:.9rem;color:#34495e;cursor:pointer;}
+body.dark-mode #controls label{color:#ccc;}
+#generated-at{font-size:.8rem;color:#7f8c8d;}
+main{display:flex;flex-direction:column;gap:2em;}
+.chart-section{background:var(--card-light);border-radius:8px;padding:1em;}
+body.dark-mode .chart-section{background:var(--card-dark);}
+.chart-section h2{color:var(--accent-light);}
+body.dark-mode .chart-section h2{color:var(--accent-dark);}
+.chart-tables{display:flex;flex-wrap:wrap;gap:1em;}
+.table-container{flex:1 1 calc(33.33% - 1em);min-width:280px;}
+table{width:100%;border-collapse:collapse;margin-bottom:.5em;}
+th,td{padding:.5em;text-align:start;word-break:break-word;font-size:.8rem;}
+th{background:var(--accent-light);color:#fff;}
+tbody tr:nth-child(even){background:#ecf0f1;}
+body.dark-mode tbody tr:nth-child(even){background:#3a3a3a;}
+tbody tr:hover{background:var(--hover-light);}
+body.dark-mode tbody tr:hover{background:var(--hover-dark);}
+h3{margin:.5em 0;font-size:1rem;color:#2980b9;}
+.ai-container .chart-container{max-height:90vh;}
+.change-up{color:green;font-weight:bold;}
+.change-down{color:red;font-weight:bold;}
+.change-new{color:orange;font-weight:bold;}
+.show-more{padding:.3em .8em;font-size:.75rem;color:#fff;background:var(--accent-light);border:none;border-radius:5px;cursor:pointer;}
+.stats-container{background:#f9f5f0;border-radius:8px;padding:.5em;}
+body.dark-mode .stats-container{background:#3a2e24;}
+.stats-container h3{color:#e67e22;font-size:1rem;margin-bottom:.3em;}
+.stats-container table th{background:#e67e22;color:#fff;}
+#update-status-area p{margin-bottom:.5em;font-size:1.1em;}
+#countdown-refresh-button{padding:.5em 1.2em;font-size:1rem;color:#fff;background:#007bff;border:none;border-radius:5px;cursor:pointer;}
+#countdown-refresh-button:disabled{background:#6c757d;cursor:not-allowed;}
+#countdown-refresh-button:hover:not(:disabled){background:#0056b3;}
+#ai-analysis h2{color:#856404;}
+@media (max-width:768px){
+.table-container{flex:1 1 100%;}
+header{flex-direction:column;align-items:flex-start;}
+header>*:not(:last-child){margin-bottom:1em;}
+#controls{display:grid;grid-template-columns:1fr 1fr;gap:10px;width:100%;margin:0;}
+#controls label{padding:.7em .5em;margin:0;background:rgba(0,0,0,.04);border-radius:6px;text-align:center;}
+body.dark-mode #controls label{background:rgba(255,255,255,.1);}
+#controls label:hover{background:rgba(0,0,0,.1);}
+body.dark-mode #controls label:hover{background:rgba(255,255,255,.2);}
+#action-buttons{display:grid;width:100%;grid-template-columns:1fr 1fr;gap:10px;}
+#action-buttons button{margin:0;width:100%;}
+}
+</style>
+</head>
+<body>
+<header>
+<h1>Music Charts</h1>
+<div id="controls"></div>
+<p id="generated-at">Loading charts…</p>
+<div id="action-buttons">{% if webhook %}<button id="toggleUpdates" onclick="triggerWebhook()">Update Charts</button>{% endif %}<button id="refreshPageButton">Refresh Page</button><button id="toggleDarkMode">Toggle Dark Mode</button></div>
+</header>
+<div id="update-status-area" style="padding:1em;text-align:center;"></div>
+<main id="charts"></main>
+<script>
+const DATA_URL={{ data_url|tojson }},INITIAL_ROWS=10,NO_CHANGE=["yearly","year_over_year"];
+let LABELS={};
+const TABLES=[["songs","🎵 Songs",[["Artist","artist"],["Title","title"],["▶️","plays"]]],["artists","👤 Artists",[["Artist","artist"],["▶️","plays"]]],["albums","💽 Albums",[["Artist","artist"],["Album","album"],["▶️","tracks"]]],["media_channels","📻 Channels/Playlists",[["Channel","channel"],["▶️","plays"]]]];
+const STATS=[["Days Collected","days"],["Unique Songs","unique_songs"],["Total Plays","total_plays"],["Unique Albums","unique_albums"],["Unique Artists","unique_artists"]];
+(function(){
+let d=localStorage.getItem('dark_mode'),p=window.matchMedia&&window.matchMedia('(prefers-color-scheme: dark)').matches;
+if(d==='1'||(d===null&&p))document.body.classList.add('dark-mode');
+})();
+function el(tag,attrs,text){const e=document.createElement(tag);for(const k in attrs||{})e.setAttribute(k,attrs[k]);if(text!==undefined&&text!==null)e.textContent=text;return e;}
+function cap(s){return s.charAt(0).toUpperCase()+s.slice(1);}
+function label(period){return LABELS[period]||cap(period);}
+function changeCell(cols,i){
+const td=el("td",{nowrap:""}),c=cols.change[i];
+if(cols.new_entry[i])td.appendChild(el("span",{class:"change-new"},"NEW"));
+else if(c>0)td.appendChild(el("span",{class:"change-up"},"▲"+c));
+else if(c<0)td.appendChild(el("span",{class:"change-down"},"▼"+(-c)));
+else td.textContent="–";
+return td;
+}
+function appendRows(tbody,cols,fields,showChange,from,to){
+const rows=document.createDocumentFragment();
+for(let i=from;i<to;i++){
+const tr=el("tr");tr.appendChild(el("td",{nowrap:""},i+1));
+fields.forEach(f=>tr.appendChild(el("td",f[1]==="plays"?{nowrap:""}:null,cols[f[1]][i])));
+if(showChange)tr.appendChild(changeCell(cols,i));
+rows.appendChild(tr);
+}
+tbody.appendChild(rows);
+}
+function renderTable(title,fields,cols,showChange){
+const box=el("div",{class:"table-container"}),n=cols?cols[fields[0][1]].length:0;
+box.appendChild(el("h3",null,title));
+if(!n){box.appendChild(el("p",null,"No data for "+title));return box;}
+const table=el("table"),thead=el("thead"),head=el("tr"),tbody=el("tbody");
+head.appendChild(el("th"));fields.forEach(f=>head.appendChild(el("th",null,f[0])));
+if(showChange)head.appendChild(el("th",null,"~"));
+thead.appendChild(head);table.appendChild(thead);table.appendChild(tbody);box.appendChild(table);
+const first=Math.min(n,INITIAL_ROWS);
+appendRows(tbody,cols,fields,showChange,0,first);
+if(n>first){const more=el("button",{class:"show-more"},"Show all "+n);more.onclick=function(){appendRows(tbody,cols,fields,showChange,first,n);more.remove();};box.appendChild(more);}
+return box;
+}
+function renderPeriod(period,data){
+const sec=el("section",{id:"chart-"+period,class:"chart-section"}),tables=el("div",{class:"chart-tables"});
+sec.appendChild(el("h2",null,"Top "+label(period)+" ("+data.dates+")"));
+TABLES.forEach(t=>tables.appendChild(renderTable(t[1],t[2],data[t[0]],!NO_CHANGE.includes(period)&&t[0]!=="media_channels")));
+const stats=el("div",{class:"table-container stats-container",style:"max-width:30%;"}),table=el("table"),tbody=el("tbody"),head=el("tr");
+stats.appendChild(el("h3",null,"📈 "+label(period)+" Statistics"));
+head.appendChild(el("th",null,"Metric"));head.appendChild(el("th",null,"Value"));
+const thead=el("thead");thead.appendChild(head);table.appendChild(thead);
+STATS.forEach(s=>{const tr=el("tr");tr.appendChild(el("td",null,s[0]));tr.appendChild(el("td",null,(data.overview||{})[s[1]]));tbody.appendChild(tr);});
+table.appendChild(tbody);stats.appendChild(table);tables.appendChild(stats);sec.appendChild(tables);
+return sec;
+}
+function renderControls(periods){
+const controls=document.getElementById("controls");
+periods.forEach(function(per){
+const box=el("label"),cb=el("input",{type:"checkbox"}),s=localStorage.getItem('show_'+per),sec=document.getElementById('chart-'+per);
+cb.checked=s===null?true:s==="1";
+if(sec)sec.style.display=cb.checked?"":"none";
+cb.onchange=function(){localStorage.setItem('show_'+per,cb.checked?"1":"0");if(sec)sec.style.display=cb.checked?"":"none";};
+box.appendChild(cb);box.appendChild(document.createTextNode(" "+label(per)));controls.appendChild(box);
+});
+}
+function render(data){
+const main=document.getElementById("charts"),gen=document.getElementById("generated-at");
+gen.textContent="Generated at "+data.generated_at;
+LABELS=data.labels||{};
+data.periods.forEach(per=>main.appendChild(renderPeriod(per,data.charts[per])));
+if(data.ai_analysis){
+gen.appendChild(el("br"));gen.appendChild(el("a",{href:"#ai-analysis",id:"ai-indicator",style:"color: light-blue"},"AI Report Available"));
+const ai=el("section",{id:"ai-analysis"});ai.appendChild(el("h2",null,"🔮 AI Analysis"));
+const body=el("div");body.innerHTML=data.ai_analysis;ai.appendChild(body);main.appendChild(ai);
+runScripts(body);
+}
+renderControls(data.periods);
+}
+// Scripts inserted through innerHTML never run; recreate them in order, waiting for each external one to load.
+function runScripts(root){
+const scripts=Array.from(root.querySelectorAll("script"));
+(function next(i){
+if(i>=scripts.length)return;
+const old=scripts[i],script=document.createElement("script");
+Array.from(old.attributes).forEach(a=>script.setAttribute(a.name,a.value));
+script.text=old.text;
+if(old.src){script.onload=script.onerror=()=>next(i+1);}
+old.replaceWith(script);
+if(!old.src)next(i+1);
+})(0);
+}
+document.addEventListener("DOMContentLoaded",function(){
+let r=document.getElementById('refreshPageButton'),t=document.getElementById('toggleDarkMode');
+if(r)r.onclick=function(){location.reload();};
+if(t)t.onclick=function(){let n=document.body.classList.toggle('dark-mode');localStorage.setItem('dark_mode',n?'1':'0');};
+fetch(DATA_URL,{cache:"no-cache"}).then(r=>{if(!r.ok)throw new Error(r.statusText);return r.json();}).then(render)
+.catch(e=>{document.getElementById("generated-at").textContent="Could not load chart data: "+e.message;});
+});
+function triggerWebhook() {
+const originalUpdateButton=document.getElementById('toggleUpdates');
+if(!originalUpdateButton||originalUpdateButton.style.display==='none'){return;}
+originalUpdateButton.style.display='none';
+const statusArea=document.getElementById('update-status-area');
+statusArea.innerHTML=`<p>Update request sent! Please wait while new AI report is generated.</p><button id="countdown-refresh-button" disabled>Refresh in <span id="countdown-timer">30</span>s</button>`;
+fetch("/api/webhook/Update_Music_Charts",{method:"POST"}).then(r=>{if(r.ok){console.log("Webhook triggered!");}else{console.error("Failed:",r.statusText);}}).catch(e=>console.error("Error:",e));
+let countdown=30,timerSpan=document.getElementById('countdown-timer'),newRefreshButton=document.getElementById('countdown-refresh-button');
+const intervalId=setInterval(()=>{
+countdown--;timerSpan.innerText=countdown;
+if(countdown<=0){clearInterval(intervalId);newRefreshButton.disabled=false;newRefreshButton.innerText='✅ Refresh Now';newRefreshButton.onclick=()=>location.reload();}
+},1000);
+}
+</script>
+</body>
+</html>
+"""
+
+# Fields identifying the same chart entry across snapshots, per chart category.
+CHART_ITEM_KEYS = {
+    "songs": ("title", "artist"),
+    "artists": ("artist",),
+    "albums": ("album", "artist"),
+    "media_channels": ("channel",),
+}
+
+# Field holding the ranking value of a chart entry, per chart category.
+CHART_VALUE_FIELDS = {
+    "songs": "plays",
+    "artists": "plays",
+    "albums": "tracks",
+    "media_channels": "plays",
+}
+
+# Date window (relative to today) searched for the snapshot a chart is compared against.
+PREVIOUS_CHART_WINDOWS = {
+    "daily": ("-1 days", "-0 days"),
+    "weekly": ("-14 days", "-7 days"),
+    "monthly": ("-60 days", "-30 days"),
+    "yearly": ("-730 days", "-365 days"),
+    "all_time": ("-14 days", "-7 days"),
+    # Last year's month compares against the chart taken a year ago: the same month two years back.
+    "year_over_year": ("-730 days", "-365 days"),
+}
+
+# Columns of each chart in the page data file; change/new_entry are always added.
+CHART_PAYLOAD_COLUMNS = {
+    "songs": ("artist", "title", "plays"),
+    "artists": ("artist", "plays"),
+    "albums": ("artist", "album", "tracks"),
+    "media_channels": ("channel", "plays"),
+}
+
+# Period covering every play, including the monthly archive.
+ALL_TIME_PERIOD = "all"
+# Period covering the calendar month one year before the chart date.
+YEAR_AGO_MONTH_PERIOD = "same month last year"
+# Start of ALL_TIME_PERIOD.
+EARLIEST_TS = "0001-01-01 00:00:00"
+
+# Chart periods generated on every refresh.
+CHART_TIMEFRAMES = {
+    "daily":   "1 day",
+    "weekly":  "7 days",
+    "monthly": "30 days",
+    "yearly":  "365 days",
+    "all_time": ALL_TIME_PERIOD,
+    "year_over_year": YEAR_AGO_MONTH_PERIOD,
+}
+
+# Page headings of periods whose name does not read well capitalized.
+PERIOD_LABELS = {
+    "all_time": "All-Time",
+    "year_over_year": "Same Month Last Year",
+}
+
+# Plays newest first, served in order by idx_plays_ts_covering.
+RECENT_PLAYS_QUERY = """
+    SELECT a.name, t.title, p.ts, t.artist_id FROM plays p JOIN tracks t ON t.id = p.track_id
+    LEFT JOIN artists a ON a.id = t.artist_id ORDER BY p.ts DESC
+"""
+
+# Ranked items of the latest snapshot inside a comparison window.
+PREVIOUS_CHART_QUERY = """
+    SELECT name, artist, value FROM chart_snapshot_items
+    WHERE snapshot_id = (
+        SELECT id FROM chart_snapshots WHERE type = ? AND period = ? AND day >= date(?, ?) AND day < date(?, ?)
+        ORDER BY day DESC LIMIT 1
+    )
+    ORDER BY rank
+"""
+
+# Version markers removed from track and album titles, e.g. "Song (2011 Remaster)" -> "Song".
+DEFAULT_TITLE_CLEANUP_KEYWORDS = (
+    'remaster', 'mix', 'remix', 'stereo', 'mono', 'demo', 'deluxe', 'instrumental', 'extended', 'version',
+    'radio edit', 'live', 'edit', 'anniversary', 'edition', 'single', 'explicit', 'clean', 'original',
+    'acoustic', 'unplugged',
+)
+
+# db_meta key holding the normalizer pattern the stored titles were last normalized with.
+TITLE_NORMALIZER_PATTERN_KEY = "title_normalizer_pattern"
+
+# db_meta key holding the highest play id already checked for skipped tracks.
+# Ids follow the insert order, so plays committed late with an older timestamp are still checked.
+SKIPPED_TRACKS_WATERMARK_KEY = "skipped_tracks_checked_id"
+
+# Ids of plays that started less than the threshold (param 5, seconds) after the
+# previous play on the same player, where the play or that predecessor was added
+# after the watermark id (params 3-4). The scan starts one threshold before the
+# oldest play added after the watermark (params 1-2) to include predecessors;
+# that play is found by a rowid range, not by walking the whole ts index.
+SKIPPED_PLAYS_QUERY = """
+    SELECT id FROM (
+        SELECT id, ts, LAG(id) OVER w AS prev_id, LAG(ts) OVER w AS prev_ts
+        FROM plays WHERE ts >= COALESCE(datetime((SELECT MIN(ts) FROM plays NOT INDEXED WHERE id > ?), ?), '')
+        WINDOW w AS (PARTITION BY player_id ORDER BY ts, id)
+    )
+    WHERE (id > ? OR prev_id > ?) AND round((julianday(ts) - julianday(prev_ts)) * 86400) >= 0
+      AND round((julianday(ts) - julianday(prev_ts)) * 86400) < ?
+"""
+
+# Canonical titles and albums renamed per re-normalization transaction.
+RENORMALIZE_BATCH_NAMES = 500
+
+# Free pages returned to the file system per incremental_vacuum transaction.
+VACUUM_CHUNK_PAGES = 256
+
+# Monthly archive table -> (columns, query aggregating the plays before a cutoff day).
+MONTHLY_ARCHIVE_SOURCES = {
+    "monthly_track_plays": ("month, track_id, plays",
+                            "SELECT substr(ts, 1, 7), track_id, COUNT(*) FROM plays WHERE ts < ? AND date(ts) IS NOT NULL GROUP BY 1, 2"),
+    "monthly_artist_plays": ("month, artist_id, plays",
+                             "SELECT substr(p.ts, 1, 7), t.artist_id, COUNT(*) FROM plays p JOIN tracks t ON t.id = p.track_id "
+                             "WHERE p.ts < ? AND date(p.ts) IS NOT NULL AND t.artist_id IS NOT NULL GROUP BY 1, 2"),
+    "monthly_channel_plays": ("month, channel_id, plays",
+                              "SELECT substr(ts, 1, 7), channel_id, COUNT(*) FROM plays WHERE ts < ? AND date(ts) IS NOT NULL "
+                              "AND channel_id IS NOT NULL GROUP BY 1, 2"),
+}
+
+# Daily rollup table -> (columns, query that recomputes it from `plays`).
+DAILY_ROLLUP_SOURCES = {
+    "daily_track_plays": ("day, track_id, plays",
+                          "SELECT date(ts), track_id, COUNT(*) FROM plays WHERE date(ts) IS NOT NULL GROUP BY 1, 2"),
+    "daily_artist_plays": ("day, artist_id, plays",
+                           "SELECT date(p.ts), t.artist_id, COUNT(*) FROM plays p JOIN tracks t ON t.id = p.track_id "
+                           "WHERE date(p.ts) IS NOT NULL AND t.artist_id IS NOT NULL GROUP BY 1, 2"),
+    "daily_channel_plays": ("day, channel_id, plays",
+                            "SELECT date(ts), channel_id, COUNT(*) FROM plays WHERE date(ts) IS NOT NULL AND channel_id IS NOT NULL GROUP BY 1, 2"),
+}
+
+class ConnectionManager:
+    """
+    Owns the SQLite connections of the app: one long-lived writer connection
+    shared behind a lock, and one reader connection per thread. Connections
+    run in WAL mode so readers never block the writer, and keep their
+    prepared-statement cache for the lifetime of the app.
+    """
+    def __init__(self, db_path, busy_timeout_ms=5000, cache_size_kib=8192, cached_statements=256):
+        self.db_path = db_path
+        self.busy_timeout_ms = busy_timeout_ms
+        self.cache_size_kib = cache_size_kib
+        self.cached_statements = cached_statements
+        self._write_lock = threading.RLock()
+        self._writer = None
+        self._local = threading.local()
+        self._readers = []
+        self._readers_lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=self.busy_timeout_ms / 1000,
+                               cached_statements=self.cached_statements, check_same_thread=False)
+        conn.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout_ms)}")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute(f"PRAGMA cache_size = -{int(self.cache_size_kib)}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        return conn
+
+    @contextlib.contextmanager
+    def write(self):
+        """Yields the writer connection under the write lock; commits on success, rolls back on error."""
+        with self._write_lock:
+            if self._writer is None:
+                self._writer = self._connect()
+                # Only takes effect on a new database; existing ones are converted by their next VACUUM.
+                self._writer.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                self._writer.execute("PRAGMA journal_mode = WAL")
+            try:
+                yield self._writer
+                self._writer.commit()
+            except BaseException:
+                self._writer.rollback()
+                raise
+
+    @contextlib.contextmanager
+    def read(self):
+        """Yields the calling thread's read-only connection, opening it on first use."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+            conn.execute("PRAGMA query_only = ON")
+            with self._readers_lock:
+                self._readers.append(conn)
+        yield conn
+
+    def close(self):
+        """Closes every connection. Called when the app terminates."""
+        with self._readers_lock:
+            readers, self._readers = self._readers, []
+        for conn in readers:
+            conn.close()
+        self._local = threading.local()
+        with self._write_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+
+def _sql_sort_key(value):
+    """Orders values the way SQLite's ORDER BY ... ASC does (NULLs first)."""
+    return (value is not None, value or "")
+
+def _period_sort_key(days_str):
+    """Orders nested period specs from shortest to longest."""
+    return float("inf") if days_str == ALL_TIME_PERIOD else int(days_str.split()[0])
+
+class ChartPeriodAggregator:
+    """
+    Builds the top-N lists, date ranges and overview stats for several nested
+    chart periods from a single pass over grouped play rows.
+
+    Each row is tagged with the index of the shortest period it falls into;
+    every longer period includes it as well.
+    """
+    def __init__(self, period_names, min_songs_for_album):
+        self.period_names = list(period_names)
+        self.min_songs_for_album = min_songs_for_album
+        self.buckets = [self._empty_bucket() for _ in self.period_names]
+
+    @staticmethod
+    def _empty_bucket():
+        return {"songs": {}, "artists": {}, "album_titles": {}, "channels": {},
+                "days": set(), "first_ts": None, "last_ts": None}
+
+    def add_row(self, bucket_index, day, artist, title, album, media_channel, plays, first_ts, last_ts):
+        """Adds a group of raw plays, which counts towards every chart category."""
+        self.add_song_row(bucket_index, day, artist, title, album, plays, first_ts, last_ts)
+        self.add_artist_row(bucket_index, artist, plays)
+        self.add_channel_row(bucket_index, media_channel, plays)
+
+    def add_song_row(self, bucket_index, day, artist, title, album, plays, first_ts=None, last_ts=None):
+        """Adds song-level plays, which also feed the album chart and the overview stats."""
+        bucket = self.buckets[bucket_index]
+        song_key = (title, artist, album)
+        bucket["songs"][song_key] = bucket["songs"].get(song_key, 0) + plays
+        if artist and album and title is not None:
+            bucket["album_titles"].setdefault((artist, album), set()).add(title)
+        if day is not None:
+            bucket["days"].add(day)
+        first_ts, last_ts = first_ts or day, last_ts or day
+        if first_ts and (bucket["first_ts"] is None or first_ts < bucket["first_ts"]):
+            bucket["first_ts"] = first_ts
+        if last_ts and (bucket["last_ts"] is None or last_ts > bucket["last_ts"]):
+            bucket["last_ts"] = last_ts
+
+    def add_day(self, bucket_index, day):
+        """Adds a day with plays whose rows were added without one (archived months)."""
+        bucket = self.buckets[bucket_index]
+        bucket["days"].add(day)
+        if bucket["first_ts"] is None or day < bucket["first_ts"]:
+            bucket["first_ts"] = day
+        if bucket["last_ts"] is None or day > bucket["last_ts"]:
+            bucket["last_ts"] = day
+
+    def add_artist_row(self, bucket_index, artist, plays):
+        if artist:
+            artists = self.buckets[bucket_index]["artists"]
+            artists[artist] = artists.get(artist, 0) + plays
+
+    def add_channel_row(self, bucket_index, media_channel, plays):
+        if media_channel:
+            channels = self.buckets[bucket_index]["channels"]
+            channels[media_channel] = channels.get(media_channel, 0) + plays
+
+    def period_totals(self):
+        """Returns {period_name: cumulative_totals}, each period including all shorter ones."""
+        totals, previous = {}, self._empty_bucket()
+        for name, bucket in zip(self.period_names, self.buckets):
+            total = {
+                "songs": dict(previous["songs"]), "artists": dict(previous["artists"]), "channels": dict(previous["channels"]),
+                "album_titles": {key: set(titles) for key, titles in previous["album_titles"].items()},
+                "days": previous["days"] | bucket["days"],
+                "first_ts": min(filter(None, (previous["first_ts"], bucket["first_ts"])), default=None),
+                "last_ts": max(filter(None, (previous["last_ts"], bucket["last_ts"])), default=None),
+            }
+            for counter in ("songs", "artists", "channels"):
+                merged = total[counter]
+                for key, plays in bucket[counter].items():
+                    merged[key] = merged.get(key, 0) + plays
+            for key, titles in bucket["album_titles"].items():
+                total["album_titles"].setdefault(key, set()).update(titles)
+            totals[name] = previous = total
+        return totals
+
+    def top_songs(self, total, limit):
+        rows = heapq.nsmallest(limit, total["songs"].items(),
+                               key=lambda kv: (-kv[1], _sql_sort_key(kv[0][1]), _sql_sort_key(kv[0][0])))
+        return [{"title": title, "artist": artist, "album": album, "plays": plays} for (title, artist, album), plays in rows]
+
+    def top_artists(self, total, limit):
+        rows = heapq.nsmallest(limit, total["artists"].items(), key=lambda kv: (-kv[1], kv[0]))
+        return [{"artist": artist, "plays": plays} for artist, plays in rows]
+
+    def top_albums(self, total, limit):
+        counts = ((key, len(titles)) for key, titles in total["album_titles"].items() if len(titles) >= self.min_songs_for_album)
+        rows = heapq.nsmallest(limit, counts, key=lambda kv: (-kv[1], kv[0][1], kv[0][0]))
+        return [{"artist": artist, "album": album, "tracks": tracks} for (artist, album), tracks in rows]
+
+    def top_media_channels(self, total, limit):
+        rows = heapq.nsmallest(limit, total["channels"].items(), key=lambda kv: (-kv[1], kv[0]))
+        return [{"channel": channel, "plays": plays} for channel, plays in rows]
+
+    def overview_stats(self, total):
+        unique_songs, unique_albums, unique_artists = set(), set(), set()
+        for (title, artist, album) in total["songs"]:
+            if artist is None: continue
+            unique_artists.add(artist)
+            if title is not None: unique_songs.add(f"{artist}|{title}")
+            if album is not None: unique_albums.add(f"{artist}|{album}")
+        return {
+            "days": len(total["days"]),
+            "unique_songs": len(unique_songs),
+            "total_plays": sum(total["songs"].values()),
+            "unique_albums": len(unique_albums),
+            "unique_artists": len(unique_artists),
+        }
+
+
+class TitleNormalizer:
+    """
+    Strips version markers such as "(Remastered)" or "- Live" from track and
+    album titles. The pattern is compiled once from `keywords` and results are
+    memoized in an LRU cache of `cache_size` titles.
+    """
+    def __init__(self, keywords=None, cache_size=4096):
+        self.keywords = tuple(keywords or DEFAULT_TITLE_CLEANUP_KEYWORDS)
+        self.pattern = (r'\s*[\(\[\-](?:[^\(\)\[\]\-]*\b(?:' + '|'.join(re.escape(k) + r'\.?' for k in self.keywords)
+                        + r')\b[^\(\)\[\]\-]*?)[\)\]\-]?\s*')
+        self._regex = re.compile(self.pattern, re.IGNORECASE)
+        self.normalize = functools.lru_cache(maxsize=cache_size)(self._normalize)
+
+    def _normalize(self, text):
+        if not isinstance(text, str): return ""
+        cleaned = self._regex.sub('', text).strip()
+        return cleaned if cleaned else text
+
+class StageMetrics:
+    """
+    Thread-safe timings and counters of the engine's and the app's hot paths.
+    Names are "group:name" (e.g. "charts:query_tracks"); each group is
+    published as one sensor, with its "total" stage as the sensor state.
+    """
+    def __init__(self, clock=time.perf_counter):
+        self._clock = clock
+        self._stages = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        """Records one run of `stage` that took `seconds`."""
+        with self._lock:
+            stats = self._stages.get(stage)
+            if stats is None:
+                stats = self._stages[stage] = {"count": 0, "sum": 0.0, "last": 0.0, "max": 0.0}
+            stats["count"] += 1
+            stats["sum"] += seconds
+            stats["last"] = seconds
+            stats["max"] = max(stats["max"], seconds)
+
+    def increment(self, counter, amount=1):
+        with self._lock:
+            self._counters[counter] = self._counters.get(counter, 0) + amount
+
+    @contextlib.contextmanager
+    def timed(self, stage):
+        """Times the body of the `with` block as one run of `stage`, also when it raises."""
+        started = self._clock()
+        try:
+            yield
+        finally:
+            self.observe(stage, self._clock() - started)
+
+    def snapshot(self):
+        """Returns {group: {attribute: value}} with <name>_count/_last_ms/_avg_ms/_max_ms per stage and one value per counter."""
+        groups = {}
+        with self._lock:
+            for stage, stats in self._stages.items():
+                group, _, name = stage.partition(":")
+                attributes = groups.setdefault(group, {})
+                attributes[f"{name}_count"] = stats["count"]
+                attributes[f"{name}_last_ms"] = round(stats["last"] * 1000, 2)
+                attributes[f"{name}_avg_ms"] = round(stats["sum"] * 1000 / stats["count"], 2)
+                attributes[f"{name}_max_ms"] = round(stats["max"] * 1000, 2)
+            for counter, value in self._counters.items():
+                group, _, name = counter.partition(":")
+                groups.setdefault(group, {})[name] = value
+        return groups
+
+    def prometheus_text(self, prefix="music_tracker"):
+        """Renders every stage as a summary (plus last/max gauges) and every counter, in the Prometheus text format."""
+        with self._lock:
+            stages = sorted((stage.partition(":"), dict(stats)) for stage, stats in self._stages.items())
+            counters = sorted((counter.partition(":"), value) for counter, value in self._counters.items())
+        lines = [f"# HELP {prefix}_stage_seconds Time spent in an instrumented stage.", f"# TYPE {prefix}_stage_seconds summary"]
+        for (group, _, name), stats in stages:
+            labels = f'{{group="{group}",stage="{name}"}}'
+            lines.append(f"{prefix}_stage_seconds_count{labels} {stats['count']}")
+            lines.append(f"{prefix}_stage_seconds_sum{labels} {stats['sum']:.6f}")
+        for gauge, help_text in (("last", "Duration of the latest run"), ("max", "Longest run")):
+            lines += [f"# HELP {prefix}_stage_{gauge}_seconds {help_text} of an instrumented stage.",
+                      f"# TYPE {prefix}_stage_{gauge}_seconds gauge"]
+            lines += [f'{prefix}_stage_{gauge}_seconds{{group="{group}",stage="{name}"}} {stats[gauge]:.6f}'
+                      for (group, _, name), stats in stages]
+        lines += [f"# HELP {prefix}_events_total Occurrences of a counted event.", f"# TYPE {prefix}_events_total counter"]
+        lines += [f'{prefix}_events_total{{group="{group}",event="{name}"}} {value}' for (group, _, name), value in counters]
+        return "\n".join(lines) + "\n"
+
+class MusicChartEngine:
+    """
+    Database, chart and rendering logic of the Music Tracker, independent of
+    AppDaemon. `log` takes (message, level=...) like Hass.log.
+    """
+    def __init__(self, db_path, html_output_path=None, min_songs_for_album=3, webhook=False, log=None,
+                 migration_batch_size=5000, cleanup_threshold_seconds=60, cleanup_prune_enabled=True,
+                 cleanup_prune_keep_days=62, cleanup_execute_mode=True, cleanup_vacuum_on_complete=True,
+                 data_output_path=None, gzip_data=True, cleanup_vacuum_max_pages=10000, cleanup_vacuum_time_budget=10.0,
+                 title_cleanup_keywords=None, slow_query_ms=1000, cleanup_vacuum_convert=False):
+        self.db_path = db_path
+        self.html_output_path = html_output_path
+        self.data_output_path = data_output_path or (os.path.splitext(html_output_path)[0] + ".json" if html_output_path else None)
+        self.gzip_data = gzip_data
+        self.min_songs_for_album_chart = min_songs_for_album
+        self.webhook = webhook
+        self._log = log
+        self.migration_batch_size = migration_batch_size
+        self.cleanup_threshold_seconds = cleanup_threshold_seconds
+        self.cleanup_prune_enabled = cleanup_prune_enabled
+        self.cleanup_prune_keep_days = cleanup_prune_keep_days
+        self.cleanup_execute_mode = cleanup_execute_mode
+        self.cleanup_vacuum_on_complete = cleanup_vacuum_on_complete
+        self.cleanup_vacuum_max_pages = cleanup_vacuum_max_pages
+        self.cleanup_vacuum_time_budget = cleanup_vacuum_time_budget
+        self.cleanup_vacuum_convert = cleanup_vacuum_convert
+        self.normalizer = TitleNormalizer(title_cleanup_keywords)
+        self.slow_query_ms = slow_query_ms
+        self.metrics = StageMetrics()
+        self.db = ConnectionManager(db_path)
+        self.legacy_migration_pending = False
+        self._render_lock = threading.Lock()
+        self._template = None
+        self._written_fingerprints = {}
+
+    def log(self, msg, level="INFO"):
+        if self._log:
+            self._log(msg, level=level)
+        else:
+            logging.getLogger("music_chart_engine").log(getattr(logging, level, logging.INFO), msg)
+
+    def close(self):
+        """Closes the database connections."""
+        self.db.close()
+
+    @contextlib.contextmanager
+    def _timed_query(self, stage, query, params=()):
+        """Times the body of the `with` block as `stage` and logs it as a slow query if it took slow_query_ms or longer."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self.metrics.observe(stage, elapsed)
+            if self.slow_query_ms and elapsed * 1000 >= self.slow_query_ms:
+                self.metrics.increment(f"{stage.partition(':')[0]}:slow_queries")
+                self.log(f"Slow query {stage} took {elapsed * 1000:.0f} ms: {' '.join(query.split())[:300]} params={str(list(params))[:200]}",
+                         level="WARNING")
+
+    def write_metrics(self, path):
+        """Writes the current metrics to `path` in the Prometheus text format (for node_exporter's textfile collector)."""
+        try:
+            self._write_atomic(path, [self.metrics.prometheus_text()])
+        except OSError as e:
+            self.log(f"Failed to write metrics to {path}: {e}", level="WARNING")
+
+    def create_db_tables(self):
+        """
+        Creates the necessary SQLite tables if they do not yet exist.
+
+        Plays are stored in a slim `plays` fact table that references interned
+        artists/albums/tracks/channels/players by integer id. A `music_history` view
+        keeps the old column layout for ad-hoc queries. A database still using
+        the old music_history table is switched over here and its rows are
+        moved in batches by _migrate_legacy_history_batch.
+        """
+        self.legacy_migration_pending = False
+        try:
+            with self.db.write() as conn:
+                cursor = conn.cursor()
+                cursor.execute("BEGIN IMMEDIATE")
+                cursor.execute("CREATE TABLE IF NOT EXISTS db_meta (key TEXT PRIMARY KEY, value TEXT)")
+                self._create_chart_snapshot_tables(cursor)
+
+                cursor.execute("SELECT type FROM sqlite_master WHERE name = 'music_history'")
+                res = cursor.fetchone()
+                if res and res[0] == "table":
+                    self.log("Switching music_history to the normalized schema. Existing plays will be migrated in the background.")
+                    for trigger in ("insert", "delete", "update"):
+                        cursor.execute(f"DROP TRIGGER IF EXISTS trg_music_history_rollup_{trigger}")
+                    for table in ("daily_song_plays", "daily_artist_plays", "daily_channel_plays"):
+                        cursor.execute(f"DROP TABLE IF EXISTS {table}")
+                    cursor.execute("DROP INDEX IF EXISTS idx_music_history_timestamp")
+                    cursor.execute("ALTER TABLE music_history RENAME TO music_history_legacy")
+
+                cursor.execute("CREATE TABLE IF NOT EXISTS artists (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)")
+                cursor.execute("CREATE TABLE IF NOT EXISTS albums (id INTEGER PRIMARY KEY, artist_id INTEGER REFERENCES artists (id), name TEXT NOT NULL)")
+                cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_albums_identity ON albums (artist_id, name)")
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS tracks (
+                        id INTEGER PRIMARY KEY, artist_id INTEGER REFERENCES artists (id),
+                        album_id INTEGER REFERENCES albums (id), title TEXT
+                    )
+                """)
+                cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_tracks_identity ON tracks (artist_id, title, album_id)")
+                cursor.execute("CREATE TABLE IF NOT EXISTS channels (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)")
+                cursor.execute("CREATE TABLE IF NOT EXISTS players (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)")
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS plays (
+                        id INTEGER PRIMARY KEY, ts TEXT NOT NULL,
+                        track_id INTEGER NOT NULL REFERENCES tracks (id), channel_id INTEGER REFERENCES channels (id),
+                        player_id INTEGER REFERENCES players (id)
+                    )
+                """)
+                cursor.execute("PRAGMA table_info(plays)")
+                if "player_id" not in {row[1] for row in cursor.fetchall()}:
+                    cursor.execute("ALTER TABLE plays ADD COLUMN player_id INTEGER REFERENCES players (id)")
+                cursor.execute("DROP INDEX IF EXISTS idx_plays_ts")
+                cursor.execute("CREATE INDEX IF NOT EXISTS idx_plays_ts_covering ON plays (ts, track_id, channel_id)")
+                cursor.execute("DROP VIEW IF EXISTS music_history")
+                cursor.execute("""
+                    CREATE VIEW music_history AS
+                    SELECT p.id AS id, a.name AS artist, t.title AS title, al.name AS album,
+                           c.name AS media_channel, p.ts AS timestamp, pl.name AS player
+                    FROM plays p JOIN tracks t ON t.id = p.track_id
+                    LEFT JOIN artists a ON a.id = t.artist_id LEFT JOIN albums al ON al.id = t.album_id
+                    LEFT JOIN channels c ON c.id = p.channel_id LEFT JOIN players pl ON pl.id = p.player_id
+                """)
+                self._create_daily_rollups(cursor)
+                self._create_monthly_archive(cursor)
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS title_aliases (
+                        kind TEXT NOT NULL, raw TEXT NOT NULL, canonical TEXT NOT NULL,
+                        PRIMARY KEY (kind, raw)
+                    ) WITHOUT ROWID
+                """)
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS ai_reports (
+                        fingerprint TEXT PRIMARY KEY, html TEXT NOT NULL, created_at TEXT NOT NULL
+                    ) WITHOUT ROWID
+                """)
+
+                cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'music_history_legacy'")
+                self.legacy_migration_pending = cursor.fetchone() is not None
+            self.log("DB tables checked/created.")
+        except sqlite3.Error as e:
+            self.log(f"DB error during table creation: {e}", level="ERROR")
+
+    def _create_chart_snapshot_tables(self, cursor):
+        """
+        Creates the chart snapshot tables: one snapshot per day/type/period and
+        one row per ranked entry. JSON snapshots in an old chart_history table
+        are converted once, keeping the latest snapshot of each day.
+        """
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS chart_snapshots (
+                id INTEGER PRIMARY KEY, type TEXT NOT NULL, period TEXT NOT NULL, day TEXT NOT NULL,
+                created_at TEXT NOT NULL, UNIQUE (type, period, day)
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS chart_snapshot_items (
+                snapshot_id INTEGER NOT NULL, rank INTEGER NOT NULL,
+                name TEXT, artist TEXT, value INTEGER,
+                PRIMARY KEY (snapshot_id, rank)
+            ) WITHOUT ROWID
+        """)
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'chart_history'")
+        if cursor.fetchone() is None: return
+        cursor.execute("""
+            SELECT type, period, day, data FROM (
+                SELECT type, period, date(timestamp) AS day, data,
+                       ROW_NUMBER() OVER (PARTITION BY type, period, date(timestamp) ORDER BY timestamp DESC, id DESC) AS rn
+                FROM chart_history
+            ) WHERE rn = 1 AND day IS NOT NULL
+        """)
+        converted = 0
+        for type_of_chart, period, day, data in cursor.fetchall():
+            try:
+                items = json.loads(data) if data else []
+            except ValueError:
+                continue
+            if type_of_chart in CHART_ITEM_KEYS and isinstance(items, list):
+                self._store_chart_snapshot(cursor, type_of_chart, period, items, day)
+                converted += 1
+        cursor.execute("DROP TABLE chart_history")
+        self.log(f"Converted {converted} chart_history snapshots to the row-based snapshot tables.")
+
+    def _create_daily_rollups(self, cursor):
+        """
+        Creates the per-day play count tables and the triggers that keep them in
+        sync with `plays`. Album charts count distinct titles, so they are served
+        from daily_track_plays.
+        """
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS daily_track_plays (
+                day TEXT NOT NULL, track_id INTEGER NOT NULL, plays INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (day, track_id)
+            ) WITHOUT ROWID
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS daily_artist_plays (
+                day TEXT NOT NULL, artist_id INTEGER NOT NULL, plays INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (day, artist_id)
+            ) WITHOUT ROWID
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS daily_channel_plays (
+                day TEXT NOT NULL, channel_id INTEGER NOT NULL, plays INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (day, channel_id)
+            ) WITHOUT ROWID
+        """)
+        add_new, remove_old = self._rollup_trigger_statements("NEW", 1), self._rollup_trigger_statements("OLD", -1)
+        cursor.execute(f"CREATE TRIGGER IF NOT EXISTS trg_plays_rollup_insert AFTER INSERT ON plays BEGIN {add_new} END;")
+        cursor.execute(f"CREATE TRIGGER IF NOT EXISTS trg_plays_rollup_delete AFTER DELETE ON plays BEGIN {remove_old} END;")
+        cursor.execute(f"CREATE TRIGGER IF NOT EXISTS trg_plays_rollup_update AFTER UPDATE OF ts, track_id, channel_id ON plays BEGIN {remove_old} {add_new} END;")
+
+    @staticmethod
+    def _create_monthly_archive(cursor):
+        """
+        Creates the monthly play count tables that keep plays older than the
+        raw retention window, plus the list of archived days for the day count.
+        Album charts count distinct titles, so they are served from
+        monthly_track_plays.
+        """
+        for table, (columns, _) in MONTHLY_ARCHIVE_SOURCES.items():
+            month, key, plays = columns.split(", ")
+            cursor.execute(f"""
+                CREATE TABLE IF NOT EXISTS {table} (
+                    {month} TEXT NOT NULL, {key} INTEGER NOT NULL, {plays} INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY ({month}, {key})
+                ) WITHOUT ROWID
+            """)
+        cursor.execute("CREATE TABLE IF NOT EXISTS archived_days (day TEXT PRIMARY KEY) WITHOUT ROWID")
+
+    @staticmethod
+    def _rollup_trigger_statements(row, delta):
+        """Returns the trigger body that adds (delta=1) or removes (delta=-1) one play of `row` from the daily rollups."""
+        day = f"date({row}.ts)"
+        artist_id = f"(SELECT artist_id FROM tracks WHERE id = {row}.track_id)"
+        if delta > 0:
+            return f"""
+                INSERT INTO daily_track_plays (day, track_id, plays) SELECT {day}, {row}.track_id, 1
+                    WHERE {day} IS NOT NULL
+                    ON CONFLICT (day, track_id) DO UPDATE SET plays = plays + 1;
+                INSERT INTO daily_artist_plays (day, artist_id, plays) SELECT {day}, {artist_id}, 1
+                    WHERE {day} IS NOT NULL AND {artist_id} IS NOT NULL
+                    ON CONFLICT (day, artist_id) DO UPDATE SET plays = plays + 1;
+                INSERT INTO daily_channel_plays (day, channel_id, plays) SELECT {day}, {row}.channel_id, 1
+                    WHERE {day} IS NOT NULL AND {row}.channel_id IS NOT NULL
+                    ON CONFLICT (day, channel_id) DO UPDATE SET plays = plays + 1;
+            """
+        return f"""
+            UPDATE daily_track_plays SET plays = plays - 1 WHERE day = {day} AND track_id = {row}.track_id;
+            DELETE FROM daily_track_plays WHERE day = {day} AND track_id = {row}.track_id AND plays <= 0;
+            UPDATE daily_artist_plays SET plays = plays - 1 WHERE day = {day} AND artist_id = {artist_id};
+            DELETE FROM daily_artist_plays WHERE day = {day} AND artist_id = {artist_id} AND plays <= 0;
+            UPDATE daily_channel_plays SET plays = plays - 1 WHERE day = {day} AND channel_id = {row}.channel_id;
+            DELETE FROM daily_channel_plays WHERE day = {day} AND channel_id = {row}.channel_id AND plays <= 0;
+        """
+
+    def _rebuild_daily_rollups(self, cursor):
+        """Recomputes all daily rollup tables from `plays`."""
+        for table, (columns, source) in DAILY_ROLLUP_SOURCES.items():
+            cursor.execute(f"DELETE FROM {table}")
+            cursor.execute(f"INSERT INTO {table} ({columns}) {source}")
+
+    def check_daily_rollups(self, cursor):
+        """
+        Compares the daily rollup tables against `plays`.
+        Returns the number of mismatching rollup rows.
+        """
+        mismatches = 0
+        for table, (columns, expected) in DAILY_ROLLUP_SOURCES.items():
+            actual = f"SELECT {columns} FROM {table}"
+            cursor.execute(f"SELECT (SELECT COUNT(*) FROM ({expected} EXCEPT {actual})) + (SELECT COUNT(*) FROM ({actual} EXCEPT {expected}))")
+            table_mismatches = cursor.fetchone()[0]
+            if table_mismatches:
+                self.log(f"{table} has {table_mismatches} rows out of sync with plays.", level="WARNING")
+            mismatches += table_mismatches
+        return mismatches
+
+    def _insert_staged_plays(self, cursor):
+        """
+        Interns the artists/albums/tracks/channels/players of the rows in temp.play_staging,
+        inserts them into `plays` and empties the staging table.
+        """
+        cursor.execute("""
+            INSERT INTO artists (name) SELECT DISTINCT s.artist FROM play_staging s
+            WHERE s.artist IS NOT NULL AND NOT EXISTS (SELECT 1 FROM artists a WHERE a.name = s.artist)
+        """)
+        cursor.execute("""
+            INSERT INTO channels (name) SELECT DISTINCT s.media_channel FROM play_staging s
+            WHERE s.media_channel IS NOT NULL AND NOT EXISTS (SELECT 1 FROM channels c WHERE c.name = s.media_channel)
+        """)
+        cursor.execute("""
+            INSERT INTO players (name) SELECT DISTINCT s.player FROM play_staging s
+            WHERE s.player IS NOT NULL AND NOT EXISTS (SELECT 1 FROM players p WHERE p.name = s.player)
+        """)
+        cursor.execute("""
+            INSERT INTO albums (artist_id, name)
+            SELECT DISTINCT a.id, s.album FROM play_staging s LEFT JOIN artists a ON a.name = s.artist
+            WHERE s.album IS NOT NULL AND NOT EXISTS (SELECT 1 FROM albums al WHERE al.artist_id IS a.id AND al.name = s.album)
+        """)
+        cursor.execute("""
+            INSERT INTO tracks (artist_id, album_id, title)
+            SELECT DISTINCT a.id, al.id, s.title FROM play_staging s
+            LEFT JOIN artists a ON a.name = s.artist
+            LEFT JOIN albums al ON al.artist_id IS a.id AND al.name = s.album
+            WHERE NOT EXISTS (SELECT 1 FROM tracks t WHERE t.artist_id IS a.id AND t.title IS s.title AND t.album_id IS al.id)
+        """)
+        cursor.execute("""
+            INSERT INTO plays (ts, track_id, channel_id, player_id)
+            SELECT s.ts, t.id, c.id, pl.id FROM play_staging s
+            LEFT JOIN artists a ON a.name = s.artist
+            LEFT JOIN albums al ON al.artist_id IS a.id AND al.name = s.album
+            JOIN tracks t ON t.artist_id IS a.id AND t.title IS s.title AND t.album_id IS al.id
+            LEFT JOIN channels c ON c.name = s.media_channel
+            LEFT JOIN players pl ON pl.name = s.player
+            WHERE s.ts IS NOT NULL ORDER BY s.rowid
+        """)
+        cursor.execute("DELETE FROM play_staging")
+
+    @staticmethod
+    def _ensure_play_staging(cursor):
+        cursor.execute("CREATE TEMP TABLE IF NOT EXISTS play_staging (artist TEXT, title TEXT, album TEXT, media_channel TEXT, ts TEXT, player TEXT)")
+
+    def migrate_legacy_history_batch(self):
+        """
+        Moves one batch of rows from music_history_legacy into the normalized
+        tables and drops the legacy table once it is empty. Returns the number
+        of rows moved; 0 means the migration is complete.
+        """
+        with self.db.write() as conn:
+            cursor = conn.cursor()
+            self._ensure_play_staging(cursor)
+            cursor.execute("""
+                INSERT INTO play_staging (artist, title, album, media_channel, ts)
+                SELECT artist, title, album, media_channel, timestamp FROM music_history_legacy ORDER BY id LIMIT ?
+            """, (self.migration_batch_size,))
+            moved = cursor.rowcount
+            self._insert_staged_plays(cursor)
+            cursor.execute("DELETE FROM music_history_legacy WHERE id IN (SELECT id FROM music_history_legacy ORDER BY id LIMIT ?)", (self.migration_batch_size,))
+            if moved == 0:
+                cursor.execute("DROP TABLE music_history_legacy")
+
+        if moved:
+            self.log(f"Migrated {moved} plays to the normalized schema.")
+        else:
+            self.legacy_migration_pending = False
+            self.log("Legacy music_history migration complete.")
+        return moved
+
+    def cleanup_old_db_tracks(self):
+        """
+        Moves plays from before the last 366 whole days into the monthly archive
+        tables and deletes them, keeping the plays table lean while all-time
+        charts still count them.
+        """
+        cutoff_day = (datetime.datetime.now(datetime.timezone.utc).date() - datetime.timedelta(days=366)).isoformat()
+        try:
+            with self.db.write() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT 1 FROM plays WHERE ts < ? LIMIT 1", (cutoff_day,))
+                if cursor.fetchone() is None: return
+                for table, (columns, source) in MONTHLY_ARCHIVE_SOURCES.items():
+                    cursor.execute(f"""
+                        INSERT INTO {table} ({columns}) {source}
+                        ON CONFLICT ({columns.rsplit(", ", 1)[0]}) DO UPDATE SET plays = plays + excluded.plays
+                    """, (cutoff_day,))
+                cursor.execute("INSERT OR IGNORE INTO archived_days (day) SELECT DISTINCT date(ts) FROM plays WHERE ts < ? AND date(ts) IS NOT NULL", (cutoff_day,))
+                cursor.execute("DELETE FROM plays WHERE ts < ?", (cutoff_day,))
+                if cursor.rowcount > 0:
+                    self.log(f"Archived {cursor.rowcount} old tracks (>1yr) into the monthly archive.")
+        except sqlite3.Error as e:
+            self.log(f"DB error during old track cleanup: {e}", level="ERROR")
+
+    def store_tracks_in_db(self, rows):
+        """
+        Inserts a batch of (artist, title, album, media_channel, timestamp, player) rows
+        in one transaction. `player` is the media player entity and may be None.
+        Titles and albums are stored in their canonical form (see title_aliases).
+        Errors are raised so the ingest queue can retry the batch.
+        """
+        with self.db.write() as conn:
+            cursor = conn.cursor()
+            self._ensure_play_staging(cursor)
+            cursor.executemany("INSERT INTO play_staging (artist, title, album, media_channel, ts, player) VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self._canonicalize_staged_titles(cursor)
+            self._insert_staged_plays(cursor)
+
+    def _canonicalize_staged_titles(self, cursor):
+        """
+        Replaces the raw titles and albums in temp.play_staging by their canonical
+        form from title_aliases, adding the normalizer's result for raw forms
+        seen for the first time.
+        """
+        for kind in ("title", "album"):
+            cursor.execute(f"""
+                SELECT DISTINCT s.{kind} FROM play_staging s
+                WHERE s.{kind} IS NOT NULL AND NOT EXISTS (SELECT 1 FROM title_aliases x WHERE x.kind = ? AND x.raw = s.{kind})
+            """, (kind,))
+            new_aliases = [(kind, raw, self.normalizer.normalize(raw)) for (raw,) in cursor.fetchall()]
+            cursor.executemany("INSERT INTO title_aliases (kind, raw, canonical) VALUES (?, ?, ?)", new_aliases)
+            cursor.execute(f"""
+                UPDATE play_staging SET {kind} = (SELECT canonical FROM title_aliases x WHERE x.kind = ? AND x.raw = play_staging.{kind})
+                WHERE {kind} IS NOT NULL
+            """, (kind,))
+
+    def title_renormalization_pending(self):
+        """True if the normalizer rules differ from the ones the stored titles were normalized with."""
+        with self.db.read() as conn:
+            row = conn.execute("SELECT value FROM db_meta WHERE key = ?", (TITLE_NORMALIZER_PATTERN_KEY,)).fetchone()
+        return not row or row[0] != self.normalizer.pattern
+
+    def renormalize_titles(self):
+        """Runs renormalize_titles_batch until every stored name follows the rules. Returns the number of renamed names."""
+        renamed = 0
+        while True:
+            batch = self.renormalize_titles_batch()
+            if not batch: return renamed
+            renamed += batch
+
+    def renormalize_titles_batch(self, batch_size=RENORMALIZE_BATCH_NAMES):
+        """
+        Re-applies the normalizer to every raw title and album in title_aliases
+        and renames up to `batch_size` canonical names, in one transaction.
+        Tracks and albums whose canonical name changes are renamed, or merged
+        into the ones that already use the new name. Names stored before
+        aliases were recorded (the canonical form of no alias) are added as
+        their own raw form first. A
+        canonical name whose raw forms would now split up is kept, since its
+        plays cannot be told apart. A rename onto a name that is itself still
+        to be renamed waits for that one, so chains end up as in a single pass.
+        Once nothing is left to rename the rules are recorded in db_meta.
+        Returns the number of renamed names; 0 means the titles are up to date.
+        """
+        with self.db.write() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                INSERT OR IGNORE INTO title_aliases (kind, raw, canonical) SELECT DISTINCT 'title', title, title FROM tracks
+                WHERE title IS NOT NULL AND title NOT IN (SELECT canonical FROM title_aliases WHERE kind = 'title')
+            """)
+            cursor.execute("""
+                INSERT OR IGNORE INTO title_aliases (kind, raw, canonical) SELECT DISTINCT 'album', name, name FROM albums
+                WHERE name NOT IN (SELECT canonical FROM title_aliases WHERE kind = 'album')
+            """)
+            renamed, kept = 0, {}
+            for kind in ("title", "album"):
+                groups = {}
+                for raw, canonical in cursor.execute("SELECT raw, canonical FROM title_aliases WHERE kind = ?", (kind,)).fetchall():
+                    groups.setdefault(canonical, set()).add(self.normalizer.normalize(raw))
+                renames = {old: min(new) for old, new in groups.items() if len(new) == 1 and old not in new}
+                kept[kind] = sum(1 for new in groups.values() if len(new) > 1)
+                ready = sorted((old, new) for old, new in renames.items() if new not in renames) or sorted(renames.items())
+                ready = ready[:batch_size - renamed]
+                cursor.execute(f"CREATE TEMP TABLE IF NOT EXISTS {kind}_renames (old TEXT PRIMARY KEY, new TEXT NOT NULL)")
+                cursor.execute(f"DELETE FROM {kind}_renames")
+                cursor.executemany(f"INSERT INTO {kind}_renames (old, new) VALUES (?, ?)", ready)
+                cursor.execute(f"""
+                    UPDATE title_aliases SET canonical = (SELECT new FROM {kind}_renames WHERE old = title_aliases.canonical)
+                    WHERE kind = ? AND canonical IN (SELECT old FROM {kind}_renames)
+                """, (kind,))
+                renamed += len(ready)
+            if renamed:
+                merged = self._apply_title_renames(cursor)
+            else:
+                cursor.execute("""
+                    INSERT INTO db_meta (key, value) VALUES (?, ?)
+                    ON CONFLICT (key) DO UPDATE SET value = excluded.value
+                """, (TITLE_NORMALIZER_PATTERN_KEY, self.normalizer.pattern))
+
+        if renamed:
+            self.log(f"Re-normalized titles: {renamed} names changed, {merged} tracks merged.")
+            return renamed
+        for kind, count in kept.items():
+            if count:
+                self.log(f"Kept {count} {kind}s whose variants would now normalize to different names.", level="WARNING")
+        self.log("Stored titles and albums follow the current title cleanup rules.")
+        return 0
+
+    @staticmethod
+    def _apply_title_renames(cursor):
+        """
+        Moves tracks and albums to the names in temp.title_renames/album_renames.
+        Every group of tracks (and albums) that ends up with the same identity
+        is merged into an existing holder of that identity, or else into its
+        lowest id, which is renamed. Plays, and through their triggers the
+        daily rollups, and the monthly archive follow the merged tracks.
+        Returns the number of merged tracks.
+        """
+        cursor.execute("DROP TABLE IF EXISTS temp.album_map")
+        cursor.execute("""
+            CREATE TEMP TABLE album_map AS
+            SELECT al.id AS src_id, al.artist_id AS artist_id, r.new AS name, al.id AS dst_id
+            FROM albums al JOIN album_renames r ON r.old = al.name
+        """)
+        cursor.execute("CREATE INDEX temp.idx_album_map_identity ON album_map (artist_id, name)")
+        cursor.execute("""
+            UPDATE album_map SET dst_id = COALESCE(
+                (SELECT x.id FROM albums x WHERE x.artist_id IS album_map.artist_id AND x.name = album_map.name
+                 AND x.id NOT IN (SELECT src_id FROM album_map)),
+                (SELECT MIN(m.src_id) FROM album_map m WHERE m.artist_id IS album_map.artist_id AND m.name = album_map.name))
+        """)
+        cursor.execute("DROP TABLE IF EXISTS temp.track_map")
+        cursor.execute("""
+            CREATE TEMP TABLE track_map AS
+            SELECT t.id AS src_id, t.artist_id AS artist_id, COALESCE(am.dst_id, t.album_id) AS album_id,
+                   COALESCE(tr.new, t.title) AS title, t.id AS dst_id
+            FROM tracks t LEFT JOIN album_map am ON am.src_id = t.album_id LEFT JOIN title_renames tr ON tr.old = t.title
+            WHERE am.src_id IS NOT NULL OR tr.old IS NOT NULL
+        """)
+        cursor.execute("CREATE INDEX temp.idx_track_map_identity ON track_map (artist_id, title, album_id)")
+        cursor.execute("""
+            UPDATE track_map SET dst_id = COALESCE(
+                (SELECT x.id FROM tracks x WHERE x.artist_id IS track_map.artist_id AND x.title IS track_map.title
+                 AND x.album_id IS track_map.album_id AND x.id NOT IN (SELECT src_id FROM track_map)),
+                (SELECT MIN(m.src_id) FROM track_map m WHERE m.artist_id IS track_map.artist_id AND m.title IS track_map.title
+                 AND m.album_id IS track_map.album_id))
+        """)
+        merged_tracks = "SELECT src_id FROM track_map WHERE dst_id != src_id"
+        cursor.execute(f"UPDATE plays SET track_id = (SELECT dst_id FROM track_map WHERE src_id = plays.track_id) WHERE track_id IN ({merged_tracks})")
+        cursor.execute("""
+            INSERT INTO monthly_track_plays (month, track_id, plays)
+            SELECT m.month, tm.dst_id, m.plays FROM monthly_track_plays m JOIN track_map tm ON tm.src_id = m.track_id
+            WHERE tm.dst_id != tm.src_id
+            ON CONFLICT (month, track_id) DO UPDATE SET plays = plays + excluded.plays
+        """)
+        cursor.execute(f"DELETE FROM monthly_track_plays WHERE track_id IN ({merged_tracks})")
+        cursor.execute(f"DELETE FROM tracks WHERE id IN ({merged_tracks})")
+        merged = cursor.rowcount
+        cursor.execute("""
+            UPDATE tracks SET album_id = (SELECT album_id FROM track_map WHERE src_id = tracks.id),
+                              title = (SELECT title FROM track_map WHERE src_id = tracks.id)
+            WHERE id IN (SELECT src_id FROM track_map WHERE dst_id = src_id)
+        """)
+        cursor.execute("DELETE FROM albums WHERE id IN (SELECT src_id FROM album_map WHERE dst_id != src_id)")
+        cursor.execute("""
+            UPDATE albums SET name = (SELECT name FROM album_map WHERE src_id = albums.id)
+            WHERE id IN (SELECT src_id FROM album_map WHERE dst_id = src_id)
+        """)
+        return merged
+
+    def get_chart_dates_for_period(self, days_str):
+        """Returns a date range string for the plays in the given period."""
+        try:
+            _, totals = self._collect_period_totals({"period": days_str})
+            return self._format_chart_dates(totals["period"]["first_ts"], totals["period"]["last_ts"])
+        except Exception as e:
+            self.log(f"Error getting chart dates for '{days_str}': {e}", level="WARNING")
+            return "Date Range Error"
+
+    def _format_chart_dates(self, first_ts, last_ts):
+        """Formats the first/last play day (or timestamp) of a period as a date range string."""
+        if not first_ts or not last_ts: return "Date Range N/A"
+        s_dt = datetime.date.fromisoformat(first_ts[:10])
+        e_dt = datetime.date.fromisoformat(last_ts[:10])
+        return s_dt.strftime('%d/%m/%Y') if s_dt == e_dt else f"{s_dt.strftime('%d/%m/%Y')} - {e_dt.strftime('%d/%m/%Y')}"
+
+    def _collect_period_totals(self, timeframes, as_of=None):
+        """
+        Aggregates plays for several nested periods ending at `as_of` (default:
+        now) in one pass.
+
+        Whole days inside a period are read from the daily rollup tables; only the
+        partial days at each period's start and end are read from raw `plays` rows.
+        An all-time period also reads the monthly archive, and same-month-last-year
+        periods are aggregated separately from the rollups and the archive.
+        Returns (aggregator, {period_name: cumulative_totals}).
+        """
+        ordered = sorted(((name, days_str) for name, days_str in timeframes.items() if days_str != YEAR_AGO_MONTH_PERIOD),
+                         key=lambda kv: _period_sort_key(kv[1]))
+        year_ago_names = [name for name, days_str in timeframes.items() if days_str == YEAR_AGO_MONTH_PERIOD]
+        aggregator = ChartPeriodAggregator([name for name, _ in ordered], self.min_songs_for_album_chart)
+        totals = {}
+        with self.db.read() as conn:
+            cursor = conn.cursor()
+            cutoffs, end = self._period_bounds(cursor, [days_str for _, days_str in ordered], as_of)
+            if ordered:
+                self._feed_aggregator(cursor, aggregator, self._period_queries(cutoffs, end))
+                totals.update(aggregator.period_totals())
+            if year_ago_names:
+                month_aggregator = ChartPeriodAggregator(["month"], self.min_songs_for_album_chart)
+                self._feed_aggregator(cursor, month_aggregator, self._year_ago_month_queries(end))
+                month_total = month_aggregator.period_totals()["month"]
+                totals.update((name, month_total) for name in year_ago_names)
+        return aggregator, totals
+
+    def _feed_aggregator(self, cursor, aggregator, queries):
+        """Runs (name, sql, params) queries, passing every row to the matching aggregator method; each is timed as charts:query_<name>."""
+        feeders = {"tracks": aggregator.add_song_row, "artists": aggregator.add_artist_row,
+                   "channels": aggregator.add_channel_row, "boundary_plays": aggregator.add_row,
+                   "archived_days": aggregator.add_day}
+        for name, query, params in queries:
+            feed = feeders[name]
+            with self._timed_query(f"charts:query_{name}", query, params):
+                for row in cursor.execute(query, params):
+                    feed(*row)
+
+    @staticmethod
+    def _period_bounds(cursor, days_strs, as_of=None):
+        """
+        Returns ([start of each period], end) for periods of `days_strs` ending at
+        `as_of` (default: now). ALL_TIME_PERIOD starts at EARLIEST_TS.
+        """
+        as_of = as_of or "now"
+        columns = "".join(", ?" if days_str == ALL_TIME_PERIOD else f", datetime(?, '-{days_str}')" for days_str in days_strs)
+        cursor.execute(f"SELECT datetime(?){columns}",
+                       [as_of] + [EARLIEST_TS if days_str == ALL_TIME_PERIOD else as_of for days_str in days_strs])
+        end, *cutoffs = cursor.fetchone()
+        if end is None: raise ValueError(f"Invalid as_of timestamp: {as_of!r}")
+        return cutoffs, end
+
+    def _period_queries(self, cutoffs, end):
+        """
+        Returns the (name, sql, params) queries that feed ChartPeriodAggregator for
+        nested periods starting at `cutoffs` (newest first) and ending at `end`.
+        """
+        cutoff_days = [cutoff[:10] for cutoff in cutoffs]
+        end_day = end[:10]
+        last = len(cutoffs) - 1
+
+        day_bucket = "CASE " + " ".join(f"WHEN d.day > ? THEN {idx}" for idx in range(last)) + f" ELSE {last} END" if last else "0"
+        boundary_days = sorted(set(cutoff_days) | {end_day})
+        day_filter = f"d.day > ? AND d.day < ? AND d.day NOT IN ({', '.join('?' * len(boundary_days))})"
+        day_params = cutoff_days[:last] + [cutoff_days[last], end_day] + boundary_days
+
+        ts_bucket = "CASE " + " ".join(f"WHEN p.ts >= ? THEN {idx}" for idx in range(last)) + f" ELSE {last} END" if last else "0"
+        ranges, range_params = [], []
+        for day in boundary_days:
+            start = cutoffs[last] if day == cutoff_days[last] else day
+            if day == end_day:
+                ranges.append("(p.ts >= ? AND p.ts <= ?)")
+                range_params += [start, end]
+            else:
+                ranges.append("(p.ts >= ? AND p.ts < ?)")
+                range_params += [start, (datetime.date.fromisoformat(day) + datetime.timedelta(days=1)).isoformat()]
+        boundary_rows = f"""
+            SELECT {ts_bucket} AS bucket, date(p.ts) AS day, a.name, t.title, al.name, c.name,
+                   COUNT(*), MIN(p.ts), MAX(p.ts)
+            FROM plays p JOIN tracks t ON t.id = p.track_id
+            LEFT JOIN artists a ON a.id = t.artist_id LEFT JOIN albums al ON al.id = t.album_id
+            LEFT JOIN channels c ON c.id = p.channel_id
+            WHERE {' OR '.join(ranges)}
+            GROUP BY bucket, day, p.track_id, p.channel_id
+        """
+        queries = self._daily_rollup_queries(day_bucket, day_filter, day_params)
+        queries.append(("boundary_plays", boundary_rows, cutoffs[:last] + range_params))
+        if cutoffs[last] == EARLIEST_TS:
+            queries += self._archive_queries(last, EARLIEST_TS[:7], end[:7])
+        return queries
+
+    def _year_ago_month_queries(self, end):
+        """Returns the queries that feed a single-period aggregator with the calendar month a year before `end`."""
+        end_date = datetime.date.fromisoformat(end[:10])
+        month = f"{end_date.year - 1:04d}-{end_date.month:02d}"
+        next_month = f"{end_date.year - 1 + end_date.month // 12:04d}-{end_date.month % 12 + 1:02d}"
+        queries = self._daily_rollup_queries("0", "d.day >= ? AND d.day < ?", [f"{month}-01", f"{next_month}-01"])
+        return queries + self._archive_queries(0, month, month)
+
+    @staticmethod
+    def _daily_rollup_queries(bucket, day_filter, params):
+        """Returns the tracks/artists/channels queries over the daily rollup tables for days matching `day_filter`."""
+        return [
+            ("tracks", f"""
+                SELECT {bucket}, d.day, a.name, t.title, al.name, d.plays FROM daily_track_plays d
+                JOIN tracks t ON t.id = d.track_id LEFT JOIN artists a ON a.id = t.artist_id LEFT JOIN albums al ON al.id = t.album_id
+                WHERE {day_filter}
+            """, params),
+            ("artists", f"SELECT {bucket}, a.name, d.plays FROM daily_artist_plays d JOIN artists a ON a.id = d.artist_id WHERE {day_filter}", params),
+            ("channels", f"SELECT {bucket}, c.name, d.plays FROM daily_channel_plays d JOIN channels c ON c.id = d.channel_id WHERE {day_filter}", params),
+        ]
+
+    @staticmethod
+    def _archive_queries(bucket, first_month, last_month):
+        """Returns the queries over the monthly archive for months `first_month` to `last_month` (YYYY-MM), into `bucket`."""
+        params = (first_month, last_month)
+        return [
+            ("tracks", f"""
+                SELECT {bucket}, NULL, a.name, t.title, al.name, m.plays FROM monthly_track_plays m
+                JOIN tracks t ON t.id = m.track_id LEFT JOIN artists a ON a.id = t.artist_id LEFT JOIN albums al ON al.id = t.album_id
+                WHERE m.month >= ? AND m.month <= ?
+            """, params),
+            ("artists", f"SELECT {bucket}, a.name, m.plays FROM monthly_artist_plays m JOIN artists a ON a.id = m.artist_id WHERE m.month >= ? AND m.month <= ?", params),
+            ("channels", f"SELECT {bucket}, c.name, m.plays FROM monthly_channel_plays m JOIN channels c ON c.id = m.channel_id WHERE m.month >= ? AND m.month <= ?", params),
+            ("archived_days", f"SELECT {bucket}, day FROM archived_days WHERE day >= ? AND day <= ?", (f"{first_month}-01", f"{last_month}-31")),
+        ]
+
+    def get_all_period_charts(self, timeframes, limit, as_of=None):
+        """
+        Builds charts, date ranges and overview stats for every period from one
+        pass over the daily rollups. Periods end at `as_of` (default: now).
+        Returns (charts, overview, all_ok).
+        """
+        with self.metrics.timed("charts:total"):
+            return self._get_all_period_charts(timeframes, limit, as_of)
+
+    def _get_all_period_charts(self, timeframes, limit, as_of):
+        charts, overview = {}, {}
+        try:
+            aggregator, totals = self._collect_period_totals(timeframes, as_of)
+            for period_name, days_str in timeframes.items():
+                self.log(f"Generating chart data for period: {period_name} ({days_str})")
+                total = totals[period_name]
+                charts[period_name] = {
+                    "songs": self._apply_chart_changes(aggregator.top_songs(total, limit), "songs", period_name, as_of),
+                    "artists": self._apply_chart_changes(aggregator.top_artists(total, limit), "artists", period_name, as_of),
+                    "albums": self._apply_chart_changes(aggregator.top_albums(total, limit), "albums", period_name, as_of),
+                    "media_channels": self._apply_chart_changes(aggregator.top_media_channels(total, limit), "media_channels", period_name, as_of),
+                    "dates": self._format_chart_dates(total["first_ts"], total["last_ts"])
+                }
+                overview[period_name] = aggregator.overview_stats(total)
+        except Exception as e:
+            self.log(f"Error generating chart data: {e}", level="ERROR")
+            empty_stats = {"days": 0, "unique_songs": 0, "total_plays": 0, "unique_albums": 0, "unique_artists": 0}
+            charts = {name: {"songs": [], "artists": [], "albums": [], "media_channels": [], "dates": "Error Generating Data"} for name in timeframes}
+            return charts, {name: dict(empty_stats) for name in timeframes}, False
+        return charts, overview, True
+
+    def _get_top_items(self, days_str, limit, period_name, category):
+        """Builds a single chart category for one period from the daily rollups."""
+        try:
+            aggregator, totals = self._collect_period_totals({period_name: days_str})
+        except sqlite3.Error as e:
+            self.log(f"DB error building {category}/{period_name} chart: {e}", level="ERROR")
+            return []
+        items = getattr(aggregator, f"top_{category}")(totals[period_name], limit)
+        return self._apply_chart_changes(items, category, period_name)
+
+    def get_top_songs(self, days_str, limit, period_name):
+        """Returns a list of dictionaries for the top songs."""
+        return self._get_top_items(days_str, limit, period_name, "songs")
+
+    def get_top_artists(self, days_str, limit, period_name):
+        """Returns a list of dictionaries for the top artists."""
+        return self._get_top_items(days_str, limit, period_name, "artists")
+
+    def get_top_albums(self, days_str, limit, period_name):
+        """Returns a list of dictionaries for the top albums."""
+        return self._get_top_items(days_str, limit, period_name, "albums")
+
+    def get_top_media_channels(self, days_str, limit, period_name):
+        """Returns a list of dictionaries for the top media channels."""
+        return self._get_top_items(days_str, limit, period_name, "media_channels")
+
+    def _apply_chart_changes(self, items, category, period, as_of=None):
+        """Annotates already-ranked chart items with their change against the previous chart."""
+        prev_ranks = self.build_rank_index(self.get_previous_chart_data(category, period, as_of), category)
+        for rank, item in enumerate(items, 1):
+            change_info = self.calculate_chart_change(prev_ranks, item, rank, category)
+            item.update(change=change_info['change_value'], new_entry=change_info['is_new_entry'])
+        return items
+
+    @staticmethod
+    def build_rank_index(previous_chart_list, category):
+        """Maps each item key of a previous chart to its (first) rank."""
+        key_fields = CHART_ITEM_KEYS.get(category)
+        if not key_fields: return {}
+        index = {}
+        for rank, prev_item in enumerate(previous_chart_list, 1):
+            index.setdefault(tuple(prev_item.get(field) for field in key_fields), rank)
+        return index
+
+    def calculate_chart_change(self, previous_ranks, current_item, current_rank, category):
+        """Computes rank change or marks as new entry, using a rank index from build_rank_index."""
+        key_fields = CHART_ITEM_KEYS.get(category, ())
+        previous_rank = previous_ranks.get(tuple(current_item.get(field) for field in key_fields)) if key_fields else None
+        if previous_rank is not None:
+            return {'change_value': previous_rank - current_rank, 'is_new_entry': False}
+        return {'change_value': 0, 'is_new_entry': True}
+
+    def store_chart_data_history(self, type_of_chart, period, data_list):
+        """Saves (or replaces) today's snapshot of one chart."""
+        if not data_list: return
+        try:
+            with self.db.write() as conn:
+                self._store_chart_snapshot(conn.cursor(), type_of_chart, period, data_list)
+        except Exception as e:
+            self.log(f"Error storing chart history for {type_of_chart}/{period}: {e}", level="WARNING")
+
+    def store_chart_snapshots(self, charts, day=None):
+        """Saves (or replaces) the snapshot of `day` (default: today) of every chart of every period in one transaction."""
+        try:
+            with self.metrics.timed("charts:store_snapshots"), self.db.write() as conn:
+                cursor = conn.cursor()
+                for period, period_data in charts.items():
+                    for type_of_chart in CHART_ITEM_KEYS:
+                        if period_data.get(type_of_chart):
+                            self._store_chart_snapshot(cursor, type_of_chart, period, period_data[type_of_chart], day)
+        except Exception as e:
+            self.log(f"Error storing chart history: {e}", level="WARNING")
+
+    def _store_chart_snapshot(self, cursor, type_of_chart, period, data_list, day=None):
+        """Upserts the snapshot row for (type, period, day) and replaces its ranked items."""
+        day = day or datetime.datetime.now(datetime.timezone.utc).date().isoformat()
+        cursor.execute("""
+            INSERT INTO chart_snapshots (type, period, day, created_at) VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT (type, period, day) DO UPDATE SET created_at = excluded.created_at
+        """, (type_of_chart, period, day))
+        cursor.execute("SELECT id FROM chart_snapshots WHERE type = ? AND period = ? AND day = ?", (type_of_chart, period, day))
+        snapshot_id = cursor.fetchone()[0]
+        cursor.execute("DELETE FROM chart_snapshot_items WHERE snapshot_id = ?", (snapshot_id,))
+        key_fields, value_field = CHART_ITEM_KEYS[type_of_chart], CHART_VALUE_FIELDS[type_of_chart]
+        cursor.executemany(
+            "INSERT INTO chart_snapshot_items (snapshot_id, rank, name, artist, value) VALUES (?, ?, ?, ?, ?)",
+            [(snapshot_id, rank, item.get(key_fields[0]), item.get(key_fields[1]) if len(key_fields) > 1 else None, item.get(value_field))
+             for rank, item in enumerate(data_list, 1)]
+        )
+
+    def get_previous_chart_data(self, type_of_chart, period, as_of=None):
+        """Retrieves the most recent snapshot inside the comparison window of a chart, relative to `as_of` (default: now)."""
+        window = PREVIOUS_CHART_WINDOWS.get(period)
+        if not window or type_of_chart not in CHART_ITEM_KEYS: return []
+        key_fields, value_field = CHART_ITEM_KEYS[type_of_chart], CHART_VALUE_FIELDS[type_of_chart]
+        try:
+            params = (type_of_chart, period, as_of or "now", window[0], as_of or "now", window[1])
+            with self.db.read() as conn, self._timed_query("charts:query_previous_chart", PREVIOUS_CHART_QUERY, params):
+                rows = conn.execute(PREVIOUS_CHART_QUERY, params).fetchall()
+            return [dict(zip(key_fields, (name, artist)), **{value_field: value}) for name, artist, value in rows]
+        except Exception as e:
+            self.log(f"Error fetching previous chart for {type_of_chart}/{period}: {e}", level="WARNING")
+        return []
+
+    def get_overview_stats_for_period(self, days_str):
+        """Computes overview statistics for a given period."""
+        try:
+            aggregator, totals = self._collect_period_totals({"period": days_str})
+        except sqlite3.Error as e:
+            self.log(f"DB error in get_overview_stats_for_period ({days_str}): {e}", level="ERROR")
+            return {"days": 0, "unique_songs": 0, "total_plays": 0, "unique_albums": 0, "unique_artists": 0}
+        return aggregator.overview_stats(totals["period"])
+
+    def get_recent_plays(self, seconds):
+        """Returns (player, artist, title, timestamp) of the plays recorded by a player in the last `seconds` seconds, oldest first."""
+        with self.db.read() as conn:
+            return conn.execute("""
+                SELECT pl.name, a.name, t.title, p.ts FROM plays p JOIN players pl ON pl.id = p.player_id
+                JOIN tracks t ON t.id = p.track_id LEFT JOIN artists a ON a.id = t.artist_id
+                WHERE p.ts >= datetime('now', ?) ORDER BY p.ts
+            """, (f"-{int(seconds)} seconds",)).fetchall()
+
+    def get_last_n_songs_with_timestamps(self, n=100):
+        """Retrieves the last N songs played from the database."""
+        if not self.db_path: return []
+        songs_list = []
+        try:
+            with self.db.read() as conn:
+                cursor = conn.cursor()
+                cursor.execute(RECENT_PLAYS_QUERY + " LIMIT ?", (n,))
+                for row in cursor.fetchall():
+                    songs_list.append({"artist": row[0], "title": row[1], "timestamp": row[2]})
+        except Exception as e:
+            self.log(f"Error retrieving last {n} songs: {e}", level="ERROR")
+        return songs_list
+
+    def get_last_n_unique_songs_with_timestamps(self, n=100):
+        """
+        Retrieves the last N unique songs played from the database. Walks plays
+        newest-first along the timestamp index and stops once N are found.
+        """
+        if not self.db_path: return []
+        songs_list, seen = [], set()
+        try:
+            with self.db.read() as conn:
+                cursor = conn.cursor()
+                try:
+                    for artist, title, ts, artist_id in cursor.execute(RECENT_PLAYS_QUERY):
+                        if (artist_id, title) in seen: continue
+                        seen.add((artist_id, title))
+                        songs_list.append({"artist": artist, "title": title, "timestamp": ts})
+                        if len(songs_list) >= n: break
+                finally:
+                    cursor.close()
+        except Exception as e:
+            self.log(f"DB error retrieving last {n} unique songs: {e}", level="ERROR")
+        return songs_list
+
+    def get_cached_ai_report(self, fingerprint, ttl_seconds):
+        """Returns the AI report stored for `fingerprint` less than `ttl_seconds` ago, or None."""
+        try:
+            with self.db.read() as conn:
+                row = conn.execute("SELECT html FROM ai_reports WHERE fingerprint = ? AND created_at > datetime('now', ?)",
+                                   (fingerprint, f"-{int(ttl_seconds)} seconds")).fetchone()
+        except sqlite3.Error as e:
+            self.log(f"DB error reading the AI report cache: {e}", level="WARNING")
+            return None
+        return row[0] if row else None
+
+    def store_ai_report(self, fingerprint, html, ttl_seconds, max_entries):
+        """Caches an AI report under `fingerprint`, dropping expired reports and all but the newest `max_entries`."""
+        try:
+            with self.db.write() as conn:
+                conn.execute("""
+                    INSERT INTO ai_reports (fingerprint, html, created_at) VALUES (?, ?, datetime('now'))
+                    ON CONFLICT (fingerprint) DO UPDATE SET html = excluded.html, created_at = excluded.created_at
+                """, (fingerprint, html))
+                conn.execute("DELETE FROM ai_reports WHERE created_at <= datetime('now', ?)", (f"-{int(ttl_seconds)} seconds",))
+                conn.execute("DELETE FROM ai_reports WHERE fingerprint NOT IN (SELECT fingerprint FROM ai_reports ORDER BY created_at DESC LIMIT ?)",
+                             (max(1, int(max_entries)),))
+        except sqlite3.Error as e:
+            self.log(f"DB error writing the AI report cache: {e}", level="WARNING")
+
+    def check_query_plans(self, timeframes=None):
+        """
+        Runs EXPLAIN QUERY PLAN for every chart query and returns a list of
+        problems: full table scans or sorts that should have been served by an index.
+        """
+        timeframes = timeframes or CHART_TIMEFRAMES
+        problems = []
+        try:
+            # Cached EXPLAIN statements are never re-prepared after a schema change,
+            # so plans come from a short-lived connection without a statement cache.
+            with contextlib.closing(sqlite3.connect(self.db_path, cached_statements=0)) as conn:
+                cursor = conn.cursor()
+                nested = sorted((d for d in timeframes.values() if d != YEAR_AGO_MONTH_PERIOD), key=_period_sort_key)
+                cutoffs, end = self._period_bounds(cursor, nested)
+                targets = [(f"period/{name}", query, params) for name, query, params in self._period_queries(cutoffs, end)] if nested else []
+                if YEAR_AGO_MONTH_PERIOD in timeframes.values():
+                    targets += [(f"year_ago_month/{name}", query, params) for name, query, params in self._year_ago_month_queries(end)]
+                targets += [
+                    ("recent_plays", RECENT_PLAYS_QUERY + " LIMIT ?", (100,)),
+                    ("previous_chart", PREVIOUS_CHART_QUERY, ("songs", "weekly", "now", PREVIOUS_CHART_WINDOWS["weekly"][0], "now", PREVIOUS_CHART_WINDOWS["weekly"][1])),
+                    ("old_plays_cleanup", "SELECT id FROM plays WHERE ts < ?", ("2000-01-01 00:00:00",)),
+                ]
+                for name, query, params in targets:
+                    for row in cursor.execute("EXPLAIN QUERY PLAN " + query, params).fetchall():
+                        detail = row[-1]
+                        if re.match(r"SCAN \S+$", detail) or "TEMP B-TREE FOR ORDER BY" in detail:
+                            problems.append(f"{name}: {detail}")
+        except sqlite3.Error as e:
+            problems.append(f"query plan check failed: {e}")
+        return problems
+
+    def log_query_plan_problems(self):
+        """Logs a warning for every chart query whose plan is not index-backed."""
+        problems = self.check_query_plans()
+        for problem in problems:
+            self.log(f"Query plan regression: {problem}", level="WARNING")
+        if not problems:
+            self.log("All chart queries are served by indexes.")
+
+    @property
+    def template(self):
+        """The chart page template, compiled on first use and reused afterwards."""
+        if self._template is None:
+            env = jinja2.Environment(loader=jinja2.BaseLoader(), autoescape=jinja2.select_autoescape(['html', 'xml']))
+            self._template = env.from_string(TEMPLATE)
+        return self._template
+
+    def build_chart_payload(self, charts_data, overview_stats_per_period, ai_text_content=None, generated_at=None):
+        """
+        Returns the page data: for each period its date range, overview stats and
+        charts, with every chart stored as one array per column, plus the
+        headings of periods listed in PERIOD_LABELS.
+        """
+        payload = {"generated_at": generated_at, "ai_analysis": ai_text_content or None, "periods": list(charts_data),
+                   "labels": {period: PERIOD_LABELS[period] for period in charts_data if period in PERIOD_LABELS}, "charts": {}}
+        for period, data in charts_data.items():
+            entry = {"dates": data.get("dates"), "overview": overview_stats_per_period.get(period, {})}
+            for category, fields in CHART_PAYLOAD_COLUMNS.items():
+                items = data.get(category) or []
+                columns = {field: [item.get(field) for item in items] for field in fields}
+                columns["change"] = [item.get("change", 0) for item in items]
+                columns["new_entry"] = [1 if item.get("new_entry") else 0 for item in items]
+                entry[category] = columns
+            payload["charts"][period] = entry
+        return payload
+
+    def render_and_write_html(self, charts_data_to_render, ai_text_content, overview_stats_per_period):
+        """
+        Writes the chart page as two files: the chart data as compact JSON (plus a
+        gzip sibling) and a static HTML shell that loads it. The shell only changes
+        with the configuration, so browsers can keep it cached.
+
+        Files are replaced atomically, and nothing is written if the charts, stats
+        and AI text are the same as last time. Returns True if the data was written.
+        """
+        with self.metrics.timed("render:total"):
+            return self._render_and_write_html(charts_data_to_render, ai_text_content, overview_stats_per_period)
+
+    def _render_and_write_html(self, charts_data_to_render, ai_text_content, overview_stats_per_period):
+        if ai_text_content:
+            ai_text_content = re.sub(r'^\s*```(?:html)?\s*|\s*```\s*$', '', ai_text_content)
+
+        with self.metrics.timed("render:payload"):
+            payload = self.build_chart_payload(charts_data_to_render, overview_stats_per_period, ai_text_content)
+            # The data also carries its generation time, so the written bytes always
+            # differ; the payload without it identifies the content instead.
+            fingerprint = hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+        with self._render_lock:
+            if self._unchanged(self.data_output_path, fingerprint):
+                self.log(f"Charts unchanged, keeping {self.data_output_path}.")
+                data_written = False
+            else:
+                with self.metrics.timed("render:write_data"):
+                    payload["generated_at"] = datetime.datetime.now().strftime("%d/%m/%Y %H:%M:%S")
+                    data = json.dumps(payload, ensure_ascii=False, separators=(",", ":"), default=str)
+                    try:
+                        if self.gzip_data:
+                            self._write_atomic(self.data_output_path + ".gz", [gzip.compress(data.encode("utf-8"), 6, mtime=0)])
+                        elif os.path.exists(self.data_output_path + ".gz"):
+                            os.remove(self.data_output_path + ".gz")
+                        size = self._write_atomic(self.data_output_path, [data])
+                        self._written_fingerprints[self.data_output_path] = fingerprint
+                        self.log(f"Successfully wrote {size} bytes to {self.data_output_path}")
+                        data_written = True
+                    except OSError as e:
+                        self.log(f"Failed to write chart data to {self.data_output_path}: {e}", level="ERROR")
+                        return False
+            with self.metrics.timed("render:html_shell"):
+                self._write_html_shell()
+        return data_written
+
+    def _write_html_shell(self):
+        """Writes the static HTML page that loads the chart data file, unless it is already up to date."""
+        data_url = os.path.relpath(self.data_output_path, os.path.dirname(os.path.abspath(self.html_output_path))).replace(os.sep, "/")
+        context = {"webhook": self.webhook, "data_url": data_url}
+        fingerprint = hashlib.sha256(json.dumps([TEMPLATE, context], sort_keys=True).encode("utf-8")).hexdigest()
+        if self._unchanged(self.html_output_path, fingerprint): return
+        try:
+            size = self._write_atomic(self.html_output_path, self.template.generate(**context))
+        except OSError as e:
+            self.log(f"Failed to write HTML file to {self.html_output_path}: {e}", level="ERROR")
+            return
+        except Exception as e:
+            self.log(f"Jinja2 template rendering error: {e}", level="ERROR")
+            fingerprint = None
+            try:
+                size = self._write_atomic(self.html_output_path, [f"<html><body><h1>Error rendering charts page</h1><p>Details: {e}</p></body></html>"])
+            except OSError as write_error:
+                self.log(f"Failed to write HTML file to {self.html_output_path}: {write_error}", level="ERROR")
+                return
+        self._written_fingerprints[self.html_output_path] = fingerprint
+        self.log(f"Successfully wrote {size} bytes to {self.html_output_path}")
+
+    def _unchanged(self, path, fingerprint):
+        """True if `path` still exists and was last written from content with this fingerprint."""
+        return self._written_fingerprints.get(path) == fingerprint and os.path.exists(path)
+
+    @staticmethod
+    def _write_atomic(path, chunks):
+        """
+        Streams `chunks` (all text or all bytes) into a temp file next to `path`,
+        then renames it over `path`. Returns the number of characters or bytes written.
+        """
+        chunks = iter(chunks)
+        first = next(chunks, "")
+        fd, tmp_path = tempfile.mkstemp(prefix=f".{os.path.basename(path)}.", suffix=".tmp", dir=os.path.dirname(os.path.abspath(path)))
+        try:
+            size = len(first)
+            with (os.fdopen(fd, "wb") if isinstance(first, bytes) else os.fdopen(fd, "w", encoding="utf-8")) as f:
+                f.write(first)
+                for chunk in chunks:
+                    f.write(chunk)
+                    size += len(chunk)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+            raise
+        return size
+
+    # --- DATABASE CLEANUP METHODS ---
+    
+    def run_optimization(self):
+        """Runs all cleanup tasks: skipped tracks, snapshot pruning, rollup verification and free page reclamation."""
+        with self.metrics.timed("cleanup:total"):
+            self._run_optimization()
+
+    def _run_optimization(self):
+        if not os.path.exists(self.db_path):
+            self.log(f"❌ Database file not found at '{self.db_path}'. Aborting optimization run.", level="ERROR")
+            return
+        
+        database_was_modified = False
+            
+        try:
+            with self.db.write() as conn:
+                cursor = conn.cursor()
+                cursor.row_factory = sqlite3.Row
+
+                self.log("--- Task 1: Checking for skipped tracks ---")
+                with self.metrics.timed("cleanup:skipped_tracks"):
+                    skipped_deleted_count = self._cleanup_skipped_tracks(cursor)
+                self.metrics.increment("cleanup:skipped_deleted", skipped_deleted_count)
+                if skipped_deleted_count > 0:
+                    database_was_modified = True
+
+                if self.cleanup_prune_enabled:
+                    self.log("--- Task 2: Pruning old chart history ---")
+                    with self.metrics.timed("cleanup:prune_chart_history"):
+                        pruned_count = self._prune_chart_history(cursor)
+                    self.metrics.increment("cleanup:snapshots_pruned", pruned_count)
+                    if pruned_count > 0:
+                        database_was_modified = True
+                else:
+                    self.log("--- Task 2: Pruning disabled, skipping. ---")
+
+                self.log("--- Task 3: Verifying daily rollup tables ---")
+                with self.metrics.timed("cleanup:verify_rollups"):
+                    rollup_mismatches = self.check_daily_rollups(cursor)
+                if rollup_mismatches == 0:
+                    self.log("Daily rollup tables are consistent with plays.")
+                elif self.cleanup_execute_mode:
+                    with self.metrics.timed("cleanup:rebuild_rollups"):
+                        self._rebuild_daily_rollups(cursor)
+                    self.log(f"EXECUTE: Rebuilt daily rollup tables ({rollup_mismatches} rows were out of sync).")
+                    database_was_modified = True
+                else:
+                    self.log("DRY RUN: Would have rebuilt the daily rollup tables. Enable 'cleanup_execute_on_run' to proceed.")
+
+                if database_was_modified and self.cleanup_execute_mode:
+                    self.log("Committing all changes to the database...")
+                    conn.commit()
+
+            if self.cleanup_execute_mode and self.cleanup_vacuum_on_complete:
+                self.log("--- Task 4: Reclaiming disk space ---")
+                with self.metrics.timed("cleanup:reclaim_free_pages"):
+                    self.reclaim_free_pages()
+
+            self.log("--- Task 5: Checking chart query plans ---")
+            with self.metrics.timed("cleanup:query_plans"):
+                self.log_query_plan_problems()
+
+            self.log("Optimization run finished.")
+
+        except sqlite3.Error as e:
+            self.log(f"❌ A database error occurred during optimization: {e}", level="ERROR")
+        except Exception as e:
+            self.log(f"❌ An unexpected error occurred during optimization: {e}", level="ERROR")
+
+    def reclaim_free_pages(self):
+        """
+        Returns free pages to the file system with incremental vacuum, in chunks
+        of VACUUM_CHUNK_PAGES that each hold the write lock only briefly, so
+        queued plays are written in between. Stops once the freelist is empty,
+        cleanup_vacuum_max_pages pages were freed or cleanup_vacuum_time_budget
+        seconds have passed; the rest is left for the next run. A database not
+        yet in incremental auto_vacuum mode needs a one-time full VACUUM, which
+        blocks writes for its whole duration; it only runs with
+        cleanup_vacuum_convert, otherwise a warning says it is pending.
+        Returns the freelist size (in pages) before and after.
+        """
+        with self.db.write() as conn:
+            free_before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                if not self.cleanup_vacuum_convert:
+                    self.log(f"Free pages are not reclaimed ({free_before} pages): the database still needs a one-time conversion "
+                             "to incremental auto_vacuum. Run 'music_chart_engine.py optimize --convert' while AppDaemon is "
+                             "stopped, or set cleanup_vacuum_convert: true for one run.", level="WARNING")
+                    return free_before, free_before
+                self.log("🧹 Converting the database to incremental auto_vacuum. This one-time full VACUUM may take a moment...")
+                conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                conn.execute("VACUUM")
+                self.log(f"✅ Conversion complete. Freelist: {free_before} pages before, 0 after.")
+                return free_before, 0
+
+        started = time.monotonic()
+        budget_pages = int(self.cleanup_vacuum_max_pages)
+        free = free_before
+        while free and budget_pages > 0 and time.monotonic() - started < self.cleanup_vacuum_time_budget:
+            with self.db.write() as conn:
+                pages = min(VACUUM_CHUNK_PAGES, budget_pages)
+                conn.executescript(f"PRAGMA incremental_vacuum({pages});")
+                free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            budget_pages -= pages
+
+        if free_before:
+            with self.db.write() as conn:
+                conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchall()
+        left = " The rest will be reclaimed by the next run." if free else ""
+        self.log(f"Freelist: {free_before} pages before, {free} after ({time.monotonic() - started:.2f}s).{left}")
+        return free_before, free
+
+    def _cleanup_skipped_tracks(self, cursor):
+        """
+        Finds and deletes skipped tracks: plays that started less than the
+        threshold after the previous play on the same player. Only plays added
+        since the play id watermark stored in db_meta, and the plays right after
+        them, are checked, whatever their timestamps. Plays without a player
+        (recorded before players were tracked) form one sequence.
+        Returns number of rows affected.
+        """
+        threshold = int(self.cleanup_threshold_seconds)
+        cursor.execute("SELECT value FROM db_meta WHERE key = ?", (SKIPPED_TRACKS_WATERMARK_KEY,))
+        row = cursor.fetchone()
+        watermark = int(row[0]) if row else 0
+        cursor.execute("SELECT MAX(id) FROM plays")
+        newest = cursor.fetchone()[0]
+        if newest is None or newest <= watermark:
+            self.log("No new plays to check for skipped tracks.")
+            return 0
+
+        params = (watermark, f"-{threshold} seconds", watermark, watermark, threshold)
+        deleted = 0
+        if self.cleanup_execute_mode:
+            cursor.execute(f"DELETE FROM plays WHERE id IN ({SKIPPED_PLAYS_QUERY})", params)
+            deleted = cursor.rowcount
+            self.log(f"EXECUTE: Deleted {deleted} skipped tracks." if deleted else "No skipped tracks found.")
+            # Read after the delete: a deleted newest id is handed out again by the next insert.
+            cursor.execute("SELECT MAX(id) FROM plays")
+            checked = cursor.fetchone()[0] or 0
+            cursor.execute("""
+                INSERT INTO db_meta (key, value) VALUES (?, ?)
+                ON CONFLICT (key) DO UPDATE SET value = excluded.value
+            """, (SKIPPED_TRACKS_WATERMARK_KEY, checked))
+        else:
+            cursor.execute(f"SELECT COUNT(*) FROM ({SKIPPED_PLAYS_QUERY})", params)
+            found_count = cursor.fetchone()[0]
+            if found_count:
+                self.log(f"DRY RUN: Found {found_count} skipped tracks. Enable 'cleanup_execute_on_run' to delete them.")
+            else:
+                self.log("No skipped tracks found.")
+        return deleted
+
+    def _prune_chart_history(self, cursor):
+        """
+        Deletes chart snapshots older than the configured number of days. Periods
+        whose previous chart window (PREVIOUS_CHART_WINDOWS) reaches further back,
+        such as yearly, keep the last snapshot of each week until it leaves that window.
+        """
+        keep_days = int(self.cleanup_prune_keep_days)
+        long_windows = [(period, window[0]) for period, window in PREVIOUS_CHART_WINDOWS.items() if int(window[0].split()[0]) < -keep_days]
+        condition, cutoff = "day < date('now', ?)", (f"-{keep_days} days",)
+        if long_windows:
+            condition += f"""
+                AND NOT (({" OR ".join("(period = ? AND day >= date('now', ?))" for _ in long_windows)})
+                  AND day = (SELECT MAX(s.day) FROM chart_snapshots s WHERE s.type = chart_snapshots.type
+                             AND s.period = chart_snapshots.period AND strftime('%Y-%W', s.day) = strftime('%Y-%W', chart_snapshots.day)))
+            """
+            cutoff += tuple(value for pair in long_windows for value in pair)
+
+        cursor.execute(f"SELECT COUNT(*) FROM chart_snapshots WHERE {condition};", cutoff)
+        count_to_delete = cursor.fetchone()[0]
+
+        if count_to_delete == 0:
+            self.log("No old chart history records to prune.")
+            return 0
+            
+        self.log(f"Found {count_to_delete} chart snapshots older than {self.cleanup_prune_keep_days} days.")
+        
+        if self.cleanup_execute_mode:
+            cursor.execute(f"DELETE FROM chart_snapshot_items WHERE snapshot_id IN (SELECT id FROM chart_snapshots WHERE {condition});", cutoff)
+            cursor.execute(f"DELETE FROM chart_snapshots WHERE {condition};", cutoff)
+            self.log(f"EXECUTE: Deleted {cursor.rowcount} old chart snapshots.")
+            return cursor.rowcount
+        else:
+            self.log("DRY RUN: Would have deleted these records. Enable 'cleanup_execute_on_run' to proceed.")
+            return 0
+
+    # --- BATCH JOBS ---
+
+    def rebuild_chart_history(self, days, timeframes=None, limit=100):
+        """
+        Regenerates the chart snapshots of each of the last `days` days (oldest
+        first, so every day's changes compare against the rebuilt previous day),
+        as they would have looked at 23:59:59 that day. Returns the number of days rebuilt.
+        """
+        timeframes = timeframes or CHART_TIMEFRAMES
+        today = datetime.datetime.now(datetime.timezone.utc).date()
+        rebuilt = 0
+        for back in range(int(days), 0, -1):
+            day = (today - datetime.timedelta(days=back)).isoformat()
+            charts, _, all_ok = self.get_all_period_charts(timeframes, limit, as_of=f"{day} 23:59:59")
+            if not all_ok:
+                self.log(f"Skipping chart history for {day}: chart generation failed.", level="WARNING")
+                continue
+            self.store_chart_snapshots(charts, day)
+            rebuilt += 1
+        self.log(f"Rebuilt chart history for {rebuilt} of {days} days.")
+        return rebuilt
+
+
+def parse_periods(value):
+    """Parses a --periods value such as "daily,weekly,quarterly:90" into a timeframes dict."""
+    timeframes = {}
+    for part in filter(None, (p.strip() for p in value.split(","))):
+        name, _, days = part.partition(":")
+        if days:
+            if not days.isdigit() or int(days) < 1:
+                raise argparse.ArgumentTypeError(f"Invalid number of days in period '{part}'")
+            timeframes[name] = f"{int(days)} days"
+        elif name in CHART_TIMEFRAMES:
+            timeframes[name] = CHART_TIMEFRAMES[name]
+        else:
+            raise argparse.ArgumentTypeError(f"Unknown period '{name}'; use one of {', '.join(CHART_TIMEFRAMES)} or name:days")
+    if not timeframes:
+        raise argparse.ArgumentTypeError("No periods given")
+    return timeframes
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build Music Tracker charts without AppDaemon.")
+    parser.add_argument("-v", "--verbose", action="store_true", help="log progress messages")
+    parser.add_argument("--metrics", help="write stage timings and counters to this file in the Prometheus text format")
+    parser.add_argument("--slow-query-ms", type=int, default=1000, help="log queries that take this long or longer (0 disables)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    charts = commands.add_parser("charts", help="generate charts and write them as HTML or JSON")
+    charts.add_argument("db_path")
+    charts.add_argument("--periods", type=parse_periods, default=dict(CHART_TIMEFRAMES), help="e.g. daily,weekly,quarterly:90")
+    charts.add_argument("--limit", type=int, default=100)
+    charts.add_argument("--output", help="HTML page to write; the chart data goes next to it as .json")
+    charts.add_argument("--data-output", help="chart data file loaded by the page (default: --output with a .json extension)")
+    charts.add_argument("--no-gzip", action="store_true", help="do not write a .gz copy of the chart data file")
+    charts.add_argument("--json", help="JSON file to write the chart data to")
+    charts.add_argument("--as-of", help="build the charts as of this UTC timestamp instead of now")
+    charts.add_argument("--min-songs-for-album", type=int, default=3)
+    charts.add_argument("--webhook", action="store_true", help="show the update button in the HTML page")
+    charts.add_argument("--no-snapshot", action="store_true", help="do not store the charts as today's snapshot")
+
+    history = commands.add_parser("rebuild-history", help="regenerate the daily chart snapshots of past days")
+    history.add_argument("db_path")
+    history.add_argument("--days", type=int, default=365)
+    history.add_argument("--periods", type=parse_periods, default=dict(CHART_TIMEFRAMES))
+    history.add_argument("--limit", type=int, default=100)
+    history.add_argument("--min-songs-for-album", type=int, default=3)
+
+    optimize = commands.add_parser("optimize", help="run the database cleanup tasks")
+    optimize.add_argument("db_path")
+    optimize.add_argument("--dry-run", action="store_true", help="report what would be deleted without deleting")
+    optimize.add_argument("--no-vacuum", action="store_true", help="do not reclaim free pages")
+    optimize.add_argument("--vacuum-pages", type=int, default=10000, help="free pages to reclaim at most")
+    optimize.add_argument("--vacuum-seconds", type=float, default=10.0, help="time budget for reclaiming free pages")
+    optimize.add_argument("--convert", action="store_true",
+                          help="convert the database to incremental auto_vacuum with a one-time full VACUUM (blocks writes)")
+    optimize.add_argument("--threshold-seconds", type=int, default=60, help="plays shorter than this count as skipped")
+    optimize.add_argument("--keep-days", type=int, default=62, help="days of chart snapshots to keep")
+
+    renormalize = commands.add_parser("renormalize", help="re-apply the title cleanup rules to all stored titles and albums")
+    renormalize.add_argument("db_path")
+    renormalize.add_argument("--keywords", type=lambda value: [k.strip() for k in value.split(",") if k.strip()],
+                             help="comma-separated version keywords to strip (default: the built-in list)")
+
+    plans = commands.add_parser("check-plans", help="check that every chart query is served by an index")
+    plans.add_argument("db_path")
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, format="%(levelname)s %(message)s")
+
+    engine = MusicChartEngine(
+        args.db_path, getattr(args, "output", None), getattr(args, "min_songs_for_album", 3), webhook=getattr(args, "webhook", False),
+        cleanup_threshold_seconds=getattr(args, "threshold_seconds", 60), cleanup_prune_keep_days=getattr(args, "keep_days", 62),
+        cleanup_execute_mode=not getattr(args, "dry_run", False), cleanup_vacuum_on_complete=not getattr(args, "no_vacuum", False),
+        data_output_path=getattr(args, "data_output", None), gzip_data=not getattr(args, "no_gzip", False),
+        cleanup_vacuum_max_pages=getattr(args, "vacuum_pages", 10000), cleanup_vacuum_time_budget=getattr(args, "vacuum_seconds", 10.0),
+        title_cleanup_keywords=getattr(args, "keywords", None), slow_query_ms=args.slow_query_ms,
+        cleanup_vacuum_convert=getattr(args, "convert", False),
+    )
+    try:
+        engine.create_db_tables()
+        while engine.legacy_migration_pending and engine.migrate_legacy_history_batch():
+            pass
+
+        if args.command == "charts":
+            charts_data, overview, all_ok = engine.get_all_period_charts(args.periods, args.limit, as_of=args.as_of)
+            if not args.no_snapshot and not args.as_of:
+                engine.store_chart_snapshots(charts_data)
+            if args.output:
+                engine.render_and_write_html(charts_data, None, overview)
+            if args.json:
+                with open(args.json, "w", encoding="utf-8") as f:
+                    json.dump({"charts": charts_data, "overview": overview}, f, ensure_ascii=False, indent=1)
+            return 0 if all_ok else 1
+        if args.command == "rebuild-history":
+            engine.rebuild_chart_history(args.days, args.periods, args.limit)
+            return 0
+        if args.command == "optimize":
+            engine.run_optimization()
+            return 0
+        if args.command == "renormalize":
+            engine.renormalize_titles()
+            return 0
+        if args.command == "check-plans":
+            problems = engine.check_query_plans()
+            for problem in problems:
+                print(problem)
+            return 1 if problems else 0
+    finally:
+        if args.metrics:
+            engine.write_metrics(args.metrics)
+        engine.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
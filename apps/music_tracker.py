@@ -6,6 +6,10 @@ Provides insights into your musical tastes.
 Includes a fully integrated, automated database cleanup and optimization
 process to remove skipped tracks and prune old chart history, keeping the
 database lean and efficient.
+
+The database, chart and rendering logic lives in music_chart_engine.py,
+which must sit next to this file; it can also be run on its own from the
+command line (see its docstring).
 ---
 
 #apps.yaml example:
@@ -20,6 +24,10 @@ music_tracker:
     - media_player.patio
     - media_player.kitchen
   html_output_path: "/homeassistant/www/music_charts.html"
+  # The page loads its chart data from this file (default: html_output_path
+  # with a .json extension); gzip_data also writes a pre-compressed .json.gz.
+  # data_output_path: "/homeassistant/www/music_charts.json"
+  gzip_data: true
   ai_service: "google_generative_ai_conversation/generate_content"
   run_on_startup: True
   webhook: False
@@ -34,183 +42,127 @@ music_tracker:
   cleanup_threshold_seconds: 60
   
   # --- Chart History Pruning Options ---
-  # Set to true to enable pruning of the chart_history table.
+  # Set to true to enable pruning of old chart snapshots.
   cleanup_prune_chart_history: true
   # Keep data for this many days. 62 days is good for monthly comparisons.
+  # The yearly charts also keep one snapshot per week for two years.
   cleanup_prune_keep_days: 62
 
   # --- Execution Options ---
   cleanup_execute_on_run: true
   
-  # Set to true to run VACUUM and reclaim disk space after cleanup.
+  # Set to true to reclaim disk space after cleanup. Free pages are returned
+  # in small steps so plays keep being recorded; each run stops after
+  # cleanup_vacuum_max_pages pages or cleanup_vacuum_time_budget seconds.
+  # Databases created before incremental auto_vacuum need a one-time full
+  # VACUUM that blocks writes while it runs. It is only done when
+  # cleanup_vacuum_convert is true (or with 'music_chart_engine.py optimize
+  # --convert'); until then each run logs that the conversion is pending.
   cleanup_vacuum_on_complete: true
+  cleanup_vacuum_max_pages: 10000
+  cleanup_vacuum_time_budget: 10
+  cleanup_vacuum_convert: false
+
+  # --- Refresh Options ---
+  # Entity showing whether a chart refresh is idle, running or queued.
+  refresh_status_entity: "sensor.music_tracker_refresh"
+
+  # --- Title Cleanup Options ---
+  # Version markers removed from titles and albums, e.g. "Song (Live)" -> "Song".
+  # Leave unset for the built-in list. After a change, stored titles are
+  # re-normalized in small batches after the next start, merging the variants
+  # of each track.
+  # title_cleanup_keywords: ["remaster", "remix", "live", "radio edit", "deluxe"]
+
+  # --- Duplicate Play Options ---
+  # A track is recorded at most once per player within this many seconds.
+  # The most recent plays are kept in memory, up to dedupe_max_entries, and
+  # reloaded from the database on startup so a restart does not record them again.
+  dedupe_seconds: 600
+  dedupe_max_entries: 1000
+  dedupe_restore_on_startup: true
+
+  # --- Player Event Options ---
+  # Seconds between checks for tracks that have played long enough to be recorded.
+  track_check_interval: 1
+
+  # --- AI Report Options ---
+  # AI reports are cached by a fingerprint of the data they were generated
+  # from; an identical refresh reuses the cached report instead of calling
+  # the AI service again. Real calls are at least ai_min_interval_minutes
+  # apart, and a refresh while a call is pending waits for its response.
+  ai_cache_ttl_hours: 24
+  ai_cache_max_entries: 20
+  ai_min_interval_minutes: 30
+  # Estimated size limit of a prompt in tokens, instructions included. Song
+  # lists are cut to the highest-ranked (or most recent) songs that fit.
+  ai_prompt_token_budget: 3000
+
+  # --- Chart API Options ---
+  # Serves the charts as JSON at http://<appdaemon>:5050/api/appdaemon/<api_endpoint>
+  # with period, category, limit and offset parameters. Set to false to disable.
+  api_endpoint: "music_charts"
+  api_max_limit: 500
+
+  # --- Chart Sensor Options ---
+  # After each refresh the top entries of every chart are published as
+  # <chart_sensor_prefix>_<period>_<category> sensors (e.g.
+  # sensor.music_tracker_top_weekly_artists), whose state is the #1 entry.
+  # Only sensors whose chart changed are written. Set the prefix to false to disable.
+  chart_sensor_prefix: "sensor.music_tracker_top"
+  chart_sensor_top_n: 10
+  # Entries beyond this size (bytes of JSON) are left out of the items attribute.
+  chart_sensor_max_attribute_bytes: 4096
+
+  # --- Metrics Options ---
+  # Timings and counters of chart queries, rendering, ingest and cleanup are
+  # published as <metrics_sensor_prefix>_charts/_render/_ingest/_cleanup
+  # sensors every metrics_interval seconds (set the prefix to false to disable),
+  # and written in the Prometheus text format to metrics_output_path if set.
+  metrics_sensor_prefix: "sensor.music_tracker"
+  metrics_output_path: "/config/music_tracker.prom"
+  metrics_interval: 60
+  # Chart queries taking at least this many milliseconds are logged (0 disables).
+  slow_query_threshold_ms: 1000
+
+  # --- Ingest Options ---
+  # Plays are written in batches, once per interval (seconds) or when a batch fills up.
+  ingest_flush_interval: 2
+  ingest_batch_size: 50
+  ingest_queue_size: 1000
 """
 
 import appdaemon.plugins.hass.hassapi as hass
+import collections
 import datetime
+import hashlib
+import json
 import sqlite3
-import re
 import time
 import threading
-import json
-import os
-import jinja2
 import random
+import queue
 
-TEMPLATE = """<!DOCTYPE html>
-<html lang="en">
-<head>
-<meta charset="UTF-8" />
-<meta name="viewport" content="width=device-width,initial-scale=1" />
-<meta http-equiv="Cache-Control" content="no-cache, no-store, must-revalidate" />
-<meta http-equiv="Pragma" content="no-cache" />
-<meta http-equiv="Expires" content="0" />
-<title>Music Charts</title>
-<style>
-:root{color-scheme:light dark;--bg-light:#f4f4f9;--bg-dark:#1a1a1a;--text-light:#333;--text-dark:#eee;--card-light:#fff;--card-dark:#2a2a2a;--accent-light:#3498db;--accent-dark:#2980b9;}
-*{box-sizing:border-box;margin:0;padding:0;}
-body{font-family:sans-serif;background:var(--bg-light);color:var(--text-light);padding:1em;}
-body.dark-mode{background:var(--bg-dark);color:var(--text-dark);}
-#refreshPageButton,#toggleDarkMode,#toggleUpdates{padding:.4em 1em;font-size:.75rem;color:#fff;background:#007bff;border:none;border-radius:5px;cursor:pointer;margin-right:.5em;}
-#toggleUpdates:disabled{background:#6c757d;cursor:not-allowed;}
-header{display:flex;flex-wrap:wrap;align-items:center;justify-content:space-between;margin-bottom:1em;}
-h1{font-size:1.6rem;color:var(--accent-light);}
-body.dark-mode h1{color:var(--accent-dark);}
-#controls label{margin-right:1em;font-size:.9rem;color:#34495e;cursor:pointer;}
-body.dark-mode #controls label{color:#ccc;}
-#generated-at{font-size:.8rem;color:#7f8c8d;}
-main{display:flex;flex-direction:column;gap:2em;}
-.chart-section{background:var(--card-light);border-radius:8px;padding:1em;}
-body.dark-mode .chart-section{background:var(--card-dark);}
-.chart-section h2{color:var(--accent-light);}
-body.dark-mode .chart-section h2{color:var(--accent-dark);}
-.chart-tables{display:flex;flex-wrap:wrap;gap:1em;}
-.table-container{flex:1 1 calc(33.33% - 1em);min-width:280px;}
-table{width:100%;border-collapse:collapse;margin-bottom:.5em;}
-th,td{padding:.5em;text-align:start;word-break:break-word;font-size:.8rem;}
-th{background:var(--accent-light);color:#fff;}
-tbody tr:nth-child(even){background:#ecf0f1;}
-body.dark-mode tbody tr:nth-child(even){background:#3a3a3a;}
-tbody tr:hover{background:var(--hover-light);}
-body.dark-mode tbody tr:hover{background:var(--hover-dark);}
-h3{margin:.5em 0;font-size:1rem;color:#2980b9;}
-.ai-container .chart-container{max-height:90vh;}
-.change-up{color:green;font-weight:bold;}
-.change-down{color:red;font-weight:bold;}
-.change-new{color:orange;font-weight:bold;}
-.stats-container{background:#f9f5f0;border-radius:8px;padding:.5em;}
-body.dark-mode .stats-container{background:#3a2e24;}
-.stats-container h3{color:#e67e22;font-size:1rem;margin-bottom:.3em;}
-.stats-container table th{background:#e67e22;color:#fff;}
-#update-status-area p{margin-bottom:.5em;font-size:1.1em;}
-#countdown-refresh-button{padding:.5em 1.2em;font-size:1rem;color:#fff;background:#007bff;border:none;border-radius:5px;cursor:pointer;}
-#countdown-refresh-button:disabled{background:#6c757d;cursor:not-allowed;}
-#countdown-refresh-button:hover:not(:disabled){background:#0056b3;}
-#ai-analysis h2{color:#856404;}
-@media (max-width:768px){
-.table-container{flex:1 1 100%;}
-header{flex-direction:column;align-items:flex-start;}
-header>*:not(:last-child){margin-bottom:1em;}
-#controls{display:grid;grid-template-columns:1fr 1fr;gap:10px;width:100%;margin:0;}
-#controls label{padding:.7em .5em;margin:0;background:rgba(0,0,0,.04);border-radius:6px;text-align:center;}
-body.dark-mode #controls label{background:rgba(255,255,255,.1);}
-#controls label:hover{background:rgba(0,0,0,.1);}
-body.dark-mode #controls label:hover{background:rgba(255,255,255,.2);}
-#action-buttons{display:grid;width:100%;grid-template-columns:1fr 1fr;gap:10px;}
-#action-buttons button{margin:0;width:100%;}
-}
-</style>
-</head>
-<body>
-<header>
-<h1>Music Charts</h1>
-<div id="controls">
-<label><input type="checkbox" data-period="daily" checked> Daily</label>
-<label><input type="checkbox" data-period="weekly" checked> Weekly</label>
-<label><input type="checkbox" data-period="monthly" checked> Monthly</label>
-<label><input type="checkbox" data-period="yearly" checked> Yearly</label>
-</div>
-<p id="generated-at">Generated at {{ generated_at }}{% if ai_analysis %}<br/><a href="#ai-analysis" id="ai-indicator" style="color: light-blue">AI Report Available</a>{% endif %}</p>
-<div id="action-buttons">{% if webhook %}<button id="toggleUpdates" onclick="triggerWebhook()">Update Charts</button>{% endif %}<button id="refreshPageButton">Refresh Page</button><button id="toggleDarkMode">Toggle Dark Mode</button></div>
-</header>
-<main>
-{% macro render_table(title, items, cols, current_period) %}
-<div class="table-container">
-<h3>{{ title }}</h3>{% if items %}
-<table>
-<thead>
-<tr><th>{% for col in cols.keys() %}<th>{{ col }}</th>{% endfor %}{% if current_period != 'yearly' and title != '📻 Channels/Playlists' %}<th>~</th>{% endif %}</tr>
-</thead>
-<tbody>{% for item in items %}
-<tr><td nowrap>{{ loop.index }}</td>{% for key in cols.values() %}<td{% if key in ['plays','change'] %} nowrap{% endif %}>{{ item[key] }}</td>{% endfor %}{% if current_period != 'yearly' and title != '📻 Channels/Playlists' %}<td nowrap>{% if item.new_entry %}<span class="change-new">NEW</span>{% elif item.change > 0 %}<span class="change-up">▲{{ item.change }}</span>{% elif item.change < 0 %}<span class="change-down">▼{{ (-item.change)|abs }}</span>{% else %}–{% endif %}</td>{% endif %}</tr>{% endfor %}
-</tbody>
-</table>{% else %}<p>No data for {{ title }}</p>{% endif %}</div>
-{% endmacro %}
-{% for period, data in charts.items() %}
-<section id="chart-{{ period }}" class="chart-section">
-<h2>Top {{ period.capitalize() }} ({{ data.dates }})</h2>
-<div class="chart-tables">
-{{ render_table('🎵 Songs', data.songs, {'Artist':'artist','Title':'title','▶️':'plays'}, period) }}
-{{ render_table('👤 Artists', data.artists, {'Artist':'artist','▶️':'plays'}, period) }}
-{{ render_table('💽 Albums', data.albums, {'Artist':'artist','Album':'album','▶️':'tracks'}, period) }}
-{{ render_table('📻 Channels/Playlists', data.media_channels, {'Channel':'channel','▶️':'plays'}, period) }}
-<div class="table-container stats-container" style="max-width:30%;">
-<h3>📈 {{ period.capitalize() }} Statistics</h3>
-<table>
-<thead>
-<tr><th>Metric</th><th>Value</th></tr>
-</thead>
-<tbody>
-<tr><td>Days Collected</td><td>{{ overview[period].days }}</td></tr>
-<tr><td>Unique Songs</td><td>{{ overview[period].unique_songs }}</td></tr>
-<tr><td>Total Plays</td><td>{{ overview[period].total_plays }}</td></tr>
-<tr><td>Unique Albums</td><td>{{ overview[period].unique_albums }}</td></tr>
-<tr><td>Unique Artists</td><td>{{ overview[period].unique_artists }}</td></tr>
-</tbody>
-</table>
-</div></div></section>
-{% endfor %}
-{% if ai_analysis %}
-<div id="update-status-area" style="padding:1em;text-align:center;"></div>
-<section id="ai-analysis">
-<h2>🔮 AI Analysis</h2>
-{{ ai_analysis|safe }}
-</section>
-{% endif %}
-</main>
-<script>
-(function(){
-let d=localStorage.getItem('dark_mode'),p=window.matchMedia&&window.matchMedia('(prefers-color-scheme: dark)').matches;
-if(d==='1'||(d===null&&p))document.body.classList.add('dark-mode');
-})();
-document.addEventListener("DOMContentLoaded",function(){
-let r=document.getElementById('refreshPageButton'),t=document.getElementById('toggleDarkMode');
-if(r)r.onclick=function(){location.reload();};
-if(t)t.onclick=function(){let n=document.body.classList.toggle('dark-mode');localStorage.setItem('dark_mode',n?'1':'0');};
-document.querySelectorAll("#controls input[type=checkbox]").forEach(function(cb){
-let per=cb.dataset.period,s=localStorage.getItem('show_'+per),sec=document.getElementById('chart-'+per);
-cb.checked=s===null?true:s==="1";
-if(sec)sec.style.display=cb.checked?"":"none";
-cb.onchange=function(){localStorage.setItem('show_'+per,cb.checked?"1":"0");if(sec)sec.style.display=cb.checked?"":"none";};
-});
-});
-function triggerWebhook() {
-const originalUpdateButton=document.getElementById('toggleUpdates');
-if(!originalUpdateButton||originalUpdateButton.style.display==='none'){return;}
-originalUpdateButton.style.display='none';
-const statusArea=document.getElementById('update-status-area');
-statusArea.innerHTML=`<p>Update request sent! Please wait while new AI report is generated.</p><button id="countdown-refresh-button" disabled>Refresh in <span id="countdown-timer">30</span>s</button>`;
-fetch("/api/webhook/Update_Music_Charts",{method:"POST"}).then(r=>{if(r.ok){console.log("Webhook triggered!");}else{console.error("Failed:",r.statusText);}}).catch(e=>console.error("Error:",e));
-let countdown=30,timerSpan=document.getElementById('countdown-timer'),newRefreshButton=document.getElementById('countdown-refresh-button');
-const intervalId=setInterval(()=>{
-countdown--;timerSpan.innerText=countdown;
-if(countdown<=0){clearInterval(intervalId);newRefreshButton.disabled=false;newRefreshButton.innerText='✅ Refresh Now';newRefreshButton.onclick=()=>location.reload();}
-},1000);
-}
-</script>
-</body>
-</html>
-"""
+from music_chart_engine import CHART_PAYLOAD_COLUMNS, CHART_TIMEFRAMES, PERIOD_LABELS, MusicChartEngine
+
+# Media player attributes that identify the playing track. Changes to any
+# other attribute (position, volume, artwork, ...) cannot start or end a play.
+# Artist and title come first: (state, artist, title) is the playing track.
+TRACK_ATTRIBUTES = ("media_artist", "media_title", "media_album_name", "media_channel", "source")
+
+# Seconds an AI service call may take before it is given up on.
+AI_CALL_TIMEOUT = 120
+# Rough characters per token, for estimating prompt sizes without a tokenizer.
+CHARS_PER_TOKEN = 4
+# Songs a prompt keeps even when the token budget cannot fit them.
+AI_PROMPT_MIN_SONGS = 10
+
+# Entries per chart kept from each refresh; the chart API reads deeper pages from the database.
+CHART_DEPTH = 100
+# Chart API responses cached between refreshes.
+API_CACHE_SIZE = 256
+
+CHART_SENSOR_ICONS = {"songs": "mdi:music-note", "artists": "mdi:account-music", "albums": "mdi:album", "media_channels": "mdi:radio"}
 
 AI_PROMPT_1 = [
     "You are a 'Musical Insights Web Weaver,' an AI expert tasked with creating a beautiful, responsive, and insightful HTML widget from music listening data.",
@@ -295,46 +247,309 @@ AI_PROMPT_2 = [
     "5. Structure: Organize content logically into: 'Musical Analysis' (including AI image), 'Artist & Song Recommendations', and 'Interactive Game'. All JavaScript (Chart.js, game logic) must be embedded and operate within `.ai-container`."
 ]
 
-
-class TrackManager:
+class RecentPlayCache:
+    """
+    Remembers recently recorded (player, track) keys for `ttl` seconds so the
+    same play is not stored twice. Entries are kept in insertion order, which
+    is also their expiry order, so expired entries are dropped lazily from the
+    front on every access instead of by a cleanup thread. Beyond `max_size`
+    entries the oldest ones are evicted.
+    """
+    def __init__(self, ttl=600, max_size=1000, clock=time.time):
+        self.ttl = ttl
+        self.max_size = max(1, int(max_size))
+        self._clock = clock
+        self._expires = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            self._expire(self._clock())
+            return len(self._expires)
+
+    def __contains__(self, key):
+        with self._lock:
+            now = self._clock()
+            self._expire(now)
+            return self._expires.get(key, now) > now
+
+    def add(self, key, played_at=None):
+        """Remembers `key` until `ttl` seconds after `played_at` (epoch seconds, default: now)."""
+        with self._lock:
+            now = self._clock()
+            self._expire(now)
+            self._store(key, (played_at or now) + self.ttl)
+
+    def add_if_new(self, key):
+        """Remembers `key` and returns True, or returns False if it was already remembered."""
+        with self._lock:
+            now = self._clock()
+            self._expire(now)
+            if self._expires.get(key, now) > now: return False
+            self._store(key, now + self.ttl)
+            return True
+
+    def _store(self, key, expires_at):
+        self._expires.pop(key, None)
+        self._expires[key] = expires_at
+        while len(self._expires) > self.max_size:
+            self._expires.popitem(last=False)
+
+    def _expire(self, now):
+        while self._expires:
+            key, expires_at = next(iter(self._expires.items()))
+            if expires_at > now: break
+            del self._expires[key]
+
+class PendingPlayTimers:
+    """
+    Tracks that started playing and are waiting to be recorded, at most one
+    per player. Instead of one AppDaemon timer per track, a single periodic
+    tick collects the entries that are due. Every entry waits the same delay,
+    so insertion order is due order and the tick only looks at the front.
+    """
+    def __init__(self, delay, clock=time.time):
+        self.delay = delay
+        self._clock = clock
+        self._pending = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._pending)
+
+    def get(self, player):
+        """Returns the track waiting on `player`, or None."""
+        with self._lock:
+            entry = self._pending.get(player)
+            return entry and entry[1]
+
+    def schedule(self, player, track_info):
+        """Starts the delay for `track_info`, replacing whatever was waiting on `player`."""
+        with self._lock:
+            self._pending.pop(player, None)
+            self._pending[player] = (self._clock() + self.delay, track_info)
+
+    def update(self, player, track_info):
+        """Replaces the details of the track waiting on `player` without restarting its delay."""
+        with self._lock:
+            if player in self._pending:
+                self._pending[player] = (self._pending[player][0], track_info)
+
+    def cancel(self, player):
+        with self._lock:
+            self._pending.pop(player, None)
+
+    def pop_due(self):
+        """Removes and returns the tracks whose delay has passed, oldest first."""
+        due = []
+        with self._lock:
+            now = self._clock()
+            while self._pending:
+                player, (due_at, track_info) = next(iter(self._pending.items()))
+                if due_at > now: break
+                del self._pending[player]
+                due.append(track_info)
+        return due
+
+class IngestQueue:
+    """
+    Write-behind buffer for track inserts. Plays are queued by the AppDaemon
+    callbacks and written by a background thread in one transaction per
+    flush interval or full batch, instead of one commit per play. With
+    `metrics`, the time from queuing (and from `started_at`) to commit is
+    recorded as ingest:queue (and ingest:total) per play. Rows stay in the
+    queue until the flush that writes them, so flush() always covers them.
+    """
+    def __init__(self, flush_callback, log, batch_size=50, flush_interval=2.0, max_size=1000, metrics=None):
+        self._flush_callback = flush_callback
+        self._log = log
+        self._metrics = metrics
+        self.batch_size = max(1, int(batch_size))
+        self.flush_interval = max(0.1, float(flush_interval))
+        self.max_size = max(1, int(max_size))
+        self._queue = queue.Queue(maxsize=self.max_size)
+        self._retry = []
+        self._flush_lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._counters = {"written": 0, "flushes": 0, "failed_flushes": 0, "dropped": 0,
+                          "last_batch_size": 0, "last_flush_ms": 0.0, "max_flush_ms": 0.0}
+        self._thread = threading.Thread(target=self._run, name="music_tracker_ingest", daemon=True)
+        self._thread.start()
+
+    def put(self, row, started_at=None):
+        """
+        Queues one row; if the queue is full, flushes on the calling thread first.
+        `started_at` (time.monotonic()) is when the play was first seen.
+        """
+        queued_at = time.monotonic()
+        entry = (row, queued_at, started_at or queued_at)
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            self._log("Ingest queue is full, flushing on the calling thread.", level="WARNING")
+            self._write([entry])
+            return
+        with self._cond:
+            self._cond.notify()
+
+    def stats(self):
+        """Returns a snapshot of the queue depth and flush counters."""
+        with self._flush_lock:
+            return dict(self._counters, depth=self._queue.qsize() + len(self._retry))
+
+    def _run(self):
+        while not self._stop.is_set():
+            with self._cond:
+                # Wait for a first row, then up to flush_interval for a full batch.
+                if self._cond.wait_for(lambda: self._queue.qsize() or self._stop.is_set(), self.flush_interval):
+                    self._cond.wait_for(lambda: self._queue.qsize() >= self.batch_size or self._stop.is_set(), self.flush_interval)
+            self._write(limit=self.batch_size)
+
+    def _drain(self, limit=None):
+        batch = []
+        while limit is None or len(batch) < limit:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, extra=(), limit=None):
+        """Writes the rows to retry, the queued rows (at most `limit`) and `extra` in one transaction."""
+        with self._flush_lock:
+            batch = self._retry + self._drain(limit) + list(extra)
+            self._retry = []
+            if not batch: return
+            started = time.monotonic()
+            try:
+                self._flush_callback([row for row, _, _ in batch])
+            except Exception as e:
+                self._counters["failed_flushes"] += 1
+                overflow = len(batch) - self.max_size
+                if overflow > 0:
+                    self._counters["dropped"] += overflow
+                    self._log(f"Dropping {overflow} queued plays after repeated write failures.", level="ERROR")
+                self._retry = batch[max(0, overflow):]
+                self._log(f"Failed to write {len(batch)} queued plays, will retry: {e}", level="ERROR")
+                return
+            committed = time.monotonic()
+            elapsed_ms = (committed - started) * 1000
+            if self._metrics:
+                self._metrics.observe("ingest:flush", committed - started)
+                for _, queued_at, started_at in batch:
+                    self._metrics.observe("ingest:queue", committed - queued_at)
+                    self._metrics.observe("ingest:total", committed - started_at)
+            self._counters["written"] += len(batch)
+            self._counters["flushes"] += 1
+            self._counters["last_batch_size"] = len(batch)
+            self._counters["last_flush_ms"] = round(elapsed_ms, 2)
+            self._counters["max_flush_ms"] = round(max(self._counters["max_flush_ms"], elapsed_ms), 2)
+
+    def flush(self):
+        """Writes everything queued so far on the calling thread."""
+        self._write()
+
+    def close(self):
+        """Stops the writer thread and flushes the remaining rows."""
+        self._stop.set()
+        with self._cond:
+            self._cond.notify()
+        self._thread.join(timeout=self.flush_interval + 5)
+        self.flush()
+
+class RefreshWorker:
     """
-    Manages recently played tracks to prevent duplicates within a short timeframe.
+    Runs chart refreshes on one background thread. Requests arriving while a
+    refresh is running are coalesced into a single follow-up run, so a burst
+    of triggers never stacks full refreshes or writes the page concurrently.
     """
-    def __init__(self):
-        self.played_tracks = {}
-        self.lock = threading.Lock()
-        self.cleanup_interval = 60  # seconds
-        self.track_memory_duration = 600  # seconds
-        self.cleanup_thread = threading.Thread(target=self.cleanup_tracks_periodically)
-        self.cleanup_thread.daemon = True
-        self.cleanup_thread.start()
-
-    def add_track(self, track_id):
-        with self.lock:
-            self.played_tracks[track_id] = time.time()
-
-    def has_been_played_recently(self, track_id):
-        with self.lock:
-            return track_id in self.played_tracks
-
-    def _perform_cleanup(self):
-        current_time = time.time()
-        with self.lock:
-            to_remove = [
-                tid for tid, ts in self.played_tracks.items()
-                if current_time - ts > self.track_memory_duration
-            ]
-            for tid in to_remove:
-                del self.played_tracks[tid]
-
-    def cleanup_tracks_periodically(self):
+    def __init__(self, refresh_callback, log, on_status=None):
+        self._refresh_callback = refresh_callback
+        self._log = log
+        self._on_status = on_status
+        self._cond = threading.Condition()
+        self._stop = False
+        self._running = False
+        self._pending_reasons = []
+        self._status = {"state": "idle", "runs": 0, "coalesced": 0, "failures": 0, "last_reason": None,
+                        "last_started": None, "last_finished": None, "last_duration_s": None, "last_error": None}
+        self._thread = threading.Thread(target=self._run, name="music_tracker_refresh", daemon=True)
+        self._thread.start()
+
+    def request(self, reason):
+        """
+        Asks for a refresh. Returns "started" if the worker was idle, "queued" if
+        a run is in progress, or "coalesced" if a follow-up run was already pending.
+        """
+        with self._cond:
+            if self._pending_reasons:
+                result = "coalesced"
+                self._status["coalesced"] += 1
+            else:
+                result = "queued" if self._running else "started"
+            self._pending_reasons.append(reason)
+            self._status["state"] = "queued" if self._running else "running"
+            self._cond.notify()
+        self._publish()
+        return result
+
+    def stats(self):
+        """Returns a snapshot of the worker status."""
+        with self._cond:
+            return dict(self._status, pending=len(self._pending_reasons))
+
+    def _publish(self):
+        if self._on_status:
+            try:
+                self._on_status(self.stats())
+            except Exception as e:
+                self._log(f"Could not publish refresh status: {e}", level="WARNING")
+
+    def _run(self):
         while True:
-            time.sleep(self.cleanup_interval)
-            self._perform_cleanup()
+            with self._cond:
+                while not self._pending_reasons and not self._stop:
+                    self._cond.wait()
+                if self._stop: return
+                reasons, self._pending_reasons = self._pending_reasons, []
+                self._running = True
+                self._status.update(state="running", last_reason=", ".join(dict.fromkeys(reasons)),
+                                    last_started=datetime.datetime.now().isoformat(timespec="seconds"))
+            self._publish()
+
+            started, error = time.monotonic(), None
+            try:
+                self._refresh_callback()
+            except Exception as e:
+                error = str(e)
+                self._log(f"Chart refresh failed: {e}", level="ERROR")
+
+            with self._cond:
+                self._running = False
+                self._status["runs"] += 1
+                self._status["failures"] += 1 if error else 0
+                self._status.update(state="queued" if self._pending_reasons else "idle", last_error=error,
+                                    last_duration_s=round(time.monotonic() - started, 2),
+                                    last_finished=datetime.datetime.now().isoformat(timespec="seconds"))
+            self._publish()
+
+    def close(self, timeout=30):
+        """
+        Stops the worker after the refresh in progress, dropping pending requests.
+        Returns False if that refresh was still running after `timeout` seconds.
+        """
+        with self._cond:
+            self._stop = True
+            self._cond.notify()
+        self._thread.join(timeout=timeout)
+        return not self._thread.is_alive()
 
 class MusicTracker(hass.Hass):
     """
     AppDaemon app to track music history, generate charts, and self-optimize its database.
+    Home Assistant wiring lives here; database and chart work is done by a MusicChartEngine.
     """
 
     def initialize(self):
@@ -346,10 +561,13 @@ class MusicTracker(hass.Hass):
             self.media_players = [self.media_players] if self.media_players else []
 
         self.duration_to_consider_played = self.args.get("duration", 30)
+        self.track_check_interval = self.args.get("track_check_interval", 1)
         self.min_songs_for_album_chart = self.args.get("min_songs_for_album", 3)
         self.chart_update_time = self.args.get("update_time", "23:59:00")
         self.db_path = self.args.get("db_path", "/config/music_data_history.db")
         self.html_output_path = self.args.get("html_output_path", "/homeassistant/www/music_charts.html")
+        self.data_output_path = self.args.get("data_output_path")
+        self.gzip_data = self.args.get("gzip_data", True)
         self.ai_service = self.args.get("ai_service", False)
         self.webhook = self.args.get("webhook", False)
 
@@ -361,15 +579,75 @@ class MusicTracker(hass.Hass):
         self.cleanup_prune_keep_days = self.args.get("cleanup_prune_keep_days", 62)
         self.cleanup_execute_mode = self.args.get("cleanup_execute_on_run", True)
         self.cleanup_vacuum_on_complete = self.args.get("cleanup_vacuum_on_complete", True)
+        self.cleanup_vacuum_max_pages = self.args.get("cleanup_vacuum_max_pages", 10000)
+        self.cleanup_vacuum_time_budget = self.args.get("cleanup_vacuum_time_budget", 10)
+        self.cleanup_vacuum_convert = self.args.get("cleanup_vacuum_convert", False)
+
+        # --- Ingest Configuration Loading ---
+        self.ingest_batch_size = self.args.get("ingest_batch_size", 50)
+        self.ingest_flush_interval = self.args.get("ingest_flush_interval", 2)
+        self.ingest_queue_size = self.args.get("ingest_queue_size", 1000)
+        self.migration_batch_size = self.args.get("migration_batch_size", 5000)
+        self.refresh_status_entity = self.args.get("refresh_status_entity", "sensor.music_tracker_refresh")
+        self.dedupe_seconds = self.args.get("dedupe_seconds", 600)
+        self.dedupe_max_entries = self.args.get("dedupe_max_entries", 1000)
+        self.dedupe_restore_on_startup = self.args.get("dedupe_restore_on_startup", True)
+        self.title_cleanup_keywords = self.args.get("title_cleanup_keywords")
+        self.ai_cache_ttl_hours = self.args.get("ai_cache_ttl_hours", 24)
+        self.ai_cache_max_entries = self.args.get("ai_cache_max_entries", 20)
+        self.ai_min_interval_minutes = self.args.get("ai_min_interval_minutes", 30)
+        self.ai_prompt_token_budget = self.args.get("ai_prompt_token_budget", 3000)
+        self.api_endpoint = self.args.get("api_endpoint", "music_charts")
+        self.api_max_limit = self.args.get("api_max_limit", 500)
+        self.chart_sensor_prefix = self.args.get("chart_sensor_prefix", "sensor.music_tracker_top")
+        self.chart_sensor_top_n = self.args.get("chart_sensor_top_n", 10)
+        self.chart_sensor_max_attribute_bytes = self.args.get("chart_sensor_max_attribute_bytes", 4096)
+        self.metrics_sensor_prefix = self.args.get("metrics_sensor_prefix", "sensor.music_tracker")
+        self.metrics_output_path = self.args.get("metrics_output_path")
+        self.metrics_interval = self.args.get("metrics_interval", 60)
+        self.slow_query_threshold_ms = self.args.get("slow_query_threshold_ms", 1000)
         
         # --- Validation and Setup ---
         if not self.db_path:
             self.log("db_path not configured. MusicTracker cannot function.", level="ERROR")
             return
 
-        self.track_manager = TrackManager()
-        self.create_db_tables()
-        self.cleanup_old_db_tracks()
+        self.engine = MusicChartEngine(
+            self.db_path, self.html_output_path, self.min_songs_for_album_chart, webhook=self.webhook, log=self.log,
+            migration_batch_size=self.migration_batch_size, cleanup_threshold_seconds=self.cleanup_threshold_seconds,
+            cleanup_prune_enabled=self.cleanup_prune_enabled, cleanup_prune_keep_days=self.cleanup_prune_keep_days,
+            cleanup_execute_mode=self.cleanup_execute_mode, cleanup_vacuum_on_complete=self.cleanup_vacuum_on_complete,
+            data_output_path=self.data_output_path, gzip_data=self.gzip_data,
+            cleanup_vacuum_max_pages=self.cleanup_vacuum_max_pages, cleanup_vacuum_time_budget=self.cleanup_vacuum_time_budget,
+            cleanup_vacuum_convert=self.cleanup_vacuum_convert,
+            title_cleanup_keywords=self.title_cleanup_keywords, slow_query_ms=self.slow_query_threshold_ms,
+        )
+        self.metrics = self.engine.metrics
+        self._published_metrics = {}
+        self.engine.create_db_tables()
+        self.recent_plays = RecentPlayCache(self.dedupe_seconds, self.dedupe_max_entries)
+        if self.dedupe_restore_on_startup:
+            self._restore_recent_plays()
+        self.ingest_queue = IngestQueue(self.engine.store_tracks_in_db, self.log, batch_size=self.ingest_batch_size,
+                                        flush_interval=self.ingest_flush_interval, max_size=self.ingest_queue_size,
+                                        metrics=self.metrics)
+        self.refresh_worker = RefreshWorker(self.update_html_and_sensors, self.log, on_status=self._publish_refresh_status)
+        self._refresh_after_migration = False
+        self._last_charts_data = {}
+        self._last_overview_stats_per_period = {}
+        self._charts_generated_at = None
+        self._api_cache = {}
+        self._published_chart_sensors = {}
+        self._ai_lock = threading.Lock()
+        self._ai_in_flight = None
+        self._ai_last_call = None
+        self._last_ai_text = None
+        if self.engine.legacy_migration_pending:
+            self.run_in(self._migrate_legacy_history_batch, 1)
+        else:
+            self._start_title_renormalization()
+        self.engine.cleanup_old_db_tracks()
+        self.engine.log_query_plan_problems()
 
         # Setup Chart Generation Schedule
         try:
@@ -403,8 +681,10 @@ class MusicTracker(hass.Hass):
         else:
             self.log(f"Input boolean {self.input_boolean_chart_trigger} not found. Manual trigger disabled.", level="WARNING")
 
-        self._active_track_timers = {}
+        self.pending_plays = PendingPlayTimers(self.duration_to_consider_played)
+        self.player_states = {}
         if self.media_players:
+            self.run_every(self._record_due_tracks, "now", self.track_check_interval)
             for player_entity_id in self.media_players:
                 if self.entity_exists(player_entity_id):
                     self.listen_state(self.handle_media_player_event, player_entity_id, attribute="all")
@@ -414,77 +694,110 @@ class MusicTracker(hass.Hass):
         else:
             self.log("No media_players configured to monitor.", level="WARNING")
 
-        self._last_charts_data = {}
+        if self.metrics_sensor_prefix or self.metrics_output_path:
+            self.run_every(self.publish_metrics, "now", self.metrics_interval)
+
+        if self.api_endpoint:
+            self.register_endpoint(self.charts_api_callback, self.api_endpoint)
+            self.log(f"Serving chart data at /api/appdaemon/{self.api_endpoint}")
+
         if self.args.get("run_on_startup", True):
-            self.log("run_on_startup is true, generating charts now.")
-            self.update_html_and_sensors()
+            if self.engine.legacy_migration_pending:
+                self.log("run_on_startup is true, charts will be generated once the history migration completes.")
+                self._refresh_after_migration = True
+            else:
+                self.log("run_on_startup is true, generating charts now.")
+                self.request_refresh("startup")
 
         self.log("MusicTracker Initialization Complete.")
 
+    def terminate(self):
+        """
+        Called by AppDaemon when the app is stopped or reloaded. Waits for a
+        running refresh, flushes queued plays and closes the database connections.
+        The connections stay open if the refresh did not finish in time.
+        """
+        refresh_stopped = True
+        if getattr(self, "refresh_worker", None):
+            refresh_stopped = self.refresh_worker.close()
+        if getattr(self, "ingest_queue", None):
+            self.ingest_queue.close()
+            self.log(f"Ingest queue flushed on terminate: {self.ingest_queue.stats()}")
+        if getattr(self, "engine", None):
+            if refresh_stopped:
+                self.engine.close()
+            else:
+                self.log("Chart refresh still running on terminate; leaving the database connections open for it.", level="WARNING")
+
     def scheduled_update_html_callback(self, kwargs):
         """
         Called daily at the configured time to regenerate charts and HTML.
         """
         self.log("Scheduled daily chart update triggered.")
-        self.update_html_and_sensors()
+        self.request_refresh("schedule")
 
     def manual_update_html_callback(self, entity, attribute, old, new, kwargs):
         """
         Called when the input_boolean for manual update is turned on.
         """
         self.log(f"Manual chart update triggered by {entity}.")
-        self.update_html_and_sensors()
+        self.request_refresh(f"manual ({entity})")
         if self.entity_exists(self.input_boolean_chart_trigger):
             self.set_state(self.input_boolean_chart_trigger, state="off",
                         attributes={"last_triggered": datetime.datetime.now().isoformat()})
 
+    def request_refresh(self, reason):
+        """Hands a chart refresh to the refresh worker, which coalesces overlapping requests."""
+        result = self.refresh_worker.request(reason)
+        if result != "started":
+            self.log(f"Chart refresh requested ({reason}) while one is running; {result} into the next run.")
+
+    def _publish_refresh_status(self, status):
+        """Mirrors the refresh worker status to the refresh status entity."""
+        if not self.refresh_status_entity: return
+        attributes = dict(status, friendly_name="Music Tracker Refresh", icon="mdi:chart-timeline-variant")
+        self.set_state(self.refresh_status_entity, state=status["state"], attributes=attributes)
+
+    def publish_metrics(self, kwargs=None):
+        """
+        Publishes every metrics group as a <metrics_sensor_prefix>_<group> sensor,
+        whose state is the latest duration of the group's "total" stage in ms,
+        and writes the Prometheus metrics file. Unchanged sensors are skipped.
+        """
+        snapshot = self.metrics.snapshot()
+        snapshot.setdefault("ingest", {}).update({f"queue_{key}": value for key, value in self.ingest_queue.stats().items()})
+        if self.metrics_sensor_prefix:
+            for group, attributes in snapshot.items():
+                if self._published_metrics.get(group) == attributes: continue
+                self._published_metrics[group] = attributes
+                self.set_state(f"{self.metrics_sensor_prefix}_{group}", state=attributes.get("total_last_ms", 0),
+                               attributes=dict(attributes, unit_of_measurement="ms", friendly_name=f"Music Tracker {group.title()}",
+                                               icon="mdi:timer-outline"))
+        if self.metrics_output_path:
+            self.engine.write_metrics(self.metrics_output_path)
+
     def update_html_and_sensors(self):
         """
         Main routine: gather data for each period, compute overview stats,
-        render HTML, and optionally call AI service.
+        render HTML, and optionally call AI service. Runs on the refresh
+        worker thread; use request_refresh to trigger it.
         """
         self.log("Starting chart data generation and HTML/Sensor update process...")
-        timeframes = {
-            "daily":   "1 day",
-            "weekly":  "7 days",
-            "monthly": "30 days",
-            "yearly":  "365 days"
-        }
-        current_charts_data = {}
-        all_data_ok = True
-
-        overview_stats_per_period = {}
-        for period_name, days_str in timeframes.items():
-            stats = self.get_overview_stats_for_period(days_str)
-            overview_stats_per_period[period_name] = stats
+        self.ingest_queue.flush()
+        timeframes = CHART_TIMEFRAMES
+        current_charts_data, overview_stats_per_period, all_data_ok = self.engine.get_all_period_charts(timeframes, CHART_DEPTH)
         self._last_overview_stats_per_period = overview_stats_per_period
 
-        for period_name, days_str in timeframes.items():
-            self.log(f"Generating chart data for period: {period_name} ({days_str})")
-            try:
-                current_charts_data[period_name] = {
-                    "songs": self.get_top_songs(days_str, 100, period_name),
-                    "artists": self.get_top_artists(days_str, 100, period_name),
-                    "albums": self.get_top_albums(days_str, 100, period_name),
-                    "media_channels": self.get_top_media_channels(days_str, 100, period_name),
-                    "dates": self.get_chart_dates_for_period(days_str)
-                }
-                self.store_chart_data_history("songs", period_name, current_charts_data[period_name]["songs"])
-                self.store_chart_data_history("artists", period_name, current_charts_data[period_name]["artists"])
-                self.store_chart_data_history("albums", period_name, current_charts_data[period_name]["albums"])
-                self.store_chart_data_history("media_channels", period_name, current_charts_data[period_name]["media_channels"])
-            except Exception as e:
-                self.log(f"Error generating data for period {period_name}: {e}", level="ERROR")
-                all_data_ok = False
-                current_charts_data[period_name] = {
-                    "songs": [], "artists": [], "albums": [], "media_channels": [], "dates": "Error Generating Data"
-                }
+        self.engine.store_chart_snapshots(current_charts_data)
 
         if not all_data_ok:
             self.log("Errors during chart data generation. HTML might be incomplete.", level="WARNING")
 
         self._last_charts_data = current_charts_data
-        self.render_and_write_html(current_charts_data, None, overview_stats_per_period)
+        self._charts_generated_at = datetime.datetime.now().isoformat(timespec="seconds")
+        self._api_cache = {}
+        self.engine.render_and_write_html(current_charts_data, None, overview_stats_per_period)
+        self.publish_chart_sensors()
 
         if self.ai_service:
             chosen_method = random.choice(["charts", "recent_songs"])
@@ -496,46 +809,184 @@ class MusicTracker(hass.Hass):
             self.log("AI service not configured. Skipping AI analysis.")
 
         self.log("HTML update process finished.")
+        self.publish_metrics()
+
+    def publish_chart_sensors(self):
+        """
+        Publishes the top entries of every chart in _last_charts_data as one
+        sensor per period and category. Sensors whose state and attributes are
+        the same as at their last publish are not written again.
+        """
+        if not self.chart_sensor_prefix: return
+        written = 0
+        for period, period_data in self._last_charts_data.items():
+            for category in CHART_PAYLOAD_COLUMNS:
+                entity_id = f"{self.chart_sensor_prefix}_{period}_{category}"
+                state, attributes = self._chart_sensor_value(period, category, period_data)
+                if self._published_chart_sensors.get(entity_id) == (state, attributes): continue
+                self.set_state(entity_id, state=state, attributes=attributes)
+                self._published_chart_sensors[entity_id] = (state, attributes)
+                written += 1
+        self.log(f"Published {written} changed chart sensors.")
+
+    def _chart_sensor_value(self, period, category, period_data):
+        """
+        Returns (state, attributes) of a chart sensor: the #1 entry, and the top
+        chart_sensor_top_n entries as far as they fit in chart_sensor_max_attribute_bytes.
+        """
+        fields = CHART_PAYLOAD_COLUMNS[category]
+        chart = period_data.get(category) or []
+        items, size = [], 2
+        for rank, item in enumerate(chart[:self.chart_sensor_top_n], 1):
+            entry = dict({field: item.get(field) for field in fields}, rank=rank, change=item.get("change", 0), new_entry=bool(item.get("new_entry")))
+            size += len(json.dumps(entry)) + 1
+            if size > self.chart_sensor_max_attribute_bytes: break
+            items.append(entry)
+        # The last column is the play/track count; the others name the entry.
+        state = " - ".join(str(chart[0].get(field)) for field in fields[:-1])[:255] if chart else "unknown"
+        attributes = {
+            "period": period, "dates": period_data.get("dates"), "items": items,
+            "friendly_name": f"Top {category.replace('_', ' ').title()} ({PERIOD_LABELS.get(period, period.title())})",
+            "icon": CHART_SENSOR_ICONS[category],
+        }
+        return state, attributes
+
+    def charts_api_callback(self, data, kwargs):
+        """
+        Endpoint serving one period's charts as JSON, in the columnar format of
+        the page data file. Parameters come from the query string, overridden
+        by a JSON body: period (default weekly), category (default: all four),
+        limit (default 20) and offset. Responses are cached until the next
+        refresh and carry an etag; a client sending it back (If-None-Match
+        header or etag parameter) gets an empty 304 while the charts are unchanged.
+        """
+        request = (kwargs or {}).get("request")
+        params = dict(request.query) if request is not None else {}
+        if hasattr(data, "items"):
+            params.update(data)
+        period, category = params.get("period", "weekly"), params.get("category") or None
+        try:
+            limit, offset = int(params.get("limit", 20)), int(params.get("offset", 0))
+        except (TypeError, ValueError):
+            return {"error": "limit and offset must be integers"}, 400
+        if period not in CHART_TIMEFRAMES:
+            return {"error": f"Unknown period '{period}'; use one of {', '.join(CHART_TIMEFRAMES)}"}, 400
+        if category is not None and category not in CHART_PAYLOAD_COLUMNS:
+            return {"error": f"Unknown category '{category}'; use one of {', '.join(CHART_PAYLOAD_COLUMNS)}"}, 400
+        if not 1 <= limit <= self.api_max_limit or offset < 0:
+            return {"error": f"limit must be 1-{self.api_max_limit} and offset at least 0"}, 400
+
+        cache, key = self._api_cache, (period, category, limit, offset)
+        response = cache.get(key)
+        if response is None:
+            if period not in self._last_charts_data:
+                return {"error": "Charts have not been generated yet"}, 503
+            if len(cache) >= API_CACHE_SIZE: cache.clear()
+            response = cache[key] = self._build_api_response(period, category, limit, offset)
+        client_etag = params.get("etag") or (request.headers.get("If-None-Match") if request is not None else None)
+        if client_etag and client_etag.replace("W/", "", 1).strip('"') == response["etag"]:
+            return "", 304
+        return response, 200
+
+    def _build_api_response(self, period, category, limit, offset):
+        """
+        Slices the charts of the last refresh; pages beyond its CHART_DEPTH
+        entries are rebuilt from the database.
+        """
+        charts = self._last_charts_data[period]
+        page = {"dates": charts.get("dates")}
+        names = [category] if category else list(CHART_PAYLOAD_COLUMNS)
+        for name in names:
+            items = charts.get(name) or []
+            if offset + limit > len(items) >= CHART_DEPTH:
+                items = getattr(self.engine, f"get_top_{name}")(CHART_TIMEFRAMES[period], offset + limit, period)
+            page[name] = items[offset:offset + limit]
+        entry = self.engine.build_chart_payload({period: page}, self._last_overview_stats_per_period)["charts"][period]
+        response = {
+            "period": period, "label": PERIOD_LABELS.get(period, period.title()), "dates": entry.pop("dates"),
+            "overview": entry.pop("overview"), "offset": offset, "limit": limit, "charts": {name: entry[name] for name in names},
+        }
+        # Hashed without the generation time, so a refresh that changes nothing keeps the etag.
+        response["etag"] = hashlib.sha256(json.dumps(response, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:32]
+        response["generated_at"] = self._charts_generated_at
+        return response
 
     def _call_ai_analysis(self, charts_data_for_ai):
         """
         Sends chart data to the configured AI service for analysis and waits for callback.
         """
         if not isinstance(self.ai_service, str): return
-        domain, service = self.ai_service.split("/", 1)
-        prompt = self.build_prompt_from_chart_data(charts_data_for_ai)
-        
-        try:
-            self.call_service(f"{domain}/{service}", prompt=prompt, timeout=120, hass_timeout=120, callback=self._ai_response_callback)
-        except Exception as e:
-            self.log(f"Error initiating AI service call: {e}", level="ERROR")
-            self.render_and_write_html(self._last_charts_data, f"Error initiating AI analysis: {e}", self._last_overview_stats_per_period)
+        # Everything the prompt can pick from, so the fingerprint does not depend on its random period.
+        prompt_input = {rate: {"dates": data.get("dates"), "artist": (data.get("artists") or [{}])[0].get("artist"),
+                               "songs": [(song.get("artist"), song.get("title"), song.get("plays")) for song in (data.get("songs") or [])[:100]]}
+                        for rate, data in charts_data_for_ai.items() if rate in ("daily", "weekly", "monthly", "yearly") and data}
+        self._request_ai_report(self._ai_fingerprint("charts", prompt_input), lambda: self.build_prompt_from_chart_data(charts_data_for_ai))
 
     def _call_ai_analysis_with_recent_songs(self):
         """
         Gets recent songs, builds a prompt, and calls the AI.
         """
         if not self.ai_service: return
-        last_100_songs = self.get_last_n_unique_songs_with_timestamps(100)
+        last_100_songs = self.engine.get_last_n_unique_songs_with_timestamps(100)
         
         if not last_100_songs:
-            self.render_and_write_html(self._last_charts_data, "Could not generate AI analysis: no recent listening data found.", self._last_overview_stats_per_period)
+            self.engine.render_and_write_html(self._last_charts_data, "Could not generate AI analysis: no recent listening data found.", self._last_overview_stats_per_period)
             return
 
-        prompt = self.build_ai_prompt_from_recent_songs(last_100_songs)
-        domain, service = self.ai_service.split("/", 1)
+        self._request_ai_report(self._ai_fingerprint("recent_songs", last_100_songs), lambda: self.build_ai_prompt_from_recent_songs(last_100_songs))
+
+    def _ai_fingerprint(self, kind, prompt_input):
+        """Stable hash of the data an AI report is generated from, together with the prompt template and the service."""
+        return hashlib.sha256(json.dumps([kind, self.ai_service, AI_PROMPT_1, AI_PROMPT_2, self.ai_prompt_token_budget, prompt_input], sort_keys=True, default=str).encode("utf-8")).hexdigest()
 
+    def _request_ai_report(self, fingerprint, build_prompt):
+        """
+        Shows the AI report for `fingerprint`: from the cache if it is there,
+        otherwise by calling the AI service. No call is made while another one
+        is pending (its response is rendered onto the latest charts) or within
+        ai_min_interval_minutes of the previous call (the last report is kept).
+        """
+        cached = self.engine.get_cached_ai_report(fingerprint, self.ai_cache_ttl_hours * 3600)
+        if cached is not None:
+            self.log("Charts unchanged since a cached AI report, reusing it.")
+            self.metrics.increment("ai:cache_hits")
+            self._last_ai_text = cached
+            self.engine.render_and_write_html(self._last_charts_data, cached, self._last_overview_stats_per_period)
+            return
+
+        with self._ai_lock:
+            now = time.monotonic()
+            if self._ai_in_flight and now - self._ai_in_flight[1] < AI_CALL_TIMEOUT:
+                self.log("An AI analysis is already running; its response will be shown.")
+                self.metrics.increment("ai:joined_in_flight")
+                return
+            if self._ai_last_call is not None and now - self._ai_last_call < self.ai_min_interval_minutes * 60:
+                self.log(f"Last AI analysis was less than {self.ai_min_interval_minutes} minutes ago, keeping its report.")
+                self.metrics.increment("ai:rate_limited")
+                if self._last_ai_text:
+                    self.engine.render_and_write_html(self._last_charts_data, self._last_ai_text, self._last_overview_stats_per_period)
+                return
+            self._ai_in_flight = (fingerprint, now)
+            self._ai_last_call = now
+
+        domain, service = self.ai_service.split("/", 1)
+        self.metrics.increment("ai:calls")
         try:
-            self.call_service(f"{domain}/{service}", prompt=prompt, timeout=120, hass_timeout=120, callback=self._ai_response_callback)
+            self.call_service(f"{domain}/{service}", prompt=build_prompt(), timeout=AI_CALL_TIMEOUT, hass_timeout=AI_CALL_TIMEOUT,
+                              callback=self._ai_response_callback)
         except Exception as e:
+            self._ai_in_flight = None
             self.log(f"Error initiating AI service call: {e}", level="ERROR")
-            self.render_and_write_html(self._last_charts_data, f"Error initiating AI analysis: {e}", self._last_overview_stats_per_period)
-
+            self.engine.render_and_write_html(self._last_charts_data, f"Error initiating AI analysis: {e}", self._last_overview_stats_per_period)
 
     def _ai_response_callback(self, resp):
         """
-        Callback after AI service returns. Extracts AI text and re-renders HTML including it.
+        Callback after AI service returns. Extracts AI text, caches successful
+        reports under the fingerprint of the pending call and re-renders HTML including it.
         """
+        with self._ai_lock:
+            in_flight, self._ai_in_flight = self._ai_in_flight, None
+
         ai_text = None
         if isinstance(resp, dict):
             if resp.get("success"):
@@ -546,6 +997,10 @@ class MusicTracker(hass.Hass):
                     ai_text = result.get("text")
                 if not ai_text:
                     ai_text = "AI analysis successful, but no content extracted."
+                else:
+                    self._last_ai_text = ai_text
+                    if in_flight:
+                        self.engine.store_ai_report(in_flight[0], ai_text, self.ai_cache_ttl_hours * 3600, self.ai_cache_max_entries)
             else:
                 err_msg = resp.get("error", {}).get("message", "Unspecified error from AI service.")
                 ai_text = f"AI analysis failed: {err_msg}"
@@ -553,41 +1008,15 @@ class MusicTracker(hass.Hass):
             ai_text = "AI analysis returned an unexpected response format."
 
         if hasattr(self, '_last_charts_data') and self._last_charts_data:
-            self.render_and_write_html(self._last_charts_data, ai_text, self._last_overview_stats_per_period)
+            self.engine.render_and_write_html(self._last_charts_data, ai_text, self._last_overview_stats_per_period)
         else:
             self.log("Cannot re-render HTML with AI: _last_charts_data is missing.", level="ERROR")
 
-    def render_and_write_html(self, charts_data_to_render, ai_text_content, overview_stats_per_period):
-        """
-        Renders the HTML using Jinja2 template and writes to the configured file path.
-        """
-        if ai_text_content:
-            ai_text_content = re.sub(r'^\s*```(?:html)?\s*|\s*```\s*$', '', ai_text_content)
-
-        try:
-            env = jinja2.Environment(loader=jinja2.BaseLoader(), autoescape=jinja2.select_autoescape(['html', 'xml']))
-            template = env.from_string(TEMPLATE)
-            html_output = template.render(
-                generated_at=datetime.datetime.now().strftime("%d/%m/%Y %H:%M:%S"),
-                charts=charts_data_to_render,
-                overview=overview_stats_per_period,
-                ai_analysis=ai_text_content,
-                webhook=self.webhook
-            )
-        except Exception as e:
-            self.log(f"Jinja2 template rendering error: {e}", level="ERROR")
-            html_output = f"<html><body><h1>Error rendering charts page</h1><p>Details: {e}</p></body></html>"
-
-        try:
-            with open(self.html_output_path, "w", encoding="utf-8") as f:
-                f.write(html_output)
-            self.log(f"Successfully wrote {len(html_output)} bytes to {self.html_output_path}")
-        except Exception as e:
-            self.log(f"Failed to write HTML file to {self.html_output_path}: {e}", level="ERROR")
-
     def build_prompt_from_chart_data(self, charts_for_prompt):
         """
-        Builds a prompt string for the AI service based on chart data.
+        Builds a prompt string for the AI service based on chart data: the top
+        songs of one period, ranked, with artists listed once as codes and the
+        list cut to what fits ai_prompt_token_budget.
         """
         top_artist_name = "a musician"
         potential_rates = ["daily", "weekly", "monthly", "yearly"]
@@ -600,24 +1029,29 @@ class MusicTracker(hass.Hass):
         
         display_name_for_rate = selected_rate_key.capitalize() if selected_rate_key else "Overall"
         dates_str_for_selected_rate = data_for_selected_rate.get("dates", "N/A")
+        preamble = [line.format(identified_artist_name=top_artist_name) for line in AI_PROMPT_1]
+        songs = data_for_selected_rate.get("songs", [])[:100]
+
+        def render(count):
+            legend, rows = {}, []
+            for rank, song in enumerate(songs[:count], 1):
+                code = legend.setdefault(song.get('artist') or "N/A", f"A{len(legend) + 1}")
+                rows.append(f"{rank}. {code} {song.get('title', 'N/A')} ({song.get('plays', 'N/A')})")
+            prompt_lines = preamble + [f"My listening data for the {display_name_for_rate} period covers: {dates_str_for_selected_rate}."]
+            if rows:
+                prompt_lines += [f"\nTop {display_name_for_rate} Songs ({count} of {len(songs)}), as: rank. artist code title (plays).",
+                                 "Artists: " + "; ".join(f"{code}={name}" for name, code in legend.items())] + rows
+            else:
+                prompt_lines.append(f"No {display_name_for_rate.lower()} song data available.")
+            return "\n".join(prompt_lines)
 
-        prompt_lines = [line.format(identified_artist_name=top_artist_name) for line in AI_PROMPT_1]
-        prompt_lines.extend([
-            f"My listening data for the {display_name_for_rate} period covers: {dates_str_for_selected_rate}.",
-            f"\nTop {display_name_for_rate} Songs Data (up to 100):",
-            "| Artist | Title | Plays |", "|---|---|---|"
-        ])
-        songs_to_list = data_for_selected_rate.get("songs", [])[:100]
-        if songs_to_list:
-            for song in songs_to_list:
-                prompt_lines.append(f"| {song.get('artist', 'N/A')} | {song.get('title', 'N/A')} | {song.get('plays', 'N/A')} |")
-        else:
-            prompt_lines.append(f"| No {display_name_for_rate.lower()} song data available. | | |")
-        return "\n".join(prompt_lines)
+        return self._fit_prompt_to_budget(render, len(songs), "charts", minimum=AI_PROMPT_MIN_SONGS)
 
     def build_ai_prompt_from_recent_songs(self, recent_songs_data):
         """
-        Builds a detailed prompt for the AI service based on the last 100 songs played.
+        Builds a detailed prompt for the AI service based on the last 100 songs
+        played: newest first, grouped by the local hour they were played in,
+        with artists listed once as codes and cut to what fits ai_prompt_token_budget.
         """
         top_artist_name = "a musician"
         if recent_songs_data:
@@ -627,428 +1061,195 @@ class MusicTracker(hass.Hass):
                 if artist: artist_counts[artist] = artist_counts.get(artist, 0) + 1
             if artist_counts: top_artist_name = max(artist_counts, key=artist_counts.get)
 
-        prompt_lines = [line.format(identified_artist_name=top_artist_name) for line in AI_PROMPT_2]
+        preamble = [line.format(identified_artist_name=top_artist_name) for line in AI_PROMPT_2]
         if not recent_songs_data:
-            prompt_lines.append("\nMy listening data is not available at this moment.")
-            return "\n".join(prompt_lines)
-
-        first_date = datetime.datetime.strptime(recent_songs_data[0]['timestamp'], '%Y-%m-%d %H:%M:%S').strftime('%B %d, %Y')
-        last_date = datetime.datetime.strptime(recent_songs_data[-1]['timestamp'], '%Y-%m-%d %H:%M:%S').strftime('%B %d, %Y')
-        date_range_info = f"This data covers my listening from approximately {last_date} to {first_date}."
-
-        prompt_lines.extend([
-            f"\nAnalyze my most recent listening history. {date_range_info}",
-            "Below is a list of the last 100 unique songs I've played, with the most recent ones listed first.",
-            "\nMy Most Recent Songs (newest first):",
-            "| Artist | Title | Played At (Timestamp) |", "|---|---|---|"
-        ])
-        for song in recent_songs_data:
-            artist = str(song.get('artist', 'N/A')).replace('|', '-')
-            title = str(song.get('title', 'N/A')).replace('|', '-')
-            prompt_lines.append(f"| {artist} | {title} | {song.get('timestamp', 'N/A')} |")
-        return "\n".join(prompt_lines)
-
-    def create_db_tables(self):
+            return "\n".join(preamble + ["\nMy listening data is not available at this moment."])
+
+        # Plays are stored in UTC; group them by local hour for the time-of-day analysis.
+        played_at = [datetime.datetime.strptime(song['timestamp'], '%Y-%m-%d %H:%M:%S').replace(tzinfo=datetime.timezone.utc).astimezone()
+                     for song in recent_songs_data]
+
+        def render(count):
+            legend, hours = {}, {}
+            for song, local_time in zip(recent_songs_data[:count], played_at):
+                code = legend.setdefault(song.get('artist') or "N/A", f"A{len(legend) + 1}")
+                title = str(song.get('title', 'N/A')).replace(';', ',')
+                hours.setdefault(local_time.strftime('%a %d %b %Y, %H:00'), []).append(f"{code} {title}")
+            date_range_info = (f"This data covers my listening from approximately {played_at[count - 1].strftime('%B %d, %Y')} "
+                               f"to {played_at[0].strftime('%B %d, %Y')}.")
+            return "\n".join(preamble + [
+                f"\nAnalyze my most recent listening history. {date_range_info}",
+                f"Below are the last {count} unique songs I've played, most recent first, grouped by the local hour they were played in.",
+                "Artists: " + "; ".join(f"{code}={name}" for name, code in legend.items()),
+                "\nMy Most Recent Songs (hour: artist code title; ...):",
+            ] + [f"{hour}: " + "; ".join(entries) for hour, entries in hours.items()])
+
+        return self._fit_prompt_to_budget(render, len(recent_songs_data), "recent songs", minimum=AI_PROMPT_MIN_SONGS)
+
+    def _fit_prompt_to_budget(self, render, available, kind, minimum=0):
         """
-        Creates the necessary SQLite tables if they do not yet exist.
+        Returns render(count) for the largest count (at least `minimum`, at most
+        `available`) whose estimated size fits ai_prompt_token_budget, and logs it.
+        Sizes are estimated at CHARS_PER_TOKEN characters per token.
         """
-        try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute("""
-                    CREATE TABLE IF NOT EXISTS music_history (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT, artist TEXT, title TEXT,
-                        album TEXT, media_channel TEXT, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-                    )
-                """)
-                cursor.execute("""
-                    CREATE TABLE IF NOT EXISTS chart_history (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT, type TEXT, period TEXT,
-                        data TEXT, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-                    )
-                """)
-                cursor.execute("CREATE INDEX IF NOT EXISTS idx_music_history_timestamp ON music_history (timestamp);")
-                cursor.execute("CREATE INDEX IF NOT EXISTS idx_chart_history_lookup ON chart_history (type, period, timestamp);")
-                conn.commit()
-            self.log("DB tables checked/created.")
-        except sqlite3.Error as e:
-            self.log(f"DB error during table creation: {e}", level="ERROR")
+        low, high = min(minimum, available), available
+        while low < high:
+            middle = (low + high + 1) // 2
+            if len(render(middle)) <= self.ai_prompt_token_budget * CHARS_PER_TOKEN: low = middle
+            else: high = middle - 1
+        prompt = render(low)
+        tokens = len(prompt) // CHARS_PER_TOKEN
+        if tokens > self.ai_prompt_token_budget:
+            self.log(f"ai_prompt_token_budget ({self.ai_prompt_token_budget}) is too small for the instructions and {low} songs; "
+                     f"sending ~{tokens} tokens. Raise the budget to include more songs.", level="WARNING")
+        else:
+            self.log(f"AI prompt ({kind}): ~{tokens} tokens with {low} of {available} songs (budget {self.ai_prompt_token_budget}).")
+        return prompt
 
-    def cleanup_old_db_tracks(self):
-        """
-        Deletes music_history entries older than one year to keep the database lean.
-        """
-        one_year_ago = (datetime.datetime.now() - datetime.timedelta(days=366)).strftime('%Y-%m-%d %H:%M:%S')
-        try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute("DELETE FROM music_history WHERE timestamp < ?", (one_year_ago,))
-                if cursor.rowcount > 0:
-                    self.log(f"Cleaned {cursor.rowcount} old tracks (>1yr) from DB.")
-                conn.commit()
-        except sqlite3.Error as e:
-            self.log(f"DB error during old track cleanup: {e}", level="ERROR")
+    @staticmethod
+    def _track_identity(state_data):
+        """The parts of a media player state that matter for recording plays; position, volume and artwork are ignored."""
+        state_data = state_data or {}
+        attributes = state_data.get("attributes") or {}
+        return (state_data.get("state"),) + tuple(attributes.get(name) for name in TRACK_ATTRIBUTES)
 
     def handle_media_player_event(self, entity_id, attribute, old_state_data, new_state_data, kwargs):
         """
-        Listens for state changes on media player entities.
+        Listens for state changes on media player entities. Updates that do not
+        change the playing track or the play state are dropped right away.
         """
-        old_title = old_state_data.get("attributes", {}).get("media_title")
-        new_attributes = new_state_data.get("attributes", {})
-        new_title = new_attributes.get("media_title")
-        new_player_state = new_state_data.get("state")
-
-        if entity_id in self._active_track_timers:
-            if old_title != new_title or new_player_state != "playing":
-                self.cancel_timer(self._active_track_timers.pop(entity_id))
-
-        if new_player_state == "playing" and new_attributes.get("media_artist") and new_title:
-            track_info = {
-                "entity_id": entity_id,
-                "artist": new_attributes.get("media_artist"),
-                "title": new_title,
-                "album": new_attributes.get("media_album_name"),
-                "media_channel": new_attributes.get("media_channel") or new_attributes.get("source"),
-            }
-            self._active_track_timers[entity_id] = self.run_in(self._finalize_and_store_track, self.duration_to_consider_played, track_info_at_play_start=track_info)
-
-    def _finalize_and_store_track(self, kwargs):
+        identity = self._track_identity(new_state_data)
+        if self._track_identity(old_state_data) == identity:
+            self.metrics.increment("ingest:events_filtered")
+            return
+        self.metrics.increment("ingest:events_handled")
+        self.player_states[entity_id] = identity
+
+        new_attributes = new_state_data.get("attributes") or {}
+        new_artist, new_title = new_attributes.get("media_artist"), new_attributes.get("media_title")
+        if new_state_data.get("state") != "playing" or not new_artist or not new_title:
+            self.pending_plays.cancel(entity_id)
+            return
+
+        track_info = {
+            "entity_id": entity_id,
+            "artist": new_artist,
+            "title": new_title,
+            "album": new_attributes.get("media_album_name"),
+            "media_channel": new_attributes.get("media_channel") or new_attributes.get("source"),
+            "event_at": time.monotonic(),
+        }
+        pending = self.pending_plays.get(entity_id)
+        if pending and (pending["artist"], pending["title"]) == (new_artist, new_title):
+            # Same track, only its album or channel arrived late.
+            track_info["event_at"] = pending["event_at"]
+            self.pending_plays.update(entity_id, track_info)
+        else:
+            self.pending_plays.schedule(entity_id, track_info)
+
+    def _record_due_tracks(self, kwargs):
+        """Periodic tick: records every track that has been playing for the configured duration."""
+        for track_info in self.pending_plays.pop_due():
+            self._finalize_and_store_track(track_info)
+
+    def _finalize_and_store_track(self, track_info):
         """
         After the delay, check that the same track is still playing before writing to DB.
         """
-        track_info = kwargs.get("track_info_at_play_start")
-        if not track_info: return
         entity_id = track_info["entity_id"]
-        self._active_track_timers.pop(entity_id, None)
-
-        current_state = self.get_state(entity_id, attribute="all")
-        if not current_state or current_state.get("state") != "playing": return
-
-        current_attrs = current_state.get("attributes", {})
-        if current_attrs.get("media_artist") != track_info["artist"] or current_attrs.get("media_title") != track_info["title"]: return
+        # The listener keeps player_states current, so no state lookup is needed here.
+        current_state = self.player_states.get(entity_id)
+        if not current_state or current_state[:3] != ("playing", track_info["artist"], track_info["title"]): return
 
         artist, title, album, media_channel = track_info["artist"], track_info["title"], track_info["album"], track_info["media_channel"]
         if title.lower() in ["tv", "unknown", "advertisement"]: return
 
         cleaned_title = self.clean_text_for_chart(title)
-        cleaned_album = self.clean_text_for_chart(album) if album else "Unknown Album"
-        track_identifier = f"{artist.lower().strip()}|{cleaned_title.lower().strip()}"
+        if not self.recent_plays.add_if_new(self._dedupe_key(entity_id, artist, cleaned_title)):
+            self.metrics.increment("ingest:duplicates_skipped")
+            return
 
-        if self.track_manager.has_been_played_recently(track_identifier): return
-        self.track_manager.add_track(track_identifier)
+        played_at = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        self.ingest_queue.put((artist, title, album or "Unknown Album", media_channel, played_at, entity_id), started_at=track_info["event_at"])
 
-        self.store_track_in_db(artist, cleaned_title, cleaned_album or cleaned_title, media_channel)
+    @staticmethod
+    def _dedupe_key(player, artist, title):
+        return f"{player}|{(artist or '').lower().strip()}|{(title or '').lower().strip()}"
 
-    def clean_text_for_chart(self, text: str) -> str:
-        """Removes common version keywords from track/album titles."""
-        if not isinstance(text, str): return ""
-        keywords = ['remaster', 'mix', 'remix', 'stereo', 'mono', 'demo', 'deluxe', 'instrumental', 'extended', 'version', 'radio edit', 'live', 'edit', 'anniversary', 'edition', 'single', 'explicit', 'clean', 'original', 'acoustic', 'unplugged']
-        pattern = r'\s*[\(\[\-](?:[^\(\)\[\]\-]*\b(?:' + '|'.join(f"{k}\\.?" for k in keywords) + r')\b[^\(\)\[\]\-]*?)[\)\]\-]?\s*'
-        cleaned = re.sub(pattern, '', text, flags=re.IGNORECASE).strip()
-        return cleaned if cleaned else text
-
-    def store_track_in_db(self, artist, title, album, media_channel):
-        """Inserts the given track data into the music_history table."""
+    def _restore_recent_plays(self):
+        """Seeds the dedupe cache with the plays recorded within the dedupe window, so a restart does not record them again."""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute("INSERT INTO music_history (artist, title, album, media_channel, timestamp) VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)", (artist, title, album, media_channel))
-                conn.commit()
+            recent = self.engine.get_recent_plays(self.dedupe_seconds)
         except sqlite3.Error as e:
-            self.log(f"DB error storing track: {e}", level="ERROR")
+            self.log(f"DB error restoring recent plays: {e}", level="WARNING")
+            return
+        for player, artist, title, played_at in recent:
+            played_at = datetime.datetime.fromisoformat(played_at).replace(tzinfo=datetime.timezone.utc).timestamp()
+            self.recent_plays.add(self._dedupe_key(player, artist, title), played_at)
+        if recent:
+            self.log(f"Restored {len(recent)} recent plays into the dedupe cache.")
 
-    def get_chart_dates_for_period(self, days_str):
-        """Returns a date range string for entries in music_history."""
-        try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                query = f"SELECT MIN(timestamp), MAX(timestamp) FROM music_history WHERE timestamp >= datetime('now', '-{days_str}')"
-                cursor.execute(query)
-                res = cursor.fetchone()
-                if res and res[0] and res[1]:
-                    s_dt = datetime.datetime.strptime(res[0], '%Y-%m-%d %H:%M:%S')
-                    e_dt = datetime.datetime.strptime(res[1], '%Y-%m-%d %H:%M:%S')
-                    return s_dt.strftime('%d/%m/%Y') if s_dt.date() == e_dt.date() else f"{s_dt.strftime('%d/%m/%Y')} - {e_dt.strftime('%d/%m/%Y')}"
-                return "Date Range N/A"
-        except Exception as e:
-            self.log(f"Error getting chart dates for '{days_str}': {e}", level="WARNING")
-            return "Date Range Error"
-
-    def get_top_songs(self, days_str, limit, period_name):
-        """Returns a list of dictionaries for the top songs."""
-        previous_chart_data = self.get_previous_chart_data("songs", period_name)
-        query = f"SELECT title, artist, album, COUNT(*) as c FROM music_history WHERE timestamp >= datetime('now', '-{days_str}') GROUP BY title, artist, album ORDER BY c DESC, artist, title LIMIT {limit}"
-        return self._get_chart_data(query, ["title", "artist", "album", "plays"], "songs", period_name, previous_chart_data)
-
-    def get_top_artists(self, days_str, limit, period_name):
-        """Returns a list of dictionaries for the top artists."""
-        previous_chart_data = self.get_previous_chart_data("artists", period_name)
-        query = f"SELECT artist, COUNT(*) as c FROM music_history WHERE timestamp >= datetime('now', '-{days_str}') AND artist IS NOT NULL AND artist != '' GROUP BY artist ORDER BY c DESC, artist LIMIT {limit}"
-        return self._get_chart_data(query, ["artist", "plays"], "artists", period_name, previous_chart_data)
-
-    def get_top_albums(self, days_str, limit, period_name):
-        """Returns a list of dictionaries for the top albums."""
-        previous_chart_data = self.get_previous_chart_data("albums", period_name)
-        query = f"SELECT artist, album, COUNT(DISTINCT title) as c FROM music_history WHERE timestamp >= datetime('now', '-{days_str}') AND album IS NOT NULL AND album != '' AND artist IS NOT NULL AND artist != '' GROUP BY artist, album HAVING c >= {self.min_songs_for_album_chart} ORDER BY c DESC, album, artist LIMIT {limit}"
-        return self._get_chart_data(query, ["artist", "album", "tracks"], "albums", period_name, previous_chart_data)
-
-    def get_top_media_channels(self, days_str, limit, period_name):
-        """Returns a list of dictionaries for the top media channels."""
-        previous_chart_data = self.get_previous_chart_data('media_channels', period_name)
-        query = f"SELECT media_channel, COUNT(*) as c FROM music_history WHERE timestamp >= datetime('now', '-{days_str}') AND media_channel IS NOT NULL AND media_channel != '' GROUP BY media_channel ORDER BY c DESC, media_channel LIMIT {limit}"
-        return self._get_chart_data(query, ["channel", "plays"], "media_channels", period_name, previous_chart_data)
-        
-    def _get_chart_data(self, query, keys, category, period, prev_data):
-        """Generic function to fetch and process chart data."""
-        items_list = []
+    def clean_text_for_chart(self, text: str) -> str:
+        """Removes common version keywords from track/album titles."""
+        return self.engine.normalizer.normalize(text)
+
+    def store_track_in_db(self, artist, title, album, media_channel, player=None):
+        """Inserts the given track data as a play happening now on `player`."""
+        played_at = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute(query)
-                for rank, row in enumerate(cursor.fetchall(), 1):
-                    item = dict(zip(keys, row))
-                    change_info = self.calculate_chart_change(prev_data, item, rank, category)
-                    item.update(change=change_info['change_value'], new_entry=change_info['is_new_entry'])
-                    items_list.append(item)
+            self.engine.store_tracks_in_db([(artist, title, album, media_channel, played_at, player)])
         except sqlite3.Error as e:
-            self.log(f"DB error in _get_chart_data for {category}/{period}: {e}", level="ERROR")
-        return items_list
-
-    def calculate_chart_change(self, previous_chart_list, current_item, current_rank, category):
-        """Computes rank change or marks as new entry."""
-        for idx, prev_item in enumerate(previous_chart_list):
-            match = False
-            if category == 'songs' and prev_item.get('title') == current_item.get('title') and prev_item.get('artist') == current_item.get('artist'): match = True
-            elif category == 'artists' and prev_item.get('artist') == current_item.get('artist'): match = True
-            elif category == 'albums' and prev_item.get('album') == current_item.get('album') and prev_item.get('artist') == current_item.get('artist'): match = True
-            elif category == 'media_channels' and prev_item.get('channel') == current_item.get('channel'): match = True
-            if match:
-                return {'change_value': (idx + 1) - current_rank, 'is_new_entry': False}
-        return {'change_value': 0, 'is_new_entry': True}
-
-    def store_chart_data_history(self, type_of_chart, period, data_list):
-        """Saves chart data JSON to chart_history table."""
-        if not data_list: return
-        try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute("INSERT INTO chart_history (type, period, data, timestamp) VALUES (?, ?, ?, CURRENT_TIMESTAMP)", (type_of_chart, period, json.dumps(data_list)))
-                conn.commit()
-        except Exception as e:
-            self.log(f"Error storing chart history for {type_of_chart}/{period}: {e}", level="WARNING")
+            self.log(f"DB error storing track: {e}", level="ERROR")
 
-    def get_previous_chart_data(self, type_of_chart, period):
-        """Retrieves the most recent chart_history JSON for comparison."""
-        conditions = {
-            "daily": "date(timestamp) = date('now','-1 day')", "weekly": "date(timestamp) >= date('now','-14 days') AND date(timestamp) < date('now','-7 days')",
-            "monthly": "date(timestamp) >= date('now','-60 days') AND date(timestamp) < date('now','-30 days')", "yearly": "date(timestamp) >= date('now','-730 days') AND date(timestamp) < date('now','-365 days')",
-        }
-        condition = conditions.get(period)
-        if not condition: return []
-        query = f"SELECT data FROM chart_history WHERE type = ? AND period = ? AND {condition} ORDER BY timestamp DESC LIMIT 1"
-        try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute(query, (type_of_chart, period))
-                res = cursor.fetchone()
-                if res and res[0]: return json.loads(res[0])
-        except Exception as e:
-            self.log(f"Error fetching previous chart for {type_of_chart}/{period}: {e}", level="WARNING")
-        return []
-
-    def get_overview_stats_for_period(self, days_str):
-        """Computes overview statistics for a given period."""
-        stats = {}
-        queries = {
-            "days": f"SELECT COUNT(DISTINCT date(timestamp)) FROM music_history WHERE timestamp >= datetime('now', '-{days_str}')",
-            "unique_songs": f"SELECT COUNT(DISTINCT artist || '|' || title) FROM music_history WHERE timestamp >= datetime('now', '-{days_str}')",
-            "total_plays": f"SELECT COUNT(*) FROM music_history WHERE timestamp >= datetime('now', '-{days_str}')",
-            "unique_albums": f"SELECT COUNT(DISTINCT artist || '|' || album) FROM music_history WHERE timestamp >= datetime('now', '-{days_str}')",
-            "unique_artists": f"SELECT COUNT(DISTINCT artist) FROM music_history WHERE timestamp >= datetime('now', '-{days_str}')"
-        }
+    def _migrate_legacy_history_batch(self, kwargs):
+        """
+        Moves one batch of the legacy music_history table into the normalized
+        tables, rescheduling itself until the legacy table is empty.
+        """
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                for key, query in queries.items():
-                    cursor.execute(query)
-                    stats[key] = cursor.fetchone()[0] or 0
+            moved = self.engine.migrate_legacy_history_batch()
         except sqlite3.Error as e:
-            self.log(f"DB error in get_overview_stats_for_period ({days_str}): {e}", level="ERROR")
-            return {key: 0 for key in queries}
-        return stats
-
-    def get_last_n_songs_with_timestamps(self, n=100):
-        """Retrieves the last N songs played from the database."""
-        if not self.db_path: return []
-        songs_list = []
-        try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute("SELECT artist, title, timestamp FROM music_history ORDER BY timestamp DESC LIMIT ?", (n,))
-                for row in cursor.fetchall():
-                    songs_list.append({"artist": row[0], "title": row[1], "timestamp": row[2]})
-        except Exception as e:
-            self.log(f"Error retrieving last {n} songs: {e}", level="ERROR")
-        return songs_list
+            self.log(f"DB error while migrating legacy music_history: {e}. Retrying in 60s.", level="ERROR")
+            self.run_in(self._migrate_legacy_history_batch, 60)
+            return
 
-    def get_last_n_unique_songs_with_timestamps(self, n=100):
-        """Retrieves the last N unique songs played from the database."""
-        if not self.db_path: return []
-        songs_list = []
-        try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                query = f"SELECT artist, title, MAX(timestamp) as last_played_ts FROM music_history GROUP BY artist, title ORDER BY last_played_ts DESC LIMIT ?"
-                cursor.execute(query, (n,))
-                for row in cursor.fetchall():
-                    songs_list.append({"artist": row[0], "title": row[1], "timestamp": row[2]})
-        except Exception as e:
-            self.log(f"DB error retrieving last {n} unique songs: {e}", level="ERROR")
-        return songs_list
+        if moved:
+            self.run_in(self._migrate_legacy_history_batch, 1)
+            return
 
+        self._start_title_renormalization()
+        self.engine.cleanup_old_db_tracks()
+        if self._refresh_after_migration:
+            self._refresh_after_migration = False
+            self.request_refresh("migration complete")
 
-    # --- DATABASE CLEANUP METHODS ---
-    
-    def run_optimization(self, kwargs):
-        """Main function to run all cleanup tasks, triggered by its own schedule."""
-        self.log("Scheduled optimization run has started.")
-        
-        if not os.path.exists(self.db_path):
-            self.log(f"❌ Database file not found at '{self.db_path}'. Aborting optimization run.", level="ERROR")
-            return
-        
-        database_was_modified = False
-            
+    def _start_title_renormalization(self):
+        """Schedules the batched re-normalization of stored titles if title_cleanup_keywords changed."""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.row_factory = sqlite3.Row
-                cursor = conn.cursor()
-
-                self.log("--- Task 1: Checking for skipped tracks ---")
-                skipped_deleted_count = self._cleanup_skipped_tracks(cursor)
-                if skipped_deleted_count > 0:
-                    database_was_modified = True
-
-                # --- NEW TASK TO REMOVE REDUNDANT SNAPSHOTS ---
-                self.log("--- Task 2: Deduplicating daily chart snapshots ---")
-                deduplicated_count = self._deduplicate_chart_history(cursor)
-                if deduplicated_count > 0:
-                    database_was_modified = True
-                # --- END OF NEW TASK ---
-
-                if self.cleanup_prune_enabled:
-                    self.log("--- Task 3: Pruning old chart history ---")
-                    pruned_count = self._prune_chart_history(cursor)
-                    if pruned_count > 0:
-                        database_was_modified = True
-                else:
-                    self.log("--- Task 3: Pruning disabled, skipping. ---")
-
-                if database_was_modified and self.cleanup_execute_mode:
-                    self.log("Committing all changes to the database...")
-                    conn.commit()
-                
-                if database_was_modified and self.cleanup_execute_mode and self.cleanup_vacuum_on_complete:
-                    self.log("--- Task 4: Reclaiming disk space ---")
-                    self.log("🧹 Starting VACUUM. This may take a moment...")
-                    conn.row_factory = None
-                    conn.execute("VACUUM;")
-                    conn.row_factory = sqlite3.Row
-                    self.log("✅ VACUUM complete. Database file has been compacted.")
-                
-                self.log("Optimization run finished.")
-
+            pending = self.engine.title_renormalization_pending()
         except sqlite3.Error as e:
-            self.log(f"❌ A database error occurred during optimization: {e}", level="ERROR")
-        except Exception as e:
-            self.log(f"❌ An unexpected error occurred during optimization: {e}", level="ERROR")
-
-    def _cleanup_skipped_tracks(self, cursor):
-        """Finds and deletes skipped tracks. Returns number of rows affected."""
-        query = "SELECT id, timestamp, LAG(timestamp, 1) OVER (ORDER BY timestamp) AS prev_timestamp FROM music_history"
-        cursor.execute(query)
-        
-        ids_to_delete = []
-        for track in cursor.fetchall():
-            if track["prev_timestamp"] is None: continue
-            
-            current_ts = datetime.datetime.fromisoformat(track["timestamp"])
-            prev_ts = datetime.datetime.fromisoformat(track["prev_timestamp"])
-            time_diff = (current_ts - prev_ts).total_seconds()
-            
-            if 0 <= time_diff < self.cleanup_threshold_seconds:
-                ids_to_delete.append((track["id"],))
-
-        found_count = len(ids_to_delete)
-        if found_count == 0:
-            self.log("No skipped tracks found.")
-            return 0
-
-        self.log(f"Found {found_count} skipped tracks.")
-        if self.cleanup_execute_mode:
-            cursor.executemany("DELETE FROM music_history WHERE id = ?;", ids_to_delete)
-            self.log(f"EXECUTE: Deleted {cursor.rowcount} skipped tracks.")
-            return cursor.rowcount
-        else:
-            self.log("DRY RUN: Would have deleted these tracks. Enable 'cleanup_execute_on_run' to proceed.")
-            return 0
+            self.log(f"DB error while checking the title cleanup rules: {e}", level="ERROR")
+            return
+        if pending:
+            self.log("Title cleanup rules changed, re-normalizing stored titles in the background.")
+            self.run_in(self._renormalize_titles_batch, 1)
 
-    # --- NEW CLEANUP FUNCTION ---
-    def _deduplicate_chart_history(self, cursor):
-        """
-        Finds and deletes redundant chart history snapshots, keeping only the
-        latest one for each day/type/period combination.
+    def _renormalize_titles_batch(self, kwargs):
         """
-        query_find_duplicates = """
-            SELECT id FROM (
-                SELECT 
-                    id, 
-                    ROW_NUMBER() OVER (
-                        PARTITION BY date(timestamp), type, period 
-                        ORDER BY timestamp DESC
-                    ) as rn
-                FROM chart_history
-            )
-            WHERE rn > 1;
+        Renames one batch of stored titles and albums to the current cleanup
+        rules, rescheduling itself until none are left.
         """
+        try:
+            renamed = self.engine.renormalize_titles_batch()
+        except sqlite3.Error as e:
+            self.log(f"DB error while re-normalizing titles: {e}. Retrying in 60s.", level="ERROR")
+            self.run_in(self._renormalize_titles_batch, 60)
+            return
+        if renamed:
+            self.run_in(self._renormalize_titles_batch, 1)
 
-        cursor.execute(query_find_duplicates)
-        ids_to_delete = cursor.fetchall()
-
-        found_count = len(ids_to_delete)
-        if found_count == 0:
-            self.log("No duplicate chart snapshots found to clean up.")
-            return 0
-
-        self.log(f"Found {found_count} redundant daily chart snapshots.")
-        
-        if self.cleanup_execute_mode:
-            cursor.executemany("DELETE FROM chart_history WHERE id = ?;", ids_to_delete)
-            self.log(f"EXECUTE: Deleted {cursor.rowcount} redundant snapshots.")
-            return cursor.rowcount
-        else:
-            self.log("DRY RUN: Would have deleted these redundant snapshots. Enable 'cleanup_execute_on_run' to proceed.")
-            return 0
-
-    def _prune_chart_history(self, cursor):
-        """Deletes records from chart_history older than the configured number of days."""
-        cutoff_date_str = f"datetime('now', '-{self.cleanup_prune_keep_days} days')"
-        
-        query_count = f"SELECT COUNT(*) FROM chart_history WHERE timestamp < {cutoff_date_str};"
-        cursor.execute(query_count)
-        count_to_delete = cursor.fetchone()[0]
-
-        if count_to_delete == 0:
-            self.log("No old chart history records to prune.")
-            return 0
-            
-        self.log(f"Found {count_to_delete} chart history records older than {self.cleanup_prune_keep_days} days.")
-        
-        if self.cleanup_execute_mode:
-            query_delete = f"DELETE FROM chart_history WHERE timestamp < {cutoff_date_str};"
-            cursor.execute(query_delete)
-            self.log(f"EXECUTE: Deleted {cursor.rowcount} old records from chart_history.")
-            return cursor.rowcount
-        else:
-            self.log("DRY RUN: Would have deleted these records. Enable 'cleanup_execute_on_run' to proceed.")
-            return 0
+    def run_optimization(self, kwargs):
+        """Runs all database cleanup tasks, triggered by its own schedule."""
+        self.log("Scheduled optimization run has started.")
+        self.engine.run_optimization()
+        self.publish_metrics()
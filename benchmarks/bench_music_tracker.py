@@ -0,0 +1,299 @@
+"""
+Offline benchmark for the Music Tracker app.
+
+Seeds a SQLite file with a synthetic, reproducible listening history, runs
+the app against a stub `hass.Hass` base class and reports timing, Python peak
+memory and SQLite work for each stage as JSON, so results from two versions
+can be compared.
+
+Usage:
+  python benchmarks/bench_music_tracker.py --plays 100000 --output before.json
+  python benchmarks/bench_music_tracker.py --plays 100000 --compare before.json
+
+Python's sqlite3 module does not expose sqlite3_stmt_status(), so "rows
+scanned" is reported as the number of SQLite VM instructions executed
+(`sql_vm_steps`, sampled every VM_STEP_GRANULARITY instructions) together
+with the number of statements run.
+"""
+
+import argparse
+import datetime
+import itertools
+import json
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+APPS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "apps")
+VM_STEP_GRANULARITY = 1000
+CHART_TYPES = ("songs", "artists", "albums", "media_channels")
+
+
+class StubHass:
+    """The subset of appdaemon.plugins.hass.hassapi.Hass used by the app; scheduling is a no-op."""
+    def __init__(self, args=None):
+        self.args = args or {}
+        self.states = {}
+        self.logs = []
+        self.verbose = False
+        self._handles = 0
+
+    def _handle(self):
+        self._handles += 1
+        return self._handles
+
+    def log(self, msg, level="INFO"):
+        self.logs.append((level, msg))
+        if self.verbose or level in ("WARNING", "ERROR"):
+            print(f"[{level}] {msg}", file=sys.stderr)
+
+    def run_in(self, callback, delay, **kwargs): return self._handle()
+    def run_daily(self, callback, start, **kwargs): return self._handle()
+    def run_every(self, callback, start, interval, **kwargs): return self._handle()
+    def run_at(self, callback, start, **kwargs): return self._handle()
+    def cancel_timer(self, handle): pass
+    def timer_running(self, handle): return False
+    def listen_state(self, callback, entity=None, **kwargs): return self._handle()
+    def listen_event(self, callback, event=None, **kwargs): return self._handle()
+    def cancel_listen_state(self, handle): pass
+    def register_endpoint(self, callback, endpoint=None, **kwargs): return endpoint
+    def entity_exists(self, entity_id): return True
+    def call_service(self, service, **kwargs): pass
+
+    def get_state(self, entity_id=None, attribute=None, **kwargs):
+        state = self.states.get(entity_id)
+        if state is None or attribute is None: return state and state["state"]
+        return state if attribute == "all" else state["attributes"].get(attribute)
+
+    def set_state(self, entity_id, state=None, attributes=None, **kwargs):
+        self.states[entity_id] = {"state": state, "attributes": attributes or {}}
+
+
+def load_app_module():
+    """Imports apps/music_tracker.py with the stub installed as appdaemon.plugins.hass.hassapi."""
+    hassapi = types.ModuleType("appdaemon.plugins.hass.hassapi")
+    hassapi.Hass = StubHass
+    for name in ("appdaemon", "appdaemon.plugins", "appdaemon.plugins.hass"):
+        sys.modules.setdefault(name, types.ModuleType(name))
+    sys.modules["appdaemon.plugins.hass.hassapi"] = hassapi
+    sys.modules["appdaemon.plugins.hass"].hassapi = hassapi
+    sys.path.insert(0, os.path.abspath(APPS_DIR))
+    import music_tracker
+    return music_tracker
+
+
+class SqlCounters:
+    """
+    Counts statements and VM instructions on every connection the app opens.
+    The hooks cost a Python call per statement, so they are only attached
+    while a measured stage runs.
+    """
+    def __init__(self):
+        self.connections = []
+        self.enabled = False
+        self.reset()
+
+    def reset(self):
+        self.statements = 0
+        self.vm_steps = 0
+
+    def install(self, conn):
+        self.connections.append(conn)
+        if self.enabled: self._attach(conn)
+
+    def enable(self, enabled):
+        self.enabled = enabled
+        for conn in self.connections:
+            if enabled: self._attach(conn)
+            else:
+                conn.set_trace_callback(None)
+                conn.set_progress_handler(None, VM_STEP_GRANULARITY)
+
+    def _attach(self, conn):
+        conn.set_trace_callback(self._trace)
+        conn.set_progress_handler(self._tick, VM_STEP_GRANULARITY)
+
+    def _trace(self, statement):
+        self.statements += 1
+
+    def _tick(self):
+        self.vm_steps += VM_STEP_GRANULARITY
+        return 0
+
+
+def instrument(module, counters):
+    """Makes the chart engine's ConnectionManager report into `counters`."""
+    engine_module = sys.modules[module.MusicChartEngine.__module__]
+    base = engine_module.ConnectionManager
+
+    class InstrumentedConnectionManager(base):
+        def _connect(self):
+            conn = super()._connect()
+            counters.install(conn)
+            return conn
+
+    engine_module.ConnectionManager = InstrumentedConnectionManager
+
+
+def generate_history(engine, plays, days, seed, batch_size=50000):
+    """
+    Fills the engine's database with `plays` plays spread over `days` days: Zipf-like
+    artist popularity, several albums and tracks per artist, daytime listening
+    sessions on a handful of players/channels, and some skipped tracks.
+    """
+    rnd = random.Random(seed)
+    artists = [f"Artist {i:04d}" for i in range(max(50, plays // 200))]
+    # Cumulative weights are computed once; passing plain weights would redo it on every draw.
+    cum_weights = list(itertools.accumulate(1.0 / (rank + 1) ** 1.1 for rank in range(len(artists))))
+    channels = [f"Channel {i:02d}" for i in range(24)] + ["Spotify", "Radio 1", None]
+    players = [f"media_player.room_{i}" for i in range(4)]
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    start = now - datetime.timedelta(days=days)
+
+    rows, generated = [], 0
+    while generated < plays:
+        session_start = start + datetime.timedelta(days=rnd.random() * days)
+        session_start = session_start.replace(hour=rnd.choice((7, 8, 12, 17, 18, 19, 20, 21, 22)), minute=rnd.randint(0, 59))
+        if session_start >= now: continue
+        channel, player = rnd.choice(channels), rnd.choice(players)
+        ts = session_start
+        session_length = min(rnd.randint(3, 40), plays - generated)
+        for artist in rnd.choices(artists, cum_weights=cum_weights, k=session_length):
+            album_no = rnd.randint(1, 4)
+            title = f"{artist} Song {album_no}-{rnd.randint(1, 12)}"
+            rows.append((artist, title, f"{artist} Album {album_no}", channel, ts.strftime("%Y-%m-%d %H:%M:%S"), player))
+            generated += 1
+            ts += datetime.timedelta(seconds=rnd.randint(15, 45) if rnd.random() < 0.05 else rnd.randint(150, 330))
+            if len(rows) >= batch_size:
+                engine.store_tracks_in_db(rows)
+                rows = []
+    if rows:
+        engine.store_tracks_in_db(rows)
+
+
+def generate_chart_history(engine, days, seed, items=100):
+    """Stores one synthetic snapshot per chart type and period for each of the last `days` days."""
+    rnd = random.Random(seed + 1)
+    today = datetime.datetime.now(datetime.timezone.utc).date()
+    with engine.db.write() as conn:
+        cursor = conn.cursor()
+        for back in range(1, days + 1):
+            day = (today - datetime.timedelta(days=back)).isoformat()
+            for period in ("daily", "weekly", "monthly", "yearly"):
+                for chart_type in CHART_TYPES:
+                    data = []
+                    for rank in range(items):
+                        artist = f"Artist {rnd.randint(0, 300):04d}"
+                        data.append({"title": f"{artist} Song 1-{rank}", "artist": artist, "album": f"{artist} Album 1",
+                                     "channel": f"Channel {rank % 24:02d}", "plays": items - rank, "tracks": items - rank})
+                    engine._store_chart_snapshot(cursor, chart_type, period, data, day=day)
+
+
+def measure(name, fn, counters, results, count_sql=True):
+    """Runs `fn` and appends its wall time, Python peak memory and SQLite counters to `results`."""
+    counters.reset()
+    counters.enable(count_sql)
+    tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        fn()
+    finally:
+        seconds = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        counters.enable(False)
+    statements, vm_steps = (counters.statements, counters.vm_steps) if count_sql else (None, None)
+    results.append({"stage": name, "seconds": round(seconds, 4), "peak_python_kib": peak // 1024,
+                    "sql_statements": statements, "sql_vm_steps": vm_steps})
+    print(f"{name:<24} {seconds:9.3f}s {peak // 1024:>9} KiB {statements or '-':>9} stmts {vm_steps or '-':>13} vm steps", file=sys.stderr)
+
+
+def run(options):
+    module = load_app_module()
+    counters = SqlCounters()
+    instrument(module, counters)
+
+    workdir = options.workdir or tempfile.mkdtemp(prefix="music_tracker_bench_")
+    db_path = os.path.join(workdir, "music_data_history.db")
+    if os.path.exists(db_path): os.remove(db_path)
+    app = module.MusicTracker({
+        "db_path": db_path,
+        "html_output_path": os.path.join(workdir, "music_charts.html"),
+        "media_players": ["media_player.bench"],
+        "ai_service": False,
+        "run_on_startup": False,
+        "cleanup_execute_on_run": True,
+        "cleanup_vacuum_on_complete": options.vacuum,
+    })
+    app.verbose = options.verbose
+
+    stages = []
+    measure("initialize", app.initialize, counters, stages)
+    measure("generate_plays", lambda: generate_history(app.engine, options.plays, options.days, options.seed), counters, stages, count_sql=False)
+    measure("generate_chart_history", lambda: generate_chart_history(app.engine, options.history_days, options.seed), counters, stages, count_sql=False)
+
+    charts = {}
+    def build_charts():
+        charts["result"] = app.engine.get_all_period_charts(module.CHART_TIMEFRAMES, 100)
+    measure("get_all_period_charts", build_charts, counters, stages)
+    current, overview, _ = charts["result"]
+    measure("render_and_write_html", lambda: app.engine.render_and_write_html(current, None, overview), counters, stages)
+    measure("update_html_and_sensors", app.update_html_and_sensors, counters, stages)
+    measure("run_optimization", lambda: app.run_optimization({}), counters, stages)
+    app.terminate()
+
+    return {
+        "benchmark": "music_tracker",
+        "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "parameters": {"plays": options.plays, "days": options.days, "history_days": options.history_days,
+                       "seed": options.seed, "vacuum": options.vacuum},
+        "db_size_bytes": os.path.getsize(db_path),
+        "stages": stages,
+    }
+
+
+def compare(report, baseline):
+    """Prints the per-stage time ratio of `report` against a previous report."""
+    before = {stage["stage"]: stage for stage in baseline.get("stages", [])}
+    for stage in report["stages"]:
+        old = before.get(stage["stage"])
+        if not old: continue
+        ratio = stage["seconds"] / old["seconds"] if old["seconds"] else float("inf")
+        print(f"{stage['stage']:<24} {old['seconds']:9.3f}s -> {stage['seconds']:9.3f}s  x{ratio:.2f}", file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--plays", type=int, default=100000, help="number of plays to generate (10k - 10M)")
+    parser.add_argument("--days", type=int, default=365, help="days of play history to spread the plays over")
+    parser.add_argument("--history-days", type=int, default=365, help="days of chart snapshots to generate")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--vacuum", action="store_true", help="let run_optimization vacuum the database")
+    parser.add_argument("--workdir", help="directory for the database and HTML output (default: a temp dir)")
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    parser.add_argument("--compare", help="JSON report of a previous run to compare against")
+    parser.add_argument("--verbose", action="store_true", help="print every app log line")
+    options = parser.parse_args(argv)
+
+    report = run(options)
+    if options.compare:
+        with open(options.compare, encoding="utf-8") as f:
+            compare(report, json.load(f))
+    if options.output:
+        with open(options.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
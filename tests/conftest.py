@@ -0,0 +1,42 @@
+"""Shared fixtures. The app is imported with the benchmark's stub AppDaemon base class."""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(__file__), os.pardir)
+sys.path.insert(0, os.path.join(ROOT, "apps"))
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+from bench_music_tracker import load_app_module  # noqa: E402
+from music_chart_engine import MusicChartEngine  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def music_tracker():
+    """The apps/music_tracker.py module."""
+    return load_app_module()
+
+
+@pytest.fixture
+def engine(tmp_path):
+    """A MusicChartEngine on an empty temporary database."""
+    engine = MusicChartEngine(str(tmp_path / "music_history.db"))
+    engine.create_db_tables()
+    yield engine
+    engine.close()
+
+
+@pytest.fixture
+def app(music_tracker, tmp_path):
+    """An initialized MusicTracker on a temporary database, without AI service or startup refresh."""
+    app = music_tracker.MusicTracker({
+        "db_path": str(tmp_path / "music_history.db"),
+        "html_output_path": str(tmp_path / "music_charts.html"),
+        "media_players": ["media_player.kitchen"],
+        "ai_service": False,
+        "run_on_startup": False,
+    })
+    app.initialize()
+    yield app
+    app.terminate()
@@ -0,0 +1,38 @@
+"""Chart snapshots: pruning keeps what the previous chart windows compare against."""
+import datetime
+import sqlite3
+
+SONGS = [{"title": "First", "artist": "Band", "plays": 9}, {"title": "Second", "artist": "Band", "plays": 5}]
+
+
+def store_daily_snapshots(engine, days):
+    today = datetime.datetime.now(datetime.timezone.utc).date()
+    for back in range(days):
+        charts = {period: {"songs": SONGS if back < 365 else SONGS[::-1]} for period in ("weekly", "yearly", "year_over_year")}
+        engine.store_chart_snapshots(charts, (today - datetime.timedelta(days=back)).isoformat())
+
+
+def snapshot_days(engine, period):
+    with sqlite3.connect(engine.db_path) as conn:
+        return [day for (day,) in conn.execute("SELECT day FROM chart_snapshots WHERE period = ? ORDER BY day", (period,))]
+
+
+def test_prune_keeps_weekly_snapshots_for_yearly_comparisons(engine):
+    store_daily_snapshots(engine, 800)
+    engine.run_optimization()
+
+    horizon = (datetime.datetime.now(datetime.timezone.utc).date() - datetime.timedelta(days=engine.cleanup_prune_keep_days)).isoformat()
+    assert min(snapshot_days(engine, "weekly")) >= horizon
+    for period in ("yearly", "year_over_year"):
+        old = [day for day in snapshot_days(engine, period) if day < horizon]
+        assert 95 <= len(old) <= 100
+        assert len({datetime.date.fromisoformat(day).strftime("%Y-%W") for day in old}) == len(old)
+
+
+def test_yearly_charts_show_movement_after_pruning(engine):
+    store_daily_snapshots(engine, 800)
+    engine.run_optimization()
+
+    for period in ("yearly", "year_over_year"):
+        items = engine._apply_chart_changes([dict(item) for item in SONGS], "songs", period)
+        assert [(item["change"], item["new_entry"]) for item in items] == [(1, False), (-1, False)]
@@ -0,0 +1,48 @@
+"""Chart sensors: state, attribute size cap and change-only publishing."""
+
+
+def chart(*artists, plays=10):
+    return [{"artist": artist, "plays": plays - n, "change": 0, "new_entry": n == 0} for n, artist in enumerate(artists)]
+
+
+def test_state_is_number_one_and_items_follow_the_chart(app):
+    state, attributes = app._chart_sensor_value("weekly", "artists", {"dates": "01/05/2024 - 07/05/2024", "artists": chart("A", "B", "C")})
+    assert state == "A"
+    assert [item["artist"] for item in attributes["items"]] == ["A", "B", "C"]
+    assert attributes["items"][0] == {"artist": "A", "plays": 10, "rank": 1, "change": 0, "new_entry": True}
+
+
+def test_items_are_capped_by_top_n_and_bytes(app):
+    artists = [f"Artist {n}" for n in range(30)]
+    app.chart_sensor_top_n = 20
+    _, attributes = app._chart_sensor_value("weekly", "artists", {"artists": chart(*artists, plays=100)})
+    assert len(attributes["items"]) == 20
+    app.chart_sensor_max_attribute_bytes = 300
+    _, attributes = app._chart_sensor_value("weekly", "artists", {"artists": chart(*artists, plays=100)})
+    assert 0 < len(attributes["items"]) < 20
+
+
+def test_state_survives_an_oversized_number_one(app):
+    app.chart_sensor_max_attribute_bytes = 50
+    state, attributes = app._chart_sensor_value("weekly", "songs", {"songs": [{"artist": "Band", "title": "x" * 200, "plays": 3}]})
+    assert state == "Band - " + "x" * 200
+    assert attributes["items"] == []
+
+
+def test_empty_chart_is_unknown(app):
+    state, attributes = app._chart_sensor_value("daily", "albums", {"albums": []})
+    assert state == "unknown"
+    assert attributes["items"] == []
+
+
+def test_only_changed_sensors_are_written(app):
+    app._last_charts_data = {"weekly": {"artists": chart("A", "B")}}
+    app.publish_chart_sensors()
+    entity_id = "sensor.music_tracker_top_weekly_artists"
+    assert app.get_state(entity_id) == "A"
+    app.states.clear()
+    app.publish_chart_sensors()
+    assert app.get_state(entity_id) is None
+    app._last_charts_data = {"weekly": {"artists": chart("B", "A")}}
+    app.publish_chart_sensors()
+    assert app.get_state(entity_id) == "B"
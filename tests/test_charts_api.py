@@ -0,0 +1,94 @@
+"""The JSON chart endpoint: parameters, paging, errors and etags."""
+import datetime
+
+import pytest
+
+
+class Request:
+    """The parts of aiohttp's request the endpoint reads."""
+    def __init__(self, query=None, headers=None):
+        self.query = query or {}
+        self.headers = headers or {}
+
+
+def call(app, query=None, body=None, headers=None):
+    return app.charts_api_callback(body or {}, {"request": Request(query, headers)})
+
+
+@pytest.fixture
+def charted_app(app):
+    """The app after one refresh over plays of 150 artists, artist n played n + 1 times."""
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None, microsecond=0)
+    rows, minutes = [], 0
+    for n in range(150):
+        for _ in range(n + 1):
+            minutes += 5
+            ts = (now - datetime.timedelta(minutes=minutes)).strftime("%Y-%m-%d %H:%M:%S")
+            rows.append((f"Artist {n:03d}", f"Song {n}", f"Album {n}", "Radio 1", ts, "media_player.kitchen"))
+    app.engine.store_tracks_in_db(rows)
+    app.update_html_and_sensors()
+    return app
+
+
+def test_unavailable_before_the_first_refresh(app):
+    response, code = call(app)
+    assert code == 503
+
+
+def test_parameters_from_the_query_string(charted_app):
+    response, code = call(charted_app, {"period": "all_time", "category": "artists", "limit": "3", "offset": "1"})
+    assert code == 200
+    assert (response["period"], response["offset"], response["limit"]) == ("all_time", 1, 3)
+    assert list(response["charts"]) == ["artists"]
+    assert response["charts"]["artists"]["artist"] == ["Artist 148", "Artist 147", "Artist 146"]
+
+
+def test_json_body_overrides_the_query_string(charted_app):
+    response, code = call(charted_app, {"period": "all_time", "limit": "3"}, body={"limit": 2, "category": "songs"})
+    assert code == 200
+    assert response["limit"] == 2
+    assert list(response["charts"]) == ["songs"]
+
+
+def test_defaults_cover_all_categories_of_the_weekly_chart(charted_app):
+    response, code = call(charted_app)
+    assert code == 200
+    assert (response["period"], response["limit"], response["offset"]) == ("weekly", 20, 0)
+    assert set(response["charts"]) == {"songs", "artists", "albums", "media_channels"}
+
+
+@pytest.mark.parametrize("query", [
+    {"period": "fortnightly"},
+    {"category": "genres"},
+    {"limit": "many"},
+    {"limit": "0"},
+    {"limit": "100000"},
+    {"offset": "-1"},
+])
+def test_invalid_parameters_are_rejected(app, query):
+    response, code = call(app, query)
+    assert code == 400
+    assert "error" in response
+
+
+def test_pages_beyond_the_refresh_come_from_the_database(charted_app):
+    response, code = call(charted_app, {"period": "all_time", "category": "artists", "limit": "20", "offset": "120"})
+    assert code == 200
+    assert response["charts"]["artists"]["artist"] == [f"Artist {149 - n:03d}" for n in range(120, 140)]
+
+
+def test_matching_etag_gets_an_empty_304(charted_app):
+    query = {"period": "all_time", "category": "artists"}
+    response, _ = call(charted_app, query)
+    etag = response["etag"]
+    assert call(charted_app, query, headers={"If-None-Match": f'"{etag}"'}) == ("", 304)
+    assert call(charted_app, query, headers={"If-None-Match": f'W/"{etag}"'}) == ("", 304)
+    assert call(charted_app, dict(query, etag=etag)) == ("", 304)
+    assert call(charted_app, query, headers={"If-None-Match": '"stale"'})[1] == 200
+
+
+def test_etag_survives_a_refresh_without_changes(charted_app):
+    query = {"period": "all_time", "category": "artists"}
+    etag = call(charted_app, query)[0]["etag"]
+    charted_app.update_html_and_sensors()
+    assert call(charted_app, query)[0]["etag"] == etag
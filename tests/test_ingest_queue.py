@@ -0,0 +1,83 @@
+"""IngestQueue: queued plays are committed by flush() and close(), and kept on write failures."""
+import sqlite3
+import time
+
+import pytest
+
+
+def row(n=0):
+    return (f"Artist {n}", f"Song {n}", "Album", "Radio 1", f"2024-01-01 12:{n:02d}:00", "media_player.kitchen")
+
+
+def play_count(engine):
+    with sqlite3.connect(engine.db_path) as conn:
+        return conn.execute("SELECT count(*) FROM plays").fetchone()[0]
+
+
+@pytest.fixture
+def make_queue(music_tracker):
+    queues = []
+
+    def make(flush_callback, **kwargs):
+        kwargs.setdefault("flush_interval", 30)
+        ingest = music_tracker.IngestQueue(flush_callback, lambda msg, level="INFO": None, **kwargs)
+        queues.append(ingest)
+        return ingest
+    yield make
+    for ingest in queues:
+        ingest.close()
+
+
+def test_flush_commits_queued_play_immediately(engine, make_queue):
+    ingest = make_queue(engine.store_tracks_in_db)
+    ingest.put(row())
+    time.sleep(0.2)  # let the writer thread pick the row up and wait for more
+    assert ingest.stats()["depth"] == 1
+    ingest.flush()
+    assert play_count(engine) == 1
+    assert ingest.stats()["depth"] == 0
+    assert ingest.stats()["written"] == 1
+
+
+def test_full_batch_is_written_without_waiting(engine, make_queue):
+    ingest = make_queue(engine.store_tracks_in_db, batch_size=3)
+    for n in range(3):
+        ingest.put(row(n))
+    deadline = time.monotonic() + 5
+    while play_count(engine) < 3 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert play_count(engine) == 3
+
+
+def test_close_flushes_remaining_rows(engine, make_queue):
+    ingest = make_queue(engine.store_tracks_in_db)
+    ingest.put(row(1))
+    ingest.put(row(2))
+    ingest.close()
+    assert play_count(engine) == 2
+
+
+def test_failed_write_is_retried(make_queue):
+    written, fail = [], [True]
+
+    def flaky(rows):
+        if fail[0]:
+            raise sqlite3.OperationalError("database is locked")
+        written.extend(rows)
+    ingest = make_queue(flaky)
+    ingest.put(row())
+    ingest.flush()
+    assert ingest.stats()["failed_flushes"] == 1
+    assert ingest.stats()["depth"] == 1
+    fail[0] = False
+    ingest.flush()
+    assert written == [row()]
+    assert ingest.stats()["depth"] == 0
+
+
+def test_full_queue_flushes_on_calling_thread(make_queue):
+    written = []
+    ingest = make_queue(written.extend, max_size=2, batch_size=10)
+    for n in range(3):
+        ingest.put(row(n))
+    assert written == [row(0), row(1), row(2)]
@@ -0,0 +1,25 @@
+"""EXPLAIN QUERY PLAN regression tests: every chart query must be served by an index."""
+import datetime
+
+
+def seed_plays(engine, days=800, plays_per_day=6):
+    """Stores a few plays per day over the last `days` days, so every chart period has data."""
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None, microsecond=0)
+    rows = []
+    for back in range(days):
+        for n in range(plays_per_day):
+            artist = f"Artist {(back + n) % 7}"
+            ts = now - datetime.timedelta(days=back, minutes=4 * n)
+            rows.append((artist, f"{artist} Song {n}", f"{artist} Album", "Radio 1", ts.strftime("%Y-%m-%d %H:%M:%S"), "media_player.kitchen"))
+    engine.store_tracks_in_db(rows)
+
+
+def test_empty_database_plans_use_indexes(engine):
+    assert engine.check_query_plans() == []
+
+
+def test_seeded_database_plans_use_indexes(engine):
+    seed_plays(engine)
+    engine.rebuild_chart_history(3)
+    engine.run_optimization()
+    assert engine.check_query_plans() == []
@@ -0,0 +1,76 @@
+"""Daily rollups and the monthly archive stay consistent with the plays they summarize."""
+import datetime
+import sqlite3
+
+from music_chart_engine import DEFAULT_TITLE_CLEANUP_KEYWORDS, MusicChartEngine
+
+PERIODS = {"weekly": "7 days", "yearly": "365 days", "all_time": "all"}
+
+
+def history(days=500):
+    """Two to four plays a day over `days` days, on two players, never close enough to count as skipped."""
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None, microsecond=0)
+    rows = []
+    for back in range(days):
+        for n in range(2 + back % 3):
+            artist = f"Artist {(back * 7 + n) % 5}"
+            ts = now - datetime.timedelta(days=back, minutes=10 * n)
+            title = f"Song {n}" + (" (Live)" if back % 4 == 0 else "")
+            rows.append((artist, title, f"{artist} LP", "Radio 1", ts.strftime("%Y-%m-%d %H:%M:%S"), f"media_player.room_{n % 2}"))
+    return rows
+
+
+def rollup_mismatches(engine):
+    with engine.db.write() as conn:
+        return engine.check_daily_rollups(conn.cursor())
+
+
+def artist_totals(engine):
+    charts, overview, all_ok = engine.get_all_period_charts(PERIODS, 100)
+    assert all_ok
+    return {period: ({item["artist"]: item["plays"] for item in charts[period]["artists"]}, overview[period]["total_plays"]) for period in PERIODS}
+
+
+def test_rollups_follow_inserts_and_deletes(engine):
+    rows = history()
+    engine.store_tracks_in_db(rows)
+    assert rollup_mismatches(engine) == 0
+    assert artist_totals(engine)["all_time"][1] == len(rows)
+
+    newest = datetime.datetime.fromisoformat(rows[0][4])
+    engine.store_tracks_in_db([rows[0][:4] + ((newest + datetime.timedelta(seconds=20)).strftime("%Y-%m-%d %H:%M:%S"), rows[0][5])])
+    engine.run_optimization()
+    assert rollup_mismatches(engine) == 0
+    assert artist_totals(engine)["all_time"][1] == len(rows)
+
+
+def test_archiving_keeps_chart_totals(engine):
+    engine.store_tracks_in_db(history())
+    before = artist_totals(engine)
+    with sqlite3.connect(engine.db_path) as conn:
+        plays_before = conn.execute("SELECT count(*) FROM plays").fetchone()[0]
+    engine.cleanup_old_db_tracks()
+    with sqlite3.connect(engine.db_path) as conn:
+        assert conn.execute("SELECT count(*) FROM plays").fetchone()[0] < plays_before
+    assert artist_totals(engine) == before
+    assert rollup_mismatches(engine) == 0
+
+
+def test_renormalization_merges_keep_totals(tmp_path):
+    db_path = str(tmp_path / "music_history.db")
+    without_live = MusicChartEngine(db_path, title_cleanup_keywords=[k for k in DEFAULT_TITLE_CLEANUP_KEYWORDS if k != "live"])
+    without_live.create_db_tables()
+    without_live.store_tracks_in_db(history())
+    without_live.cleanup_old_db_tracks()
+    before = artist_totals(without_live)
+    without_live.close()
+
+    engine = MusicChartEngine(db_path)
+    try:
+        assert engine.renormalize_titles() > 0
+        with sqlite3.connect(db_path) as conn:
+            assert conn.execute("SELECT count(*) FROM tracks WHERE title LIKE '%(Live)'").fetchone()[0] == 0
+        assert artist_totals(engine) == before
+        assert rollup_mismatches(engine) == 0
+    finally:
+        engine.close()
@@ -0,0 +1,50 @@
+"""Skipped-track cleanup: only new plays are checked, whatever their timestamps."""
+import sqlite3
+
+
+def play(title, minute, second=0):
+    return ("Band", title, "LP", None, f"2026-01-01 12:{minute:02d}:{second:02d}", "media_player.kitchen")
+
+
+def titles(engine):
+    with sqlite3.connect(engine.db_path) as conn:
+        return [title for (title,) in conn.execute("SELECT t.title FROM plays p JOIN tracks t ON t.id = p.track_id ORDER BY p.ts")]
+
+
+def test_skipped_play_is_deleted(engine):
+    engine.store_tracks_in_db([play("A", 0), play("B", 0, 20), play("C", 5)])
+    engine.run_optimization()
+    assert titles(engine) == ["A", "C"]
+
+
+def test_late_play_with_an_older_timestamp_is_checked(engine):
+    engine.store_tracks_in_db([play("A", 0), play("B", 10)])
+    engine.run_optimization()
+    engine.store_tracks_in_db([play("Late", 0, 30)])
+    engine.run_optimization()
+    assert titles(engine) == ["A", "B"]
+
+
+def test_late_play_is_compared_with_the_play_after_it(engine):
+    engine.store_tracks_in_db([play("A", 0), play("C", 5)])
+    engine.run_optimization()
+    engine.store_tracks_in_db([play("B", 4, 30)])
+    engine.run_optimization()
+    assert titles(engine) == ["A", "B"]
+
+
+def test_reused_id_of_a_deleted_newest_play_is_checked(engine):
+    engine.store_tracks_in_db([play("A", 0), play("B", 0, 10)])
+    engine.run_optimization()
+    assert titles(engine) == ["A"]
+    engine.store_tracks_in_db([play("D", 0, 20)])
+    engine.run_optimization()
+    assert titles(engine) == ["A"]
+
+
+def test_checked_plays_are_not_scanned_again(engine):
+    engine.store_tracks_in_db([play("A", 0), play("B", 5)])
+    engine.run_optimization()
+    engine.cleanup_threshold_seconds = 600
+    engine.run_optimization()
+    assert titles(engine) == ["A", "B"]
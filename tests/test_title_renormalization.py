@@ -0,0 +1,74 @@
+"""Title re-normalization after a change of the cleanup rules, in single and bounded batches."""
+import sqlite3
+
+import pytest
+
+from music_chart_engine import DEFAULT_TITLE_CLEANUP_KEYWORDS, MusicChartEngine
+
+ROWS = [
+    ("Band", "Song (Remastered)", "LP (Remastered)", None, "2024-05-01 10:00:00", "media_player.kitchen"),
+    ("Band", "Song - Remastered", "LP", None, "2024-05-02 10:00:00", "media_player.kitchen"),
+    ("Band", "Song", "LP", None, "2024-05-03 10:00:00", "media_player.kitchen"),
+    ("Band", "Other (Remastered)", "LP (Remastered)", None, "2024-05-04 10:00:00", "media_player.kitchen"),
+    ("Solo", "Tune - Remastered", None, None, "2024-05-05 10:00:00", "media_player.office"),
+]
+
+
+def chart_rows(db_path):
+    with sqlite3.connect(db_path) as conn:
+        return conn.execute("""
+            SELECT a.name, t.title, al.name, count(p.id) FROM tracks t JOIN artists a ON a.id = t.artist_id
+            LEFT JOIN albums al ON al.id = t.album_id LEFT JOIN plays p ON p.track_id = t.id
+            GROUP BY t.id ORDER BY 1, 2, 3
+        """).fetchall()
+
+
+@pytest.fixture
+def renormalizing_engine(tmp_path):
+    """An engine whose rules strip "remastered", on a database filled under the default rules."""
+    db_path = str(tmp_path / "music_history.db")
+    old = MusicChartEngine(db_path)
+    old.create_db_tables()
+    old.store_tracks_in_db(ROWS)
+    old.renormalize_titles()
+    old.close()
+    engine = MusicChartEngine(db_path, title_cleanup_keywords=list(DEFAULT_TITLE_CLEANUP_KEYWORDS) + ["remastered"])
+    yield engine
+    engine.close()
+
+
+def test_changed_rules_are_detected(renormalizing_engine):
+    assert renormalizing_engine.title_renormalization_pending()
+    renormalizing_engine.renormalize_titles()
+    assert not renormalizing_engine.title_renormalization_pending()
+
+
+def test_renames_merge_tracks_and_keep_plays(renormalizing_engine):
+    assert renormalizing_engine.renormalize_titles() == 5
+    assert chart_rows(renormalizing_engine.db_path) == [
+        ("Band", "Other", "LP", 1),
+        ("Band", "Song", "LP", 3),
+        ("Solo", "Tune", None, 1),
+    ]
+
+
+def test_batches_match_a_single_pass(renormalizing_engine, tmp_path):
+    batches = []
+    while True:
+        renamed = renormalizing_engine.renormalize_titles_batch(batch_size=1)
+        if not renamed: break
+        batches.append(renamed)
+    assert batches == [1, 1, 1, 1, 1]
+    assert not renormalizing_engine.title_renormalization_pending()
+
+    single = MusicChartEngine(str(tmp_path / "single.db"), title_cleanup_keywords=list(DEFAULT_TITLE_CLEANUP_KEYWORDS) + ["remastered"])
+    single.create_db_tables()
+    single.store_tracks_in_db(ROWS)
+    single.close()
+    assert chart_rows(renormalizing_engine.db_path) == chart_rows(single.db_path)
+
+
+def test_new_plays_use_the_renamed_titles(renormalizing_engine):
+    renormalizing_engine.renormalize_titles()
+    renormalizing_engine.store_tracks_in_db([("Band", "Song (Remastered)", "LP (Remastered)", None, "2024-05-06 10:00:00", "media_player.kitchen")])
+    assert ("Band", "Song", "LP", 4) in chart_rows(renormalizing_engine.db_path)